@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+import constants
+
+SUM = constants.AGGREGATION_SUM
+COUNT = constants.AGGREGATION_COUNT
+SUM_SQUARES = constants.AGGREGATION_SUM_SQUARES
+STATISTICS = constants.AGGREGATION_STATISTICS
+
+
+def is_aggregated(data):
+    if isinstance(data, pd.Series):
+        return False
+    if isinstance(data.columns, pd.MultiIndex):
+        return True
+    return set(data.columns) == set(STATISTICS)
+
+
+def _get_statistic(data, statistic):
+    if isinstance(data.columns, pd.MultiIndex):
+        return data.xs(statistic, axis=1, level=1)
+    return data[statistic]
+
+
+def get_sensors(data):
+    if not is_aggregated(data):
+        return data.columns
+    return _get_statistic(data, SUM).columns
+
+
+def rename_sensors(data, mapper):
+    if not is_aggregated(data):
+        return data.rename(columns=mapper)
+    return data.rename(columns=mapper, level=0)
+
+
+def mean(data):
+    if not is_aggregated(data):
+        return data.mean()
+    sums = _get_statistic(data, SUM).sum()
+    counts = _get_statistic(data, COUNT).sum()
+    if isinstance(counts, pd.Series):
+        return sums / counts.replace(0, np.nan)
+    return sums / counts if counts else np.nan
+
+
+def means(data):
+    if not is_aggregated(data):
+        return data
+    return _get_statistic(data, SUM) / _get_statistic(data, COUNT).replace(0, np.nan)
+
+
+def rolling_mean(data, period):
+    if not is_aggregated(data):
+        return data.rolling(period).mean()
+    sums = _get_statistic(data, SUM).rolling(period).sum()
+    counts = _get_statistic(data, COUNT).rolling(period).sum()
+    return sums / counts.replace(0, np.nan)
+
+
+def rolling_std(data, period):
+    if not is_aggregated(data):
+        return data.rolling(period).std()
+    sums = _get_statistic(data, SUM).rolling(period).sum()
+    counts = _get_statistic(data, COUNT).rolling(period).sum()
+    sums_squares = _get_statistic(data, SUM_SQUARES).rolling(period).sum()
+    variances = (sums_squares - sums ** 2 / counts.replace(0, np.nan)) / (counts - 1).where(counts > 1)
+    return np.sqrt(variances.clip(lower=0.))
@@ -8,9 +8,19 @@ PREDICTION_SMOOTHING_PERIOD = datetime.timedelta(hours=48)
 STATISTICS_SMOOTHING_PERIOD = datetime.timedelta(minutes=10)
 STATISTICS_INDEX_FILTERING_MINUTES = 10
 TEMPERATURES_STD_PERIOD = datetime.timedelta(hours=6)
+OUTPUT_WRITE_QUEUE_SIZE = 4
+STAGES_MAX_WORKERS = 4
 
 TEMPERATURES_HISTORY = datetime.timedelta(days=4)
 ANALYSIS_HISTORY = datetime.timedelta(days=4)
+LATE_DATA_WINDOW = datetime.timedelta(days=4)
+FINGERPRINT_BUCKET_MINUTES = 60
+# per bucket statistics of aggregated reads and input fingerprints
+AGGREGATION_SUM = 'sum'
+AGGREGATION_COUNT = 'count'
+AGGREGATION_SUM_SQUARES = 'sum_squares'
+AGGREGATION_STATISTICS = [AGGREGATION_SUM, AGGREGATION_COUNT, AGGREGATION_SUM_SQUARES]
+LATE_DATA_FULL_SCAN_INTERVAL = datetime.timedelta(hours=1)
 
 NN_NORMALIZING_EXPECTATION_EVALUATION = 500.
 NN_NORMALIZING_STD_EVALUATION = 100.
@@ -21,3 +31,25 @@ NN_OUTPUT_FEATURES_NUMBER = 5
 INPUT_DATETIME_COLUMN = 'Timestamp'
 MODEL_DATETIME_COLUMN = 'Timestamp'
 OUTPUT_DATETIME_COLUMN = 'Дата'
+
+SQL_SINK = 'sql'
+PARQUET_SINK = 'parquet'
+DEFAULT_WATERMARKS_TABLE = 'run_watermarks'
+DEFAULT_FINGERPRINTS_TABLE = 'input_fingerprints'
+PARQUET_PENDING_TIMEOUT = datetime.timedelta(days=1)
+
+SCORING_DEFAULT_PORT = 8765
+SCORING_BATCH_WINDOW = datetime.timedelta(milliseconds=20)
+SCORING_MAX_BATCH_SIZE = 64
+SCORING_DATA_TTL = 60.
+SCORING_LATENCY_WINDOW = 10000
+
+DEFAULT_WORK_UNITS_TABLE = 'work_units'
+WORK_UNIT_MAX_ATTEMPTS = 3
+WORK_UNIT_LEASE_TIMEOUT = datetime.timedelta(minutes=30)
+WORK_UNIT_CHUNK = datetime.timedelta(days=1)
+WORK_UNIT_SENSORS_NUMBER = 4
+WORK_QUEUE_LOCK_TIMEOUT = 30.
+WORK_QUEUE_POLL_INTERVAL = 1.
+
+HOT_RELOAD_POLL_INTERVAL = 30.
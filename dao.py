@@ -1,14 +1,21 @@
 import json
 import os
+import warnings
+
+import exceptions
 
 from domain.reactor_schema import IsobutaneReactor, ReactorPlate
 
+DICT_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'resources', 'dict')
+REACTORS_PATH = os.path.join(DICT_DIR, 'reactors.json')
+CHEMICAL_ANALYSIS_TAGS_PATH = os.path.join(DICT_DIR, 'chemical_analysis_tags.json')
+TEMPERATURES_TAGS_PATH = os.path.join(DICT_DIR, 'temperature_sensors_tags.json')
+DICT_PATHS = [REACTORS_PATH, CHEMICAL_ANALYSIS_TAGS_PATH, TEMPERATURES_TAGS_PATH]
+
 
 class ReactorsDao:
     def __init__(self):
-        path = os.path.abspath(os.path.dirname(__file__))
-        path = os.path.join(path, "./resources/dict/reactors.json")
-        with open(path, 'r', encoding='utf-8') as f:
+        with open(REACTORS_PATH, 'r', encoding='utf-8') as f:
             self._reactors_dict = {reactor_name: IsobutaneReactor(reactor_name,
                                                                   {plate_name: ReactorPlate(plate_name, sensors_config)
                                                                    for plate_name, sensors_config in
@@ -34,9 +41,7 @@ class ReactorsDao:
 
 class ChemicalAnalysisTagsDao:
     def __init__(self):
-        path = os.path.abspath(os.path.dirname(__file__))
-        path = os.path.join(path, "./resources/dict/chemical_analysis_tags.json")
-        with open(path, 'r', encoding='utf-8') as f:
+        with open(CHEMICAL_ANALYSIS_TAGS_PATH, 'r', encoding='utf-8') as f:
             self._tags_dict = json.load(f)
 
     def findall(self):
@@ -45,21 +50,52 @@ class ChemicalAnalysisTagsDao:
 
 class TemperaturesTagsDao:
     def __init__(self):
-        path = os.path.abspath(os.path.dirname(__file__))
-        path = os.path.join(path, "./resources/dict/temperature_sensors_tags.json")
-        with open(path, 'r', encoding='utf-8') as f:
+        with open(TEMPERATURES_TAGS_PATH, 'r', encoding='utf-8') as f:
             self._tags_dict = json.load(f)
 
     def findall(self):
         return dict(self._tags_dict)
 
 
+def _get_file_version(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
 class Dao:
     def __init__(self):
+        self._versions = {path: _get_file_version(path) for path in DICT_PATHS}
         self._reactors_dao = ReactorsDao()
         self._chemical_analysis_tags_dao = ChemicalAnalysisTagsDao()
         self._temperatures_tags_dao = TemperaturesTagsDao()
 
+    def _find_changed_paths(self):
+        return [path for path in DICT_PATHS if _get_file_version(path) != self._versions.get(path)]
+
+    def has_changes(self):
+        return len(self._find_changed_paths()) > 0
+
+    def reload(self):
+        changed_paths = self._find_changed_paths()
+        if not changed_paths:
+            return False
+        versions = {path: _get_file_version(path) for path in changed_paths}
+        try:
+            reactors_dao = ReactorsDao() if REACTORS_PATH in changed_paths else self._reactors_dao
+            chemical_analysis_tags_dao = ChemicalAnalysisTagsDao() \
+                if CHEMICAL_ANALYSIS_TAGS_PATH in changed_paths else self._chemical_analysis_tags_dao
+            temperatures_tags_dao = TemperaturesTagsDao() \
+                if TEMPERATURES_TAGS_PATH in changed_paths else self._temperatures_tags_dao
+        except Exception as e:
+            warnings.warn('dictionaries reload failed, previous ones are kept: {}'.format(str(e)),
+                          exceptions.MissingComponentsWarning)
+            return False
+        self._reactors_dao = reactors_dao
+        self._chemical_analysis_tags_dao = chemical_analysis_tags_dao
+        self._temperatures_tags_dao = temperatures_tags_dao
+        self._versions.update(versions)
+        return True
+
     def get_reactors_dao(self):
         return self._reactors_dao
 
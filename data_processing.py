@@ -1,3 +1,4 @@
+import aggregation
 import constants
 
 
@@ -43,4 +44,5 @@ class DataPostprocessor:
             .rolling(constants.PREDICTION_SMOOTHING_PERIOD).mean()
 
     def process_temperatures(self, data):
-        return data.rename(columns=self._convert_sensor_id).reindex(data.index.rename(constants.OUTPUT_DATETIME_COLUMN))
+        return aggregation.rename_sensors(data, self._convert_sensor_id)\
+            .reindex(data.index.rename(constants.OUTPUT_DATETIME_COLUMN))
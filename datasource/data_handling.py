@@ -1,8 +1,12 @@
+import queue
+import threading
 from collections import defaultdict
 
 import pandas as pd
 
+import aggregation
 import constants
+from datasource import output_schema, sinks
 from datasource.source import SQLSource
 
 
@@ -11,31 +15,74 @@ class InputDataHandler:
         source_params = settings.get_input()
         self._source = SQLSource(source_params, constants.INPUT_DATETIME_COLUMN)
         self._table_names = settings.get_input_tables()
+        self._temperatures_aggregation_minutes = source_params.get('temperatures_aggregation_minutes')
         self._temperatures_data = None
         self._last_temperatures_datetime = None
         self._analysis_data = None
         self._last_analysis_datetime = None
 
-    def get_temperatures(self, since_datetime=None):
-        return self._source.get_data_since(self._table_names['temperatures'], since_datetime)
+    def get_temperatures(self, since_datetime=None, until_datetime=None):
+        if self._temperatures_aggregation_minutes:
+            return self._source.get_aggregated_data_since(self._table_names['temperatures'],
+                                                          self._temperatures_aggregation_minutes, since_datetime,
+                                                          until_datetime=until_datetime)
+        return self._source.get_data_since(self._table_names['temperatures'], since_datetime,
+                                           until_datetime=until_datetime)
 
-    def get_analysis(self, since_datetime=None):
+    def get_table_types(self):
+        return list(self._table_names.keys())
+
+    def get_fingerprints(self, table_type, since_datetime, until_datetime):
+        # per bucket sums, counts and sums of squares of every column change whenever rows are added or corrected,
+        # rows are taken in (since_datetime, until_datetime] so buckets after a bucket bound are whole
+        return self._source.get_aggregated_data_since(self._table_names[table_type],
+                                                      constants.FINGERPRINT_BUCKET_MINUTES, since_datetime,
+                                                      allow_equality=False, until_datetime=until_datetime)
+
+    def get_row_counts(self, table_type, since_datetime, until_datetime):
+        # rows per fingerprint bucket, a cheap check for added and removed rows
+        return self._source.get_bucket_counts(self._table_names[table_type], constants.FINGERPRINT_BUCKET_MINUTES,
+                                              since_datetime, allow_equality=False, until_datetime=until_datetime)
+
+    def get_table_name(self, table_type):
+        return self._table_names[table_type]
+
+    def get_analysis(self, since_datetime=None, until_datetime=None):
         analysis_data_list = []
         for table_type, table_name in self._table_names.items():
             if table_type == 'temperatures':
                 continue
-            analysis_data_list.append(self._source.get_data_since(self._table_names[table_type], since_datetime))
+            analysis_data_list.append(self._source.get_data_since(self._table_names[table_type], since_datetime,
+                                                                  until_datetime=until_datetime))
         return pd.concat(analysis_data_list, axis=1, sort=True, join='outer')
 
+    def find_first_analysis_datetime(self):
+        first_datetimes = [self._source.find_first_datetime(table_name)
+                           for table_type, table_name in self._table_names.items() if table_type != 'temperatures']
+        first_datetimes = [first_datetime for first_datetime in first_datetimes if first_datetime is not None]
+        return min(first_datetimes) if first_datetimes else None
+
 
 class OutputDataHandler:
     def __init__(self, settings):
-        source_params = settings.get_output()
         self._table_names = settings.get_output_tables()
-        self._source = SQLSource(source_params, constants.OUTPUT_DATETIME_COLUMN)
+        self._sink = sinks.build_sink(settings)
+
+    def _ensure_schema(self):
+        self._sink.ensure_schema()
 
     def find_last_prediction_datetime(self):
-        return self._source.find_last_datetime(self._table_names['predictions'])
+        predictions_table = self._table_names['predictions']
+        # the watermark is read before any schema change, a run never depends on DDL to find its bound
+        last_datetime = self._sink.find_watermark(predictions_table)
+        if last_datetime is not None:
+            return last_datetime
+        self._ensure_schema()
+        # tables written before the watermarks table existed are scanned once to seed it, the seed is written
+        # before any prediction so rows of a failed run never pass for a finished one
+        last_datetime = self._sink.find_last_datetime('predictions')
+        self._sink.set_watermark(predictions_table, last_datetime)
+        return last_datetime
 
     @staticmethod
     def _format_predictions(predictions):
@@ -52,7 +99,7 @@ class OutputDataHandler:
 
     @staticmethod
     def _smooth_statistics(data):
-        return data.rolling(constants.STATISTICS_SMOOTHING_PERIOD).mean()
+        return aggregation.rolling_mean(data, constants.STATISTICS_SMOOTHING_PERIOD)
 
     @staticmethod
     def _filter_statistics(data):
@@ -73,6 +120,7 @@ class OutputDataHandler:
 
     @staticmethod
     def _build_temperatures_diff(raw_temperatures):
+        raw_temperatures = aggregation.means(raw_temperatures)
         plates_columns = defaultdict(list)
         for col in raw_temperatures.columns:
             plates_columns[int(col.split(':')[0])].append(col)
@@ -94,7 +142,7 @@ class OutputDataHandler:
 
     @staticmethod
     def _build_temperatures_std(raw_temperatures):
-        raw_stds = raw_temperatures.rolling(constants.TEMPERATURES_STD_PERIOD).std()
+        raw_stds = aggregation.rolling_std(raw_temperatures, constants.TEMPERATURES_STD_PERIOD)
         filtered_stds = OutputDataHandler._filter_statistics(raw_stds)
         rows_number = filtered_stds.shape[0]
         stds = []
@@ -108,6 +156,7 @@ class OutputDataHandler:
 
     @staticmethod
     def _build_temperatures_plates_std(raw_temperatures):
+        raw_temperatures = aggregation.means(raw_temperatures)
         plates_columns = defaultdict(list)
         for col in raw_temperatures.columns:
             plates_columns[int(col.split(':')[0])].append(col)
@@ -122,31 +171,152 @@ class OutputDataHandler:
                                      index=smoothed_filtered_std.index))
         return pd.concat(stds, sort=False)
 
-    def update_predictions_and_statistics(self, predictions, temperatures):
-        last_prediction_datetime = self.find_last_prediction_datetime()
+    def open_predictions_writer(self, last_prediction_datetime):
+        self._ensure_schema()
+        return _PredictionsWriter(self._sink, last_prediction_datetime)
 
-        filtered_predictions = predictions.loc[predictions.index > last_prediction_datetime]
-        self._source.write_new_data(self._table_names['predictions'],
-                                    OutputDataHandler._format_predictions(filtered_predictions))
+    def replace_predictions(self, predictions, since_datetime, until_datetime):
+        self._ensure_schema()
+        filtered_predictions = predictions.loc[(predictions.index > since_datetime)
+                                               & (predictions.index <= until_datetime)]
+        if filtered_predictions.shape[0] == 0:
+            return
+        formatted_predictions = OutputDataHandler._format_predictions(filtered_predictions)
+        self._sink.replace('predictions', formatted_predictions, since_datetime, until_datetime)
+        return
 
-        last_new_prediction_datetime = filtered_predictions.index.max()
-        filtered_temperatures = temperatures.loc[(temperatures.index > last_prediction_datetime)
-                                                 & (temperatures.index <= last_new_prediction_datetime)]
-        formatted_temperatures = OutputDataHandler._format_temperatures(filtered_temperatures)
-        self._source.write_new_data(self._table_names['temperatures'], formatted_temperatures)
+    def replace_statistics(self, temperatures, since_datetime, until_datetime):
+        # all sensors of the statistics tables are recomputed for (since_datetime, until_datetime]
+        self._ensure_schema()
+        smoothing_since_datetime = since_datetime - constants.STATISTICS_SMOOTHING_PERIOD
+        filtered_temperatures = temperatures.loc[(temperatures.index > smoothing_since_datetime)
+                                                 & (temperatures.index <= until_datetime)]
+        statistics = {
+            'temperatures': OutputDataHandler._format_temperatures(filtered_temperatures),
+            'temperatures_diff': OutputDataHandler._build_temperatures_diff(filtered_temperatures),
+            'plates_temperatures_std': OutputDataHandler._build_temperatures_plates_std(filtered_temperatures),
+            'temperatures_std': OutputDataHandler.build_temperatures_std(temperatures, since_datetime, until_datetime)
+        }
+        for table_type, data in statistics.items():
+            if data.shape[0] > 0:
+                data = data.loc[(data.index > since_datetime) & (data.index <= until_datetime)]
+            self._sink.replace(table_type, data, since_datetime, until_datetime, columns=())
+        return
+
+    def find_input_fingerprints(self, table_name):
+        self._ensure_schema()
+        return self._sink.find_fingerprints(table_name)
+
+    def replace_input_fingerprints(self, table_name, fingerprints, until_datetime):
+        self._ensure_schema()
+        self._sink.replace_fingerprints(table_name, fingerprints, until_datetime)
 
-        self._source.write_new_data(self._table_names['temperatures_diff'],
-                                    OutputDataHandler._build_temperatures_diff(filtered_temperatures))
+    def find_input_scan_datetime(self, table_name):
+        self._ensure_schema()
+        return self._sink.find_watermark(output_schema.FINGERPRINTS_SCAN_PREFIX + table_name)
 
-        self._source.write_new_data(self._table_names['plates_temperatures_std'],
-                                    OutputDataHandler._build_temperatures_plates_std(filtered_temperatures))
+    def set_input_scan_datetime(self, table_name, scan_datetime):
+        self._ensure_schema()
+        self._sink.set_watermark(output_schema.FINGERPRINTS_SCAN_PREFIX + table_name, scan_datetime)
+
+    @staticmethod
+    def build_statistics(temperatures, last_prediction_datetime, last_new_prediction_datetime):
+        filtered_temperatures = temperatures.loc[(temperatures.index > last_prediction_datetime)
+                                                 & (temperatures.index <= last_new_prediction_datetime)]
+        return {
+            'temperatures': OutputDataHandler._format_temperatures(filtered_temperatures),
+            'temperatures_diff': OutputDataHandler._build_temperatures_diff(filtered_temperatures),
+            'plates_temperatures_std': OutputDataHandler._build_temperatures_plates_std(filtered_temperatures),
+            'temperatures_std': OutputDataHandler.build_temperatures_std(temperatures, last_prediction_datetime,
+                                                                         last_new_prediction_datetime)
+        }
 
+    @staticmethod
+    def build_temperatures_std(temperatures, last_prediction_datetime, last_new_prediction_datetime):
         min_temperatures_datetime_for_std = last_prediction_datetime
         if last_prediction_datetime != constants.MIN_DATETIME:
             min_temperatures_datetime_for_std = last_prediction_datetime - constants.TEMPERATURES_STD_PERIOD
         temperatures_filtered_for_std = temperatures.loc[(temperatures.index > min_temperatures_datetime_for_std)
                                                          & (temperatures.index <= last_new_prediction_datetime)]
         temperatures_std = OutputDataHandler._build_temperatures_std(temperatures_filtered_for_std)
-        filtered_temperatures_std = temperatures_std.loc[temperatures_std.index > last_prediction_datetime].dropna()
-        self._source.write_new_data(self._table_names['temperatures_std'], filtered_temperatures_std)
+        return temperatures_std.loc[temperatures_std.index > last_prediction_datetime].dropna()
+
+    def commit_run(self, statistics, last_new_prediction_datetime):
+        self._ensure_schema()
+        # statistics are staged until the predictions are written, a failed run leaves no rows to be appended
+        # again by the next one, rows past the last written prediction belong to the next run
+        statistics = {table_type: data.loc[data.index <= last_new_prediction_datetime] if data.shape[0] > 0 else data
+                      for table_type, data in statistics.items()}
+        for table_type, data in statistics.items():
+            if table_type != 'temperatures_std':
+                self._sink.write(table_type, data)
+        # the run watermark moves only together with its last write, after all predictions were written
+        self._sink.write('temperatures_std', statistics['temperatures_std'],
+                         watermark=(self._table_names['predictions'], last_new_prediction_datetime))
         return
+
+
+class _PredictionsWriter:
+    """Background writer of per-sensor predictions
+
+    Predictions are filtered by the run-level watermark taken before the first write,
+    so rows written by earlier sensors of the same run never hide later sensors.
+    """
+
+    def __init__(self, sink, last_prediction_datetime, queue_size=constants.OUTPUT_WRITE_QUEUE_SIZE):
+        self._sink = sink
+        self._last_prediction_datetime = last_prediction_datetime
+        self._last_written_datetime = None
+        self._error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            predictions = self._queue.get()
+            if predictions is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._write(predictions)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, predictions):
+        filtered_predictions = predictions.loc[predictions.index > self._last_prediction_datetime]
+        if filtered_predictions.shape[0] == 0:
+            return
+        self._sink.write('predictions', OutputDataHandler._format_predictions(filtered_predictions))
+        last_datetime = filtered_predictions.index.max()
+        if self._last_written_datetime is None or last_datetime > self._last_written_datetime:
+            self._last_written_datetime = last_datetime
+
+    def write(self, predictions):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(predictions)
+
+    def _stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def close(self):
+        self._stop()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # the exception failing the run is reported, not a write error it may have left behind
+            self._stop()
+        return False
+
+    def get_last_written_datetime(self):
+        return self._last_written_datetime
@@ -0,0 +1,78 @@
+import sqlalchemy
+
+import constants
+
+PLATE_COLUMN = 'Решетка'
+SENSOR_COLUMN = 'Датчик'
+PLATES_COLUMN = 'Решетки'
+HORIZON_COLUMN = 'Горизонт прогнозирования'
+STD_COLUMN = 'Стандартное отклонение'
+
+WATERMARK_TABLE_COLUMN = 'table_name'
+WATERMARK_DATETIME_COLUMN = 'last_datetime'
+WATERMARK_UPDATED_COLUMN = 'updated_at'
+
+FINGERPRINT_TABLE_COLUMN = 'table_name'
+FINGERPRINT_COLUMN = 'column_name'
+FINGERPRINTS_WATERMARK_PREFIX = 'fingerprints:'
+FINGERPRINTS_SCAN_PREFIX = 'fingerprints_scan:'
+# pseudo column of the fingerprints holding the rows number of a bucket in the count statistic
+ROW_COUNT_FINGERPRINT = '*'
+
+LABEL_LENGTH = 32
+
+TABLES_COLUMNS = {
+    'predictions': [(HORIZON_COLUMN, sqlalchemy.String(LABEL_LENGTH)),
+                    (PLATE_COLUMN, sqlalchemy.Integer),
+                    (SENSOR_COLUMN, sqlalchemy.Integer),
+                    ('Вероятность коксования', sqlalchemy.Float)],
+    'temperatures': [('Температура', sqlalchemy.Float),
+                     (PLATE_COLUMN, sqlalchemy.Integer),
+                     (SENSOR_COLUMN, sqlalchemy.Integer)],
+    'temperatures_diff': [(PLATES_COLUMN, sqlalchemy.String(LABEL_LENGTH)),
+                          ('Разность температур', sqlalchemy.Float)],
+    'temperatures_std': [(STD_COLUMN, sqlalchemy.Float),
+                         (PLATE_COLUMN, sqlalchemy.Integer),
+                         (SENSOR_COLUMN, sqlalchemy.Integer)],
+    'plates_temperatures_std': [(PLATE_COLUMN, sqlalchemy.Integer),
+                                (STD_COLUMN, sqlalchemy.Float)]
+}
+
+TABLES_KEYS = {
+    'predictions': [constants.OUTPUT_DATETIME_COLUMN, PLATE_COLUMN, SENSOR_COLUMN, HORIZON_COLUMN],
+    'temperatures': [constants.OUTPUT_DATETIME_COLUMN, PLATE_COLUMN, SENSOR_COLUMN],
+    'temperatures_diff': [constants.OUTPUT_DATETIME_COLUMN, PLATES_COLUMN],
+    'temperatures_std': [constants.OUTPUT_DATETIME_COLUMN, PLATE_COLUMN, SENSOR_COLUMN],
+    'plates_temperatures_std': [constants.OUTPUT_DATETIME_COLUMN, PLATE_COLUMN]
+}
+
+
+def build_index_name(table_name):
+    return 'ux_{}_key'.format(table_name)
+
+
+def build_table(metadata, table_type, table_name):
+    if table_type not in TABLES_COLUMNS:
+        raise ValueError('unknown output table type {}'.format(table_type))
+    columns = [sqlalchemy.Column(constants.OUTPUT_DATETIME_COLUMN, sqlalchemy.DateTime, nullable=False)]
+    columns += [sqlalchemy.Column(name, column_type) for name, column_type in TABLES_COLUMNS[table_type]]
+    table = sqlalchemy.Table(table_name, metadata, *columns)
+    # merges match rows on the key, mysql and sqlite upserts also need it to be unique
+    sqlalchemy.Index(build_index_name(table_name), *[table.c[col] for col in TABLES_KEYS[table_type]],
+                     unique=True, mssql_clustered=True)
+    return table
+
+
+def build_watermarks_table(metadata, table_name):
+    return sqlalchemy.Table(table_name, metadata,
+                            sqlalchemy.Column(WATERMARK_TABLE_COLUMN, sqlalchemy.String(128), primary_key=True),
+                            sqlalchemy.Column(WATERMARK_DATETIME_COLUMN, sqlalchemy.DateTime, nullable=False),
+                            sqlalchemy.Column(WATERMARK_UPDATED_COLUMN, sqlalchemy.DateTime, nullable=False))
+
+
+def build_fingerprints_table(metadata, table_name):
+    columns = [sqlalchemy.Column(FINGERPRINT_TABLE_COLUMN, sqlalchemy.String(128), primary_key=True),
+               sqlalchemy.Column(constants.OUTPUT_DATETIME_COLUMN, sqlalchemy.DateTime, primary_key=True),
+               sqlalchemy.Column(FINGERPRINT_COLUMN, sqlalchemy.String(128), primary_key=True)]
+    columns += [sqlalchemy.Column(statistic, sqlalchemy.Float) for statistic in constants.AGGREGATION_STATISTICS]
+    return sqlalchemy.Table(table_name, metadata, *columns)
@@ -0,0 +1,492 @@
+import datetime as dt
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+import sqlalchemy
+
+import constants
+from datasource import output_schema
+from datasource.source import SQLSource
+
+SQL_SINK = constants.SQL_SINK
+PARQUET_SINK = constants.PARQUET_SINK
+
+LONG_LAYOUT = 'long'
+WIDE_LAYOUT = 'wide'
+
+WIDE_COLUMN_SEPARATOR = ':'
+PARTITION_DATE_FORMAT = '%Y-%m-%d'
+
+
+class SQLSink:
+    """Output sink writing long format rows into the output database tables"""
+
+    def __init__(self, source_params, table_names):
+        self._source = SQLSource(source_params, constants.OUTPUT_DATETIME_COLUMN)
+        metadata = sqlalchemy.MetaData()
+        self._tables = {table_type: output_schema.build_table(metadata, table_type, table_name)
+                        for table_type, table_name in table_names.items()
+                        if table_type in output_schema.TABLES_COLUMNS}
+        self._watermarks_table = output_schema.build_watermarks_table(
+            metadata,
+            table_names.get('watermarks', constants.DEFAULT_WATERMARKS_TABLE)
+        )
+        self._fingerprints_table = output_schema.build_fingerprints_table(
+            metadata,
+            table_names.get('fingerprints', constants.DEFAULT_FINGERPRINTS_TABLE)
+        )
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def ensure_schema(self):
+        with self._schema_lock:
+            if not self._schema_ready:
+                self._source.ensure_tables(list(self._tables.values())
+                                           + [self._watermarks_table, self._fingerprints_table])
+                self._schema_ready = True
+
+    def find_watermark(self, key):
+        return self._source.find_watermark(self._watermarks_table, key)
+
+    def set_watermark(self, key, datetime):
+        self._source.set_watermark(self._watermarks_table, key, datetime)
+
+    def find_last_datetime(self, table_type):
+        return self._source.find_last_datetime(self._tables[table_type].name)
+
+    def write(self, table_type, data, watermark=None):
+        # watermark is (key, datetime) committed in the same transaction as data
+        if watermark is not None:
+            watermark = (self._watermarks_table,) + tuple(watermark)
+        self._source.merge_data(self._tables[table_type], data, output_schema.TABLES_KEYS[table_type],
+                                watermark=watermark)
+
+    def replace(self, table_type, data, since_datetime, until_datetime,
+                columns=(output_schema.PLATE_COLUMN, output_schema.SENSOR_COLUMN)):
+        # rows in (since_datetime, until_datetime] having any combination of columns values found in data are replaced
+        table = self._tables[table_type]
+        datetime_column = table.c[constants.OUTPUT_DATETIME_COLUMN]
+        conditions = [datetime_column > since_datetime, datetime_column <= until_datetime]
+        if columns:
+            values = data[list(columns)].drop_duplicates()
+            conditions.append(sqlalchemy.or_(*[sqlalchemy.and_(*[table.c[col] == SQLSink._to_python(value)
+                                                                 for col, value in zip(columns, row)])
+                                               for row in values.itertuples(index=False)]))
+        self._source.replace_data(table, data, sqlalchemy.and_(*conditions))
+
+    @staticmethod
+    def _to_python(value):
+        return value.item() if hasattr(value, 'item') else value
+
+    def find_fingerprints(self, key):
+        # fingerprints are returned together with the datetime they were taken until
+        until_datetime = self.find_watermark(output_schema.FINGERPRINTS_WATERMARK_PREFIX + key)
+        if until_datetime is None:
+            return None, None
+        table = self._fingerprints_table
+        fingerprints = self._source.get_rows(table, table.c[output_schema.FINGERPRINT_TABLE_COLUMN] == key)
+        return fingerprints.drop(columns=output_schema.FINGERPRINT_TABLE_COLUMN), until_datetime
+
+    def replace_fingerprints(self, key, fingerprints, until_datetime):
+        table = self._fingerprints_table
+        data = fingerprints.copy()
+        data.insert(0, output_schema.FINGERPRINT_TABLE_COLUMN, key)
+        self._source.replace_data(table, data, table.c[output_schema.FINGERPRINT_TABLE_COLUMN] == key,
+                                  watermark=(self._watermarks_table,
+                                             output_schema.FINGERPRINTS_WATERMARK_PREFIX + key, until_datetime))
+
+
+class ParquetSink:
+    """Output sink writing compressed parquet files partitioned by reactor, table and day
+
+    Files of a run are staged and moved into their partitions when the run watermark is written,
+    so readers never see rows of an unfinished run. Replacing rows rewrites the affected days.
+    """
+
+    PENDING_DIR = '_pending'
+    FINGERPRINTS_DIR = '_fingerprints'
+    LOCKS_DIR = '_locks'
+    COMMITTED_NAME = 'COMMITTED'
+    WATERMARKS_NAME = '_watermarks.json'
+    PART_ENDING = '.parquet'
+    LOCK_ENDING = '.lock'
+
+    def __init__(self, source_params, table_names, reactor_name):
+        self._table_names = {table_type: table_name for table_type, table_name in table_names.items()
+                             if table_type in output_schema.TABLES_COLUMNS}
+        self._path = os.path.join(source_params['parquet_path'], 'reactor={}'.format(reactor_name))
+        self._layout = source_params.get('parquet_layout') or LONG_LAYOUT
+        if self._layout not in (LONG_LAYOUT, WIDE_LAYOUT):
+            raise ValueError('parquet layout must be \"{}\" or \"{}\"'.format(LONG_LAYOUT, WIDE_LAYOUT))
+        self._compression = source_params.get('parquet_compression') or 'snappy'
+        self._pending_path = os.path.join(self._path, ParquetSink.PENDING_DIR, uuid.uuid4().hex)
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    def ensure_schema(self):
+        with self._lock:
+            if not self._schema_ready:
+                os.makedirs(self._path, exist_ok=True)
+                self._recover_pending()
+                self._schema_ready = True
+
+    @staticmethod
+    def _get_value_column(table_type):
+        keys = output_schema.TABLES_KEYS[table_type]
+        return [name for name, _ in output_schema.TABLES_COLUMNS[table_type] if name not in keys][0]
+
+    @staticmethod
+    def _get_label_columns(table_type):
+        return [col for col in output_schema.TABLES_KEYS[table_type] if col != constants.OUTPUT_DATETIME_COLUMN]
+
+    def _get_table_path(self, table_type):
+        return os.path.join(self._path, 'table={}'.format(self._table_names[table_type]))
+
+    def _get_partition_path(self, table_type, day):
+        return os.path.join(self._get_table_path(table_type), 'date={}'.format(day.strftime(PARTITION_DATE_FORMAT)))
+
+    @staticmethod
+    def _to_frame(data):
+        frame = data.reset_index()
+        return frame.rename(columns={frame.columns[0]: constants.OUTPUT_DATETIME_COLUMN})
+
+    def _to_layout(self, table_type, frame):
+        if self._layout == LONG_LAYOUT:
+            return frame
+        labels = ParquetSink._get_label_columns(table_type)
+        wide = frame.pivot_table(index=constants.OUTPUT_DATETIME_COLUMN, columns=labels,
+                                 values=ParquetSink._get_value_column(table_type), aggfunc='last')
+        if len(labels) > 1:
+            wide.columns = [WIDE_COLUMN_SEPARATOR.join(str(value) for value in col) for col in wide.columns]
+        else:
+            wide.columns = [str(col) for col in wide.columns]
+        return wide.reset_index()
+
+    def _from_layout(self, table_type, frame):
+        if self._layout == LONG_LAYOUT:
+            return frame
+        labels = ParquetSink._get_label_columns(table_type)
+        value_column = ParquetSink._get_value_column(table_type)
+        long = frame.melt(id_vars=[constants.OUTPUT_DATETIME_COLUMN], var_name='_label', value_name=value_column)
+        long = long.dropna(subset=[value_column])
+        split_labels = long['_label'].str.split(WIDE_COLUMN_SEPARATOR, n=len(labels) - 1, expand=True)
+        column_types = dict(output_schema.TABLES_COLUMNS[table_type])
+        for i, col in enumerate(labels):
+            is_integer = isinstance(sqlalchemy.types.to_instance(column_types[col]), sqlalchemy.Integer)
+            long[col] = split_labels[i].astype('int64') if is_integer else split_labels[i]
+        return long.drop(columns='_label')
+
+    def _write_file(self, frame, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), tmp_path, compression=self._compression)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _build_part_name():
+        return 'part-{}-{}{}'.format(dt.datetime.now().strftime('%Y%m%d%H%M%S%f'), uuid.uuid4().hex,
+                                     ParquetSink.PART_ENDING)
+
+    @staticmethod
+    def _list_parts(path):
+        if not os.path.isdir(path):
+            return []
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(ParquetSink.PART_ENDING))
+
+    def _write_days(self, table_type, frame, get_directory):
+        if frame.shape[0] == 0:
+            return
+        days = frame[constants.OUTPUT_DATETIME_COLUMN].dt.floor('D')
+        for day, day_frame in frame.groupby(days, sort=True):
+            self._write_file(self._to_layout(table_type, day_frame),
+                             os.path.join(get_directory(day), ParquetSink._build_part_name()))
+
+    def write(self, table_type, data, watermark=None):
+        # watermark is (key, datetime), it commits every file staged by this sink since the previous commit
+        self.ensure_schema()
+        relative_table_path = os.path.relpath(self._get_table_path(table_type), self._path)
+        self._write_days(table_type, ParquetSink._to_frame(data),
+                         lambda day: os.path.join(self._pending_path, relative_table_path,
+                                                  'date={}'.format(day.strftime(PARTITION_DATE_FORMAT))))
+        if watermark is not None:
+            self._commit(watermark)
+
+    @contextmanager
+    def _lock_pending(self):
+        # commits and the recovery of other runs pending files never interleave
+        with ParquetSink._lock_file(os.path.join(self._path, ParquetSink.LOCKS_DIR,
+                                                 ParquetSink.PENDING_DIR + ParquetSink.LOCK_ENDING)):
+            yield
+
+    def _commit(self, watermark):
+        with self._lock, self._lock_pending():
+            if os.path.isdir(self._pending_path):
+                # the marker makes an interrupted commit finish on the next start instead of being dropped
+                ParquetSink._write_json(os.path.join(self._pending_path, ParquetSink.COMMITTED_NAME),
+                                        None if watermark is None else [watermark[0], str(watermark[1])])
+                self._finish_pending(self._pending_path)
+            elif watermark is not None:
+                self._write_watermark(watermark[0], watermark[1], advance=True)
+
+    def _finish_pending(self, pending_path):
+        with open(os.path.join(pending_path, ParquetSink.COMMITTED_NAME), 'r', encoding='utf-8') as f:
+            watermark = json.load(f)
+        for directory, _, names in os.walk(pending_path):
+            for name in names:
+                if name.endswith(ParquetSink.PART_ENDING):
+                    target_path = os.path.join(self._path, os.path.relpath(directory, pending_path), name)
+                    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                    os.replace(os.path.join(directory, name), target_path)
+        if watermark is not None:
+            self._write_watermark(watermark[0], pd.Timestamp(watermark[1]).to_pydatetime(), advance=True)
+        ParquetSink._remove_tree(pending_path)
+
+    @staticmethod
+    def _remove_tree(path):
+        for directory, _, names in os.walk(path, topdown=False):
+            for name in names:
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    @staticmethod
+    def _get_modified_at(path):
+        # files of a run are staged in nested partition directories, which do not touch the run directory
+        return max([os.path.getmtime(path)] + [os.path.getmtime(os.path.join(directory, name))
+                                               for directory, _, names in os.walk(path) for name in names])
+
+    def _recover_pending(self, timeout=constants.PARQUET_PENDING_TIMEOUT):
+        pending_root = os.path.dirname(self._pending_path)
+        if not os.path.isdir(pending_root):
+            return
+        with self._lock_pending():
+            for name in os.listdir(pending_root):
+                pending_path = os.path.join(pending_root, name)
+                if os.path.exists(os.path.join(pending_path, ParquetSink.COMMITTED_NAME)):
+                    self._finish_pending(pending_path)
+                elif time.time() - ParquetSink._get_modified_at(pending_path) > timeout.total_seconds():
+                    # runs which never reached their commit are dropped once they cannot be running anymore
+                    ParquetSink._remove_tree(pending_path)
+
+    def _read_watermarks(self):
+        path = os.path.join(self._path, ParquetSink.WATERMARKS_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_watermark(self, key, datetime, advance=False):
+        # other runs and shard workers update other keys of the same file, so it is rewritten under a file lock
+        with ParquetSink._lock_file(os.path.join(self._path, ParquetSink.LOCKS_DIR,
+                                                 ParquetSink.WATERMARKS_NAME + ParquetSink.LOCK_ENDING)):
+            watermarks = self._read_watermarks()
+            stored = watermarks.get(key)
+            # concurrent runs may commit out of order, committed watermarks only move forward
+            if advance and stored is not None \
+                    and pd.Timestamp(stored[output_schema.WATERMARK_DATETIME_COLUMN]) >= pd.Timestamp(datetime):
+                return
+            watermarks[key] = {output_schema.WATERMARK_DATETIME_COLUMN: str(datetime),
+                               output_schema.WATERMARK_UPDATED_COLUMN: str(dt.datetime.now())}
+            ParquetSink._write_json(os.path.join(self._path, ParquetSink.WATERMARKS_NAME), watermarks)
+
+    @staticmethod
+    def _write_json(path, value):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def find_watermark(self, key):
+        self.ensure_schema()
+        watermark = self._read_watermarks().get(key)
+        if watermark is None:
+            return None
+        return pd.Timestamp(watermark[output_schema.WATERMARK_DATETIME_COLUMN]).to_pydatetime()
+
+    def set_watermark(self, key, datetime):
+        self.ensure_schema()
+        with self._lock:
+            self._write_watermark(key, datetime)
+
+    def _get_fingerprints_path(self, key):
+        return os.path.join(self._path, ParquetSink.FINGERPRINTS_DIR, '{}{}'.format(key, ParquetSink.PART_ENDING))
+
+    def find_fingerprints(self, key):
+        import pyarrow.parquet as pq
+        until_datetime = self.find_watermark(output_schema.FINGERPRINTS_WATERMARK_PREFIX + key)
+        path = self._get_fingerprints_path(key)
+        if until_datetime is None or not os.path.exists(path):
+            return None, None
+        return pq.read_table(path).to_pandas().set_index(constants.OUTPUT_DATETIME_COLUMN), until_datetime
+
+    def replace_fingerprints(self, key, fingerprints, until_datetime):
+        self.ensure_schema()
+        with self._lock:
+            self._write_file(ParquetSink._to_frame(fingerprints), self._get_fingerprints_path(key))
+            self._write_watermark(output_schema.FINGERPRINTS_WATERMARK_PREFIX + key, until_datetime)
+
+    def _read_parts(self, table_type, paths, columns=None):
+        import pyarrow.parquet as pq
+        frames = [pq.read_table(path, columns=columns).to_pandas() for path in paths]
+        if not frames:
+            return None
+        frame = pd.concat(frames, sort=False)
+        return frame if columns is not None else self._from_layout(table_type, frame)
+
+    def _list_days(self, table_type):
+        table_path = self._get_table_path(table_type)
+        if not os.path.isdir(table_path):
+            return []
+        return sorted(dt.datetime.strptime(name.split('=', 1)[1], PARTITION_DATE_FORMAT)
+                      for name in os.listdir(table_path)
+                      if name.startswith('date=') and os.path.isdir(os.path.join(table_path, name)))
+
+    def find_last_datetime(self, table_type):
+        self.ensure_schema()
+        for day in reversed(self._list_days(table_type)):
+            frame = self._read_parts(table_type, ParquetSink._list_parts(self._get_partition_path(table_type, day)),
+                                     columns=[constants.OUTPUT_DATETIME_COLUMN])
+            if frame is not None and frame.shape[0] > 0:
+                return frame[constants.OUTPUT_DATETIME_COLUMN].max().to_pydatetime()
+        return constants.MIN_DATETIME
+
+    def read(self, table_type, since_datetime=None, until_datetime=None):
+        """Reads long format rows in (since_datetime, until_datetime] scanning only the matching days"""
+        self.ensure_schema()
+        paths = []
+        for day in self._list_days(table_type):
+            if since_datetime is not None and day + dt.timedelta(days=1) <= since_datetime:
+                continue
+            if until_datetime is not None and day > until_datetime:
+                continue
+            paths += ParquetSink._list_parts(self._get_partition_path(table_type, day))
+        frame = self._read_parts(table_type, paths)
+        if frame is None:
+            return pd.DataFrame()
+        datetimes = frame[constants.OUTPUT_DATETIME_COLUMN]
+        mask = pd.Series(True, index=frame.index)
+        if since_datetime is not None:
+            mask &= datetimes > since_datetime
+        if until_datetime is not None:
+            mask &= datetimes <= until_datetime
+        return frame.loc[mask.values].set_index(constants.OUTPUT_DATETIME_COLUMN).sort_index()
+
+    def _get_lock_path(self, table_type, day):
+        # locks live outside the table directories, partition listings only ever see partitions
+        partition_path = self._get_partition_path(table_type, day)
+        return os.path.join(self._path, ParquetSink.LOCKS_DIR, os.path.relpath(partition_path, self._path)) \
+            + ParquetSink.LOCK_ENDING
+
+    @contextmanager
+    def _lock_partition(self, table_type, day, timeout=constants.WORK_QUEUE_LOCK_TIMEOUT):
+        with ParquetSink._lock_file(self._get_lock_path(table_type, day), timeout):
+            yield
+
+    @staticmethod
+    @contextmanager
+    def _lock_file(lock_path, timeout=constants.WORK_QUEUE_LOCK_TIMEOUT):
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > timeout:
+                        os.remove(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+
+    def replace(self, table_type, data, since_datetime, until_datetime,
+                columns=(output_schema.PLATE_COLUMN, output_schema.SENSOR_COLUMN)):
+        self.ensure_schema()
+        frame = ParquetSink._to_frame(data)
+        values = set(frame[list(columns)].itertuples(index=False, name=None)) if columns else None
+        day = pd.Timestamp(since_datetime).floor('D').to_pydatetime()
+        while day <= until_datetime:
+            partition_path = self._get_partition_path(table_type, day)
+            with self._lock_partition(table_type, day):
+                old_paths = ParquetSink._list_parts(partition_path)
+                old_frame = self._read_parts(table_type, old_paths)
+                new_frame = frame.loc[frame[constants.OUTPUT_DATETIME_COLUMN].dt.floor('D') == day] \
+                    if frame.shape[0] > 0 else frame
+                if old_frame is not None:
+                    datetimes = old_frame[constants.OUTPUT_DATETIME_COLUMN]
+                    replaced = (datetimes > since_datetime) & (datetimes <= until_datetime)
+                    if values is not None:
+                        replaced &= pd.Series([row in values for row in
+                                               old_frame[list(columns)].itertuples(index=False, name=None)],
+                                              index=old_frame.index)
+                    new_frame = pd.concat([old_frame.loc[~replaced.values], new_frame], sort=False)
+                if new_frame.shape[0] > 0:
+                    # the day is compacted into one file which lands before the old ones are removed
+                    self._write_file(self._to_layout(table_type, new_frame),
+                                     os.path.join(partition_path, ParquetSink._build_part_name()))
+                for path in old_paths:
+                    os.remove(path)
+            day += dt.timedelta(days=1)
+
+
+class MultiSink:
+    """Writes to several sinks, watermarks are read from the first one"""
+
+    def __init__(self, sinks):
+        self._sinks = sinks
+
+    def ensure_schema(self):
+        for sink in self._sinks:
+            sink.ensure_schema()
+
+    def find_watermark(self, key):
+        return self._sinks[0].find_watermark(key)
+
+    def set_watermark(self, key, datetime):
+        for sink in self._sinks:
+            sink.set_watermark(key, datetime)
+
+    def find_last_datetime(self, table_type):
+        return self._sinks[0].find_last_datetime(table_type)
+
+    def write(self, table_type, data, watermark=None):
+        # the first sink commits last so its watermark never gets ahead of the others
+        for sink in self._sinks[1:] + self._sinks[:1]:
+            sink.write(table_type, data, watermark)
+
+    def replace(self, table_type, data, since_datetime, until_datetime,
+                columns=(output_schema.PLATE_COLUMN, output_schema.SENSOR_COLUMN)):
+        for sink in self._sinks:
+            sink.replace(table_type, data, since_datetime, until_datetime, columns)
+
+    def find_fingerprints(self, key):
+        return self._sinks[0].find_fingerprints(key)
+
+    def replace_fingerprints(self, key, fingerprints, until_datetime):
+        for sink in self._sinks[1:] + self._sinks[:1]:
+            sink.replace_fingerprints(key, fingerprints, until_datetime)
+
+
+def build_sink(settings):
+    source_params = settings.get_output()
+    sinks = []
+    for sink_type in (source_params.get('sink') or SQL_SINK).split(','):
+        sink_type = sink_type.strip()
+        if sink_type == SQL_SINK:
+            sinks.append(SQLSink(source_params, settings.get_output_tables()))
+        elif sink_type == PARQUET_SINK:
+            sinks.append(ParquetSink(source_params, settings.get_output_tables(), settings.get_reactor_name()))
+        else:
+            raise ValueError('output sink {} is not provided\nUse one of the following sinks: {}'.format(
+                sink_type, str([SQL_SINK, PARQUET_SINK])))
+    return sinks[0] if len(sinks) == 1 else MultiSink(sinks)
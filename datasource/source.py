@@ -1,38 +1,76 @@
-import pandas as pd
-import pymysql
+import datetime as dt
+import warnings
+
 import sqlalchemy
 from sqlalchemy.pool import NullPool
 
 import constants
-
-pymysql.install_as_MySQLdb()
+import exceptions
+from datasource import output_schema
 
 
 class SQLSource:
+    # pandas is imported by the reads returning frames, so checks made before a run never load it
     TABLE_TO_WRITE_MAX_LENGTH = 1000
 
     DBAPI_DICT = {
         'mysql': 'mysqldb',
-        'mssql': 'pymssql'
+        'mssql': 'pymssql',
+        'sqlite': None
     }
 
     DATETIME_CONVERTERS = {
         'mysql': lambda str_dt: 'CONVERT(\'{}\', datetime)'.format(str_dt),
-        'mssql': lambda str_dt: 'CONVERT(datetime, \'{}\', 120)'.format(str_dt)
+        'mssql': lambda str_dt: 'CONVERT(datetime, \'{}\', 120)'.format(str_dt),
+        # sqlite keeps datetimes as text in the format written by sqlalchemy and pandas
+        'sqlite': lambda str_dt: '\'{}\''.format(dt.datetime.fromisoformat(str_dt).strftime('%Y-%m-%d %H:%M:%S.%f'))
     }
 
+    # buckets are (end - minutes, end] labelled by their end, like the right closed windows of raw rows,
+    # so a bucket never holds rows later than its label
+    BUCKET_EXPRESSIONS = {
+        'mysql': lambda col, minutes: 'TIMESTAMPADD(SECOND, (TIMESTAMPDIFF(SECOND, \'1900-01-01\', {0}) + {1} - 1)'
+                                      ' DIV {1} * {1}, \'1900-01-01\')'.format(col, int(minutes) * 60),
+        'mssql': lambda col, minutes: 'CASE WHEN {1} = {0} THEN {1} ELSE DATEADD(minute, {2}, {1}) END'.format(
+            col, 'DATEADD(minute, DATEDIFF(minute, 0, {0}) / {1} * {1}, 0)'.format(col, minutes), minutes),
+        'sqlite': lambda col, minutes: 'DATETIME((CAST(ROUND((JULIANDAY({0}) - 2440587.5) * 86400000) AS INTEGER)'
+                                       ' + {1} - 1) / {1} * {1} / 1000, \'unixepoch\')'.format(col,
+                                                                                             int(minutes) * 60000)
+    }
+
+    ALTER_COLUMN_QUERIES = {
+        'mysql': 'ALTER TABLE {} MODIFY {} {};',
+        'mssql': 'ALTER TABLE {} ALTER COLUMN {} {};'
+    }
+
+    # a plain DROP TABLE commits the open transaction on mysql, so the staging table is dropped by its own kind
+    DROP_STAGING_TABLE_QUERIES = {
+        'mysql': 'DROP TEMPORARY TABLE {};',
+        'mssql': 'DROP TABLE {};',
+        'sqlite': 'DROP TABLE {};'
+    }
+
+    STAGING_TABLE_PREFIX = 'stage_'
+    # keys of a delete are OR-ed conditions, sqlite limits the depth of an expression
+    DELETED_KEYS_MAX_LENGTH = 100
+
     def __init__(self, params, datetime_col):
         self._db_type = params['db_type']
         if self._db_type not in SQLSource.DBAPI_DICT:
             raise ValueError('database type {} is not provided\nUse one of the following types: {}'.format(
                 self._db_type, str(list(SQLSource.DBAPI_DICT.keys()))))
 
+        if self._db_type == 'mysql':
+            import pymysql
+            pymysql.install_as_MySQLdb()
+
         self._db_name = params['database']
         self._datetime_col = datetime_col
 
         engine_config = SQLSource._build_engine_config(params['db_type'], params['username'], params['password'],
                                                        params['hostname'], params['port'], params['database'])
         self._engine = sqlalchemy.create_engine(engine_config, poolclass=NullPool)
+        self._unique_keys = {}
 
     @staticmethod
     def _build_engine_config(db_type, username, password, hostname, port, db_name):
@@ -42,36 +80,354 @@ class SQLSource:
         address = ':'.join([hostname, port]) if port else hostname
         return '{}://{}/{}'.format(prefix, '@'.join([auth, address]) if auth else address, db_name)
 
-    def get_data_since(self, table, datetime=None, allow_equality=True):
-        query = 'SELECT * FROM {}'.format(table)
+    def get_engine(self):
+        return self._engine
+
+    def _build_since_condition(self, datetime, allow_equality, until_datetime=None):
+        conditions = []
         if datetime is not None:
             inequality = '>=' if allow_equality else '>'
-            query += ' WHERE {} {} {}'.format(self._datetime_col, inequality,
-                                              SQLSource.DATETIME_CONVERTERS[self._db_type](str(datetime)))
+            conditions.append('{} {} {}'.format(self._datetime_col, inequality,
+                                                SQLSource.DATETIME_CONVERTERS[self._db_type](str(datetime))))
+        if until_datetime is not None:
+            conditions.append('{} <= {}'.format(self._datetime_col,
+                                                SQLSource.DATETIME_CONVERTERS[self._db_type](str(until_datetime))))
+        if not conditions:
+            return ''
+        return ' WHERE ' + ' AND '.join(conditions)
+
+    def get_data_since(self, table, datetime=None, allow_equality=True, until_datetime=None):
+        import pandas as pd
+
+        query = 'SELECT * FROM {}'.format(table)
+        if datetime is not None or until_datetime is not None:
+            query += self._build_since_condition(datetime, allow_equality, until_datetime)
             query += ';'
         connection = self._engine.connect()
-        result = pd.read_sql(query, connection, index_col=self._datetime_col)
+        result = pd.read_sql(query, connection, index_col=self._datetime_col, parse_dates=[self._datetime_col])
         connection.close()
         return result
 
+    def get_aggregated_data_since(self, table, bucket_minutes, datetime=None, allow_equality=True,
+                                  until_datetime=None):
+        import pandas as pd
+
+        import aggregation
+
+        columns = [column['name'] for column in sqlalchemy.inspect(self._engine).get_columns(table)
+                   if column['name'] != self._datetime_col]
+        bucket = SQLSource.BUCKET_EXPRESSIONS[self._db_type](self._datetime_col, int(bucket_minutes))
+        aggregates = []
+        for col in columns:
+            aggregates += ['SUM({})'.format(col), 'COUNT({})'.format(col), 'SUM({0} * {0})'.format(col)]
+        query = 'SELECT {} AS {}, {} FROM {}'.format(bucket, self._datetime_col, ', '.join(aggregates), table)
+        query += self._build_since_condition(datetime, allow_equality, until_datetime)
+        query += ' GROUP BY {};'.format(bucket)
+        connection = self._engine.connect()
+        result = pd.read_sql(query, connection, index_col=self._datetime_col, parse_dates=[self._datetime_col])
+        connection.close()
+        result.columns = pd.MultiIndex.from_product([columns, aggregation.STATISTICS])
+        return result.sort_index()
+
+    def _build_bucket_counts_query(self, table, bucket_minutes, datetime, allow_equality, until_datetime):
+        # only the datetime column is read, tables indexed by time answer from the index
+        bucket = SQLSource.BUCKET_EXPRESSIONS[self._db_type](self._datetime_col, int(bucket_minutes))
+        query = 'SELECT {} AS {}, COUNT(*) AS {} FROM {}'.format(bucket, self._datetime_col,
+                                                                  constants.AGGREGATION_COUNT, table)
+        query += self._build_since_condition(datetime, allow_equality, until_datetime)
+        return query + ' GROUP BY {};'.format(bucket)
+
+    def get_bucket_counts(self, table, bucket_minutes, datetime=None, allow_equality=True, until_datetime=None):
+        import pandas as pd
+
+        query = self._build_bucket_counts_query(table, bucket_minutes, datetime, allow_equality, until_datetime)
+        connection = self._engine.connect()
+        result = pd.read_sql(query, connection, index_col=self._datetime_col, parse_dates=[self._datetime_col])
+        connection.close()
+        return result.sort_index()
+
+    def find_bucket_counts(self, table, bucket_minutes, datetime=None, allow_equality=True, until_datetime=None):
+        # the same counts as get_bucket_counts in a {bucket: rows number} dict, read without pandas
+        query = self._build_bucket_counts_query(table, bucket_minutes, datetime, allow_equality, until_datetime)
+        connection = self._engine.connect()
+        try:
+            rows = connection.execute(sqlalchemy.text(query)).fetchall()
+        finally:
+            connection.close()
+        return {SQLSource._to_datetime(bucket): count for bucket, count in rows}
+
+    def get_rows(self, table, condition):
+        import pandas as pd
+
+        connection = self._engine.connect()
+        result = pd.read_sql(table.select().where(condition), connection, index_col=self._datetime_col,
+                             parse_dates=[self._datetime_col])
+        connection.close()
+        return result
+
+    def find_first_datetime(self, table):
+        query = 'SELECT MIN({}) from {};'.format(self._datetime_col, table)
+        connection = self._engine.connect()
+        result = connection.execute(sqlalchemy.text(query)).fetchone()[0]
+        connection.close()
+        if result is None:
+            return None
+        return SQLSource._to_datetime(result)
+
     def find_last_datetime(self, table):
         query = 'SELECT MAX({}) from {};'.format(self._datetime_col, table)
-        result = self._engine.execute(query).fetchone()[0]
+        connection = self._engine.connect()
+        result = connection.execute(sqlalchemy.text(query)).fetchone()[0]
+        connection.close()
         if result is None:
             return constants.MIN_DATETIME
-        return result
+        return SQLSource._to_datetime(result)
 
-    def write_new_data(self, table, data):
-        if data.shape[0] == 0:
+    @staticmethod
+    def _to_datetime(value):
+        # sqlite returns datetimes computed or read by plain text queries as strings
+        if isinstance(value, str):
+            return dt.datetime.fromisoformat(value)
+        return value
+
+    def ensure_tables(self, tables):
+        for table in tables:
+            try:
+                table.create(self._engine, checkfirst=True)
+            except sqlalchemy.exc.DBAPIError:
+                # another writer may have created the table between the check and the create
+                if not sqlalchemy.inspect(self._engine).has_table(table.name):
+                    raise
+        inspector = sqlalchemy.inspect(self._engine)
+        for table in tables:
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                try:
+                    if index.unique:
+                        self._remove_duplicate_keys(table, [column.name for column in index.columns])
+                    self._fit_index_columns(inspector, table, index)
+                    index.create(self._engine)
+                except sqlalchemy.exc.DBAPIError as e:
+                    # another writer may have built the index between the inspection and the create
+                    if index.name in {index['name'] for index in sqlalchemy.inspect(self._engine)
+                                      .get_indexes(table.name)}:
+                        continue
+                    warnings.warn('index {} on {} was not created, rows are merged by delete and insert which is '
+                                  'not safe for concurrent writers: {}'.format(index.name, table.name, str(e)),
+                                  exceptions.MissingComponentsWarning)
+        self._unique_keys.clear()
+
+    def _remove_duplicate_keys(self, table, key_columns):
+        # tables appended to before rows were merged may hold a key several times, the last row in table order
+        # is kept like the last row of a key in a merge, it is done once as the unique index is built right after
+        keys = [table.c[col] for col in key_columns]
+        duplicated = sqlalchemy.select(*keys).group_by(*keys).having(sqlalchemy.func.count() > 1).subquery()
+        matched = sqlalchemy.exists().where(sqlalchemy.and_(*[table.c[col] == duplicated.c[col]
+                                                              for col in key_columns]))
+        with self._engine.begin() as connection:
+            rows = connection.execute(table.select().where(matched)).mappings().all()
+            if not rows:
+                return
+            last_rows = list({tuple(row[col] for col in key_columns): dict(row) for row in rows}.values())
+            for i in range(0, len(last_rows), SQLSource.DELETED_KEYS_MAX_LENGTH):
+                connection.execute(table.delete().where(sqlalchemy.or_(*[
+                    sqlalchemy.and_(*[table.c[col] == row[col] for col in key_columns])
+                    for row in last_rows[i: i + SQLSource.DELETED_KEYS_MAX_LENGTH]
+                ])))
+            for i in range(0, len(last_rows), SQLSource.TABLE_TO_WRITE_MAX_LENGTH):
+                connection.execute(table.insert(), last_rows[i: i + SQLSource.TABLE_TO_WRITE_MAX_LENGTH])
+        warnings.warn('{} keys of {} were held by several rows, only the last row of each is kept'
+                      .format(len(last_rows), table.name), exceptions.MissingComponentsWarning)
+
+    @staticmethod
+    def build_alter_column_query(dialect, table_name, column):
+        quote = dialect.identifier_preparer.quote
+        return SQLSource.ALTER_COLUMN_QUERIES[dialect.name].format(quote(table_name), quote(column.name),
+                                                                   column.type.compile(dialect=dialect))
+
+    @staticmethod
+    def build_drop_staging_table_query(dialect, staging_table_name):
+        return SQLSource.DROP_STAGING_TABLE_QUERIES[dialect.name].format(
+            dialect.identifier_preparer.quote(staging_table_name))
+
+    def _fit_index_columns(self, inspector, table, index):
+        # pandas created text columns as TEXT on mysql and VARCHAR(max) on mssql, neither can be an index key,
+        # so columns of tables written before the schema was managed get their declared length first
+        if self._db_type not in SQLSource.ALTER_COLUMN_QUERIES:
             return
+        existing_types = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        for column in index.columns:
+            existing_type = existing_types.get(column.name)
+            if not isinstance(column.type, sqlalchemy.String) or column.type.length is None:
+                continue
+            if not isinstance(existing_type, sqlalchemy.String) or existing_type.length is not None:
+                continue
+            with self._engine.begin() as connection:
+                connection.execute(sqlalchemy.text(SQLSource.build_alter_column_query(self._engine.dialect,
+                                                                                      table.name, column)))
+
+    def find_watermark(self, watermarks_table, key):
+        query = watermarks_table.select().where(watermarks_table.c[output_schema.WATERMARK_TABLE_COLUMN] == key)
         connection = self._engine.connect()
-        if data.shape[0] > SQLSource.TABLE_TO_WRITE_MAX_LENGTH:
-            chunks_number = data.shape[0] // SQLSource.TABLE_TO_WRITE_MAX_LENGTH + 1
-            for i in range(chunks_number):
-                chunk =  data[i * SQLSource.TABLE_TO_WRITE_MAX_LENGTH: (i + 1) * SQLSource.TABLE_TO_WRITE_MAX_LENGTH]
-                if chunk.shape[0] > 0:
-                    chunk.to_sql(table, connection, if_exists='append')
-        else:
-            data.to_sql(table, connection, if_exists='append')
-        connection.close()
+        try:
+            row = connection.execute(query).fetchone()
+        except sqlalchemy.exc.DBAPIError:
+            # the watermarks table is created with the rest of the schema on the first write
+            if sqlalchemy.inspect(self._engine).has_table(watermarks_table.name):
+                raise
+            return None
+        finally:
+            connection.close()
+        if row is None:
+            return None
+        return row[1]
+
+    @staticmethod
+    def _update_watermark(connection, watermarks_table, key, datetime):
+        values = {output_schema.WATERMARK_DATETIME_COLUMN: datetime,
+                  output_schema.WATERMARK_UPDATED_COLUMN: dt.datetime.now()}
+        updated = connection.execute(watermarks_table.update()
+                                     .where(watermarks_table.c[output_schema.WATERMARK_TABLE_COLUMN] == key)
+                                     .values(values))
+        if updated.rowcount == 0:
+            values[output_schema.WATERMARK_TABLE_COLUMN] = key
+            connection.execute(watermarks_table.insert().values(values))
+
+    @staticmethod
+    def _advance_watermark(connection, watermarks_table, key, datetime):
+        # concurrent runs may commit out of order, the watermark only moves forward
+        key_column = watermarks_table.c[output_schema.WATERMARK_TABLE_COLUMN]
+        datetime_column = watermarks_table.c[output_schema.WATERMARK_DATETIME_COLUMN]
+        updated = connection.execute(watermarks_table.update()
+                                     .where(sqlalchemy.and_(key_column == key, datetime_column < datetime))
+                                     .values({output_schema.WATERMARK_DATETIME_COLUMN: datetime,
+                                              output_schema.WATERMARK_UPDATED_COLUMN: dt.datetime.now()}))
+        if updated.rowcount > 0:
+            return
+        if connection.execute(watermarks_table.select().where(key_column == key)).fetchone() is None:
+            connection.execute(watermarks_table.insert().values({output_schema.WATERMARK_TABLE_COLUMN: key,
+                                                                 output_schema.WATERMARK_DATETIME_COLUMN: datetime,
+                                                                 output_schema.WATERMARK_UPDATED_COLUMN:
+                                                                     dt.datetime.now()}))
+
+    def set_watermark(self, watermarks_table, key, datetime):
+        with self._engine.begin() as connection:
+            SQLSource._update_watermark(connection, watermarks_table, key, datetime)
+
+    def _build_records(self, data):
+        frame = data.reset_index()
+        frame = frame.rename(columns={frame.columns[0]: self._datetime_col})
+        return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+    def _insert_rows(self, connection, table, data, key_columns=None):
+        # rows go through executemany of a core insert, the table has to exist already
+        records = self._build_records(data)
+        if key_columns is not None:
+            # one merge must not match a target row twice, the last row of a key wins
+            records = list({tuple(record[col] for col in key_columns): record for record in records}.values())
+        for i in range(0, len(records), SQLSource.TABLE_TO_WRITE_MAX_LENGTH):
+            connection.execute(table.insert(), records[i: i + SQLSource.TABLE_TO_WRITE_MAX_LENGTH])
+
+    def _build_staging_table(self, table):
+        columns = [sqlalchemy.Column(column.name, column.type) for column in table.columns]
+        name = SQLSource.STAGING_TABLE_PREFIX + table.name
+        if self._db_type == 'mssql':
+            # tables starting with # live in tempdb and are visible to the current session only
+            return sqlalchemy.Table('#' + name, sqlalchemy.MetaData(), *columns)
+        return sqlalchemy.Table(name, sqlalchemy.MetaData(), *columns, prefixes=['TEMPORARY'])
+
+    def _build_merge_query(self, table, staging_table, key_columns):
+        quote = self._engine.dialect.identifier_preparer.quote
+        table_name, staging_name = quote(table.name), quote(staging_table.name)
+        columns = [quote(column.name) for column in table.columns]
+        keys = [quote(col) for col in key_columns]
+        value_columns = [col for col in columns if col not in keys]
+        if self._db_type == 'mssql':
+            # HOLDLOCK keeps the matched range locked, so concurrent merges of the same keys do not both insert
+            return 'MERGE INTO {} WITH (HOLDLOCK) AS target USING {} AS source ON {} ' \
+                   'WHEN MATCHED THEN UPDATE SET {} ' \
+                   'WHEN NOT MATCHED THEN INSERT ({}) VALUES ({});'.format(
+                       table_name, staging_name,
+                       ' AND '.join('target.{0} = source.{0}'.format(col) for col in keys),
+                       ', '.join('target.{0} = source.{0}'.format(col) for col in value_columns),
+                       ', '.join(columns), ', '.join('source.{}'.format(col) for col in columns))
+        if self._db_type == 'mysql':
+            return 'INSERT INTO {0} ({1}) SELECT {1} FROM {2} ON DUPLICATE KEY UPDATE {3};'.format(
+                table_name, ', '.join(columns), staging_name,
+                ', '.join('{0} = VALUES({0})'.format(col) for col in value_columns))
+        # WHERE is needed by sqlite to tell the upsert clause from a join constraint
+        return 'INSERT INTO {0} ({1}) SELECT {1} FROM {2} WHERE 1 ON CONFLICT ({3}) DO UPDATE SET {4};'.format(
+            table_name, ', '.join(columns), staging_name, ', '.join(keys),
+            ', '.join('{0} = excluded.{0}'.format(col) for col in value_columns))
+
+    def _has_unique_key(self, table, key_columns):
+        # upserts need a unique key on key_columns, without it mysql inserts duplicates and sqlite fails
+        if table.name not in self._unique_keys:
+            inspector = sqlalchemy.inspect(self._engine)
+            unique_columns = [index['column_names'] for index in inspector.get_indexes(table.name) if index['unique']]
+            unique_columns += [constraint['column_names']
+                               for constraint in inspector.get_unique_constraints(table.name)]
+            unique_columns.append(inspector.get_pk_constraint(table.name)['constrained_columns'])
+            has_unique_key = any(set(columns) == set(key_columns) for columns in unique_columns)
+            if not has_unique_key:
+                warnings.warn('table {} has no unique key on {}, rows are merged by delete and insert which is not '
+                              'safe for concurrent writers'.format(table.name, ', '.join(key_columns)),
+                              exceptions.MissingComponentsWarning)
+            self._unique_keys[table.name] = has_unique_key
+        return self._unique_keys[table.name]
+
+    @staticmethod
+    def _delete_and_insert(connection, table, staging_table, key_columns):
+        matched = sqlalchemy.exists().where(sqlalchemy.and_(*[staging_table.c[col] == table.c[col]
+                                                              for col in key_columns]))
+        connection.execute(table.delete().where(matched))
+        columns = [column.name for column in table.columns]
+        connection.execute(table.insert().from_select(columns,
+                                                      sqlalchemy.select(*[staging_table.c[col] for col in columns])))
+
+    def merge_data(self, table, data, key_columns, watermark=None):
+        # data is bulk loaded into a session staging table and merged on key_columns with one statement,
+        # so repeated or overlapping writes of the same rows leave one row per key
+        if data.shape[0] == 0 and watermark is None:
+            return
+        has_unique_key = data.shape[0] == 0 or self._has_unique_key(table, key_columns)
+        with self._engine.begin() as connection:
+            if data.shape[0] > 0:
+                staging_table = self._build_staging_table(table)
+                staging_table.create(connection)
+                try:
+                    self._insert_rows(connection, staging_table, data, key_columns)
+                    if has_unique_key:
+                        connection.execute(sqlalchemy.text(self._build_merge_query(table, staging_table,
+                                                                                   key_columns)))
+                    else:
+                        SQLSource._delete_and_insert(connection, table, staging_table, key_columns)
+                finally:
+                    connection.execute(sqlalchemy.text(SQLSource.build_drop_staging_table_query(
+                        self._engine.dialect, staging_table.name)))
+            if watermark is not None:
+                SQLSource._advance_watermark(connection, *watermark)
+        return
+
+    def replace_data(self, table, data, delete_condition, watermark=None):
+        # table is a sqlalchemy table, rows matching delete_condition are replaced by data in one transaction
+        with self._engine.begin() as connection:
+            connection.execute(table.delete().where(delete_condition))
+            if data.shape[0] > 0:
+                self._insert_rows(connection, table, data)
+            if watermark is not None:
+                SQLSource._update_watermark(connection, *watermark)
+        return
+
+    def write_new_data(self, table, data, watermark=None):
+        # watermark is (watermarks_table, key, datetime) committed in the same transaction as data
+        if data.shape[0] == 0 and watermark is None:
+            return
+        with self._engine.begin() as connection:
+            for i in range(0, data.shape[0], SQLSource.TABLE_TO_WRITE_MAX_LENGTH):
+                data[i: i + SQLSource.TABLE_TO_WRITE_MAX_LENGTH].to_sql(table, connection, if_exists='append')
+            if watermark is not None:
+                SQLSource._update_watermark(connection, *watermark)
         return
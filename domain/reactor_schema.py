@@ -1,7 +1,5 @@
 from functools import reduce
 
-import numpy as np
-
 
 class ReactorPlate:
     def __init__(self, name, sensors_config):
@@ -13,6 +11,9 @@ class ReactorPlate:
     def get_angle_array(self, sensor_id):
         if sensor_id not in self._sensor_enumeration:
             raise ValueError('no sensor with name {} on plate {}'.format(str(sensor_id), self._name))
+        # reactors are loaded by every run, numpy only by the ones extracting features
+        import numpy as np
+
         result = np.zeros(len(self._sensors_config), dtype='int8')
         result[len(self._sensors_config) - self._sensors_config.index(sensor_id) - 1] = 1
         return result
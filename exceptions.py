@@ -1,4 +1,5 @@
-__all__ = ['MissingComponentsWarning', 'NoNewDataWarning', 'MissingTags', 'MissingModel', 'NotReadyModelError']
+__all__ = ['MissingComponentsWarning', 'NoNewDataWarning', 'MissingTags', 'MissingModel', 'NotReadyModelError',
+           'InvalidRequest']
 
 
 class MissingComponentsWarning(UserWarning):
@@ -36,3 +37,10 @@ class NotReadyModelError(ValueError, AttributeError):
     This class inherits from both ValueError and AttributeError to help with
     exception handling and backward compatibility.
     """
+
+
+class InvalidRequest(ValueError):
+    """Exception class to raise if a scoring request does not match the served reactor
+
+    This class inherits from ValueError.
+    """
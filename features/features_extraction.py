@@ -2,9 +2,8 @@ import warnings
 
 import numpy as np
 import pandas as pd
-from keras.layers import Dense
-from keras.models import Sequential
 
+import aggregation
 import constants
 import exceptions
 
@@ -14,16 +13,19 @@ NN_TEMPERATURE_PREFIX = 'Температура_'  # 'nn_temperature_'
 POSITION_PREFIX = 'angle'  # 'position_'
 
 
-def calculate_duration(timestamps):
-    return pd.DataFrame({'duration': (timestamps - timestamps[0]).total_seconds().values / 3600.},
+def calculate_duration(timestamps, origin=None):
+    # hours since the first timestamp of the run, which may have started before the given timestamps
+    origin = timestamps[0] if origin is None else origin
+    return pd.DataFrame({'duration': (timestamps - origin).total_seconds().values / 3600.},
                         index=timestamps)
 
 
 def collect_interval_mean_temperatures(temperature_sensors_data, interval, timestamps):
     return pd.DataFrame(
-        timestamps.map(lambda dt: temperature_sensors_data.loc[dt - interval: dt].mean().tolist()).tolist(),
+        timestamps.map(lambda dt: aggregation.mean(temperature_sensors_data.loc[dt - interval: dt]).tolist())
+        .tolist(),
         index=timestamps,
-        columns=temperature_sensors_data.columns
+        columns=aggregation.get_sensors(temperature_sensors_data)
     )
 
 
@@ -69,6 +71,9 @@ class AnalysisLinearTrendsExtractor:
         self._period = period
         self._tags_to_process = tags_to_process
 
+    def get_period(self):
+        return self._period
+
     def extract(self, chemical_analysis_data):
         missing_tags = [tag for tag in self._tags_to_process if tag not in chemical_analysis_data.columns]
         if missing_tags:
@@ -118,6 +123,9 @@ class NNTemperaturesFeaturesExtractor:
         return True
 
     def _compile_nn_model(self):
+        from keras.layers import Dense
+        from keras.models import Sequential
+
         nn_model = Sequential()
         nn_model.add(Dense(self._output_features_number, input_shape=(self._input_time_intervals_number,),
                            activation='linear', use_bias=True))
@@ -127,8 +135,8 @@ class NNTemperaturesFeaturesExtractor:
 
     def _calculate_features_row_for_datetime(self, temperature_sensor_data, dt):
         period_sensor_data = temperature_sensor_data.loc[dt - self._period: dt]
-        return [period_sensor_data.loc[dt + constants.ONE_SECOND_DELTA - self._interval * (i + 1):
-                                       dt - self._interval * i].mean()
+        return [aggregation.mean(period_sensor_data.loc[dt + constants.ONE_SECOND_DELTA - self._interval * (i + 1):
+                                                        dt - self._interval * i])
                 for i in range(self._input_time_intervals_number)]
 
     def extract(self, temperature_sensor_data, timestamps):
@@ -158,7 +166,7 @@ class FeaturesExtractor:
         self._excluded_features = excluded_features
 
     def extract(self, temperature_sensors_data, chemical_analysis_data, sensor_id, reactor,
-                mean_temperatures_interval=constants.TWELVE_HOURS_DELTA):
+                mean_temperatures_interval=constants.TWELVE_HOURS_DELTA, duration_origin=None):
         plate_number = reactor.find_plate_number(sensor_id)
         plate = reactor.get_plate(plate_number)
 
@@ -170,7 +178,7 @@ class FeaturesExtractor:
         below_temperature_delta = calculate_below_plate_temperature_delta(interval_mean_temperatures,
                                                                           sensor_id, plate_number, reactor)
         position = extract_sensor_position_features(timestamps, sensor_id, plate)
-        duration = calculate_duration(timestamps)
+        duration = calculate_duration(timestamps, duration_origin)
 
         if self._temperatures_features_extractor is None:
             temperatures_features = pd.DataFrame(None, index=timestamps)
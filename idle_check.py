@@ -0,0 +1,97 @@
+import datetime
+
+import sqlalchemy
+
+import constants
+from datasource import output_schema
+from datasource.source import SQLSource
+
+FINGERPRINT_BUCKET = datetime.timedelta(minutes=constants.FINGERPRINT_BUCKET_MINUTES)
+# fingerprint buckets are floored like pandas timestamps, from the unix epoch
+FINGERPRINT_BUCKET_ORIGIN = datetime.datetime(1970, 1, 1)
+
+
+class IdleRunCheck:
+    """Finds out without pandas whether a run has neither new analysis nor late input rows to process
+
+    The run watermark and the stored fingerprints are read the way the run reads them, but only rows counts
+    are compared and anything not cheap to settle, like a due full scan or a parquet only output,
+    is left to the run itself.
+    """
+
+    def __init__(self, settings, window=constants.LATE_DATA_WINDOW,
+                 full_scan_interval=constants.LATE_DATA_FULL_SCAN_INTERVAL):
+        output_params = settings.get_output()
+        table_names = settings.get_output_tables()
+        # watermarks and fingerprints of several sinks are read from the first one
+        self._is_sql_output = (output_params.get('sink') or constants.SQL_SINK).split(',')[0].strip() \
+            == constants.SQL_SINK
+        self._input_source = SQLSource(settings.get_input(), constants.INPUT_DATETIME_COLUMN)
+        self._output_source = SQLSource(output_params, constants.OUTPUT_DATETIME_COLUMN)
+        self._input_tables = settings.get_input_tables()
+        self._predictions_table_name = table_names['predictions']
+        metadata = sqlalchemy.MetaData()
+        self._watermarks_table = output_schema.build_watermarks_table(
+            metadata,
+            table_names.get('watermarks', constants.DEFAULT_WATERMARKS_TABLE)
+        )
+        self._fingerprints_table = output_schema.build_fingerprints_table(
+            metadata,
+            table_names.get('fingerprints', constants.DEFAULT_FINGERPRINTS_TABLE)
+        )
+        self._window = window
+        self._full_scan_interval = full_scan_interval
+        self._scan_datetime = datetime.datetime.now()
+
+    def _find_watermark(self, key):
+        return self._output_source.find_watermark(self._watermarks_table, key)
+
+    def _get_window_since(self, until_datetime):
+        since_datetime = until_datetime - self._window
+        return since_datetime - (since_datetime - FINGERPRINT_BUCKET_ORIGIN) % FINGERPRINT_BUCKET
+
+    def _find_stored_counts(self, table_name, since_datetime, until_datetime):
+        table = self._fingerprints_table
+        query = sqlalchemy.select(table.c[constants.OUTPUT_DATETIME_COLUMN], table.c[constants.AGGREGATION_COUNT]) \
+            .where(table.c[output_schema.FINGERPRINT_TABLE_COLUMN] == table_name) \
+            .where(table.c[output_schema.FINGERPRINT_COLUMN] == output_schema.ROW_COUNT_FINGERPRINT)
+        connection = self._output_source.get_engine().connect()
+        try:
+            rows = connection.execute(query).fetchall()
+        finally:
+            connection.close()
+        # the buckets holding rows in (since_datetime, until_datetime], like late_data.select_buckets
+        return {bucket: count for bucket, count in rows
+                if bucket > since_datetime and bucket - FINGERPRINT_BUCKET < until_datetime}
+
+    def _has_unchanged_row_counts(self, table_name):
+        until_datetime = self._find_watermark(output_schema.FINGERPRINTS_WATERMARK_PREFIX + table_name)
+        if until_datetime is None:
+            # tables never fingerprinted are not checked for late rows by the run either
+            return True
+        scan_datetime = self._find_watermark(output_schema.FINGERPRINTS_SCAN_PREFIX + table_name)
+        if scan_datetime is None or self._scan_datetime - scan_datetime >= self._full_scan_interval:
+            return False
+        since_datetime = self._get_window_since(until_datetime)
+        stored_counts = self._find_stored_counts(table_name, since_datetime, until_datetime)
+        if not stored_counts:
+            return False
+        current_counts = self._input_source.find_bucket_counts(table_name, constants.FINGERPRINT_BUCKET_MINUTES,
+                                                               since_datetime, allow_equality=False,
+                                                               until_datetime=until_datetime)
+        return stored_counts == current_counts
+
+    def find_idle_datetime(self):
+        """Returns the last prediction datetime if the run has nothing to do, otherwise None"""
+        if not self._is_sql_output:
+            return None
+        last_output_datetime = self._find_watermark(self._predictions_table_name)
+        if last_output_datetime is None:
+            return None
+        for table_type, table_name in self._input_tables.items():
+            if table_type != 'temperatures' and \
+                    self._input_source.find_last_datetime(table_name) > last_output_datetime:
+                return None
+            if not self._has_unchanged_row_counts(table_name):
+                return None
+        return last_output_datetime
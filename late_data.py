@@ -0,0 +1,284 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+import constants
+from datasource import output_schema
+
+FINGERPRINT_BUCKET = datetime.timedelta(minutes=constants.FINGERPRINT_BUCKET_MINUTES)
+FINGERPRINT_TOLERANCE = 1e-9
+# outputs of a timestamp depend on inputs this far back, so a changed input reaches outputs this far forward
+TEMPERATURES_LOOKBACK = max(constants.NN_PERIOD, constants.TWELVE_HOURS_DELTA)
+STATISTICS_LOOKBACK = constants.TEMPERATURES_STD_PERIOD + constants.STATISTICS_SMOOTHING_PERIOD
+
+
+def to_long_fingerprints(aggregated):
+    frames = []
+    for col in aggregation.get_sensors(aggregated):
+        frame = aggregated[col][aggregation.STATISTICS].copy()
+        frame.insert(0, output_schema.FINGERPRINT_COLUMN, str(col))
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=[output_schema.FINGERPRINT_COLUMN] + aggregation.STATISTICS,
+                            index=pd.DatetimeIndex([], name=constants.OUTPUT_DATETIME_COLUMN))
+    result = pd.concat(frames, sort=False)
+    return result.reindex(result.index.rename(constants.OUTPUT_DATETIME_COLUMN))
+
+
+def to_row_count_fingerprints(counts):
+    frame = pd.DataFrame({output_schema.FINGERPRINT_COLUMN: output_schema.ROW_COUNT_FINGERPRINT, aggregation.SUM: np.nan,
+                          aggregation.COUNT: counts[aggregation.COUNT].astype('float64'),
+                          aggregation.SUM_SQUARES: np.nan},
+                         index=counts.index, columns=[output_schema.FINGERPRINT_COLUMN] + aggregation.STATISTICS)
+    return frame.reindex(frame.index.rename(constants.OUTPUT_DATETIME_COLUMN))
+
+
+def select_buckets(fingerprints, since_datetime, until_datetime):
+    """Returns fingerprints of the buckets holding rows in (since_datetime, until_datetime]"""
+    buckets = pd.to_datetime(fingerprints.index)
+    selected = (buckets > since_datetime) & (buckets - FINGERPRINT_BUCKET < until_datetime)
+    return fingerprints.loc[selected]
+
+
+def _index_fingerprints(fingerprints):
+    fingerprints = fingerprints.set_index(pd.to_datetime(fingerprints.index).rename(constants.OUTPUT_DATETIME_COLUMN))
+    return fingerprints.set_index(output_schema.FINGERPRINT_COLUMN, append=True)[aggregation.STATISTICS]
+
+
+def find_changed_fingerprints(stored, current):
+    """Returns (bucket, column) pairs whose rows were added, removed or changed"""
+    stored, current = _index_fingerprints(stored).align(_index_fingerprints(current), join='outer')
+    unchanged = np.isclose(stored.values.astype('float64'), current.values.astype('float64'),
+                           rtol=FINGERPRINT_TOLERANCE, atol=FINGERPRINT_TOLERANCE, equal_nan=True).all(axis=1)
+    return stored.index[~unchanged]
+
+
+def find_affected_sensors(reactor, sensors):
+    # plate deltas of a sensor use mean temperatures of the plates above and below it
+    affected_sensors = set()
+    for sensor_id in sensors:
+        plate_number = reactor.find_plate_number(sensor_id)
+        affected_sensors.add(sensor_id)
+        for neighbour_plate_number in [reactor.get_plate_number_above(plate_number),
+                                       reactor.get_plate_number_below(plate_number)]:
+            if neighbour_plate_number is not None:
+                affected_sensors.update(reactor.get_plate(neighbour_plate_number).get_sensor_list())
+    return affected_sensors
+
+
+class LateDataPlan:
+    """Input time ranges changed after they were processed and the output ranges to recompute
+
+    Ranges are (since, until] pairs, outputs after last_output_datetime are produced by the regular run anyway.
+    """
+
+    def __init__(self, last_output_datetime):
+        self._last_output_datetime = last_output_datetime
+        self._analysis_tags = set()
+        self._analysis_range = None
+        self._temperatures_range = None
+        self._temperatures_sensors = set()
+
+    @staticmethod
+    def _build_range(buckets):
+        # buckets are labelled by their end
+        buckets = pd.to_datetime(pd.Index(buckets))
+        return buckets.min().to_pydatetime() - FINGERPRINT_BUCKET, buckets.max().to_pydatetime()
+
+    @staticmethod
+    def _merge_ranges(first, second):
+        if first is None:
+            return second
+        if second is None:
+            return first
+        return min(first[0], second[0]), max(first[1], second[1])
+
+    def add_analysis_changes(self, buckets, tags):
+        self._analysis_range = LateDataPlan._merge_ranges(self._analysis_range, LateDataPlan._build_range(buckets))
+        self._analysis_tags.update(tags)
+
+    def add_temperatures_changes(self, buckets, sensors):
+        self._temperatures_range = LateDataPlan._merge_ranges(self._temperatures_range,
+                                                              LateDataPlan._build_range(buckets))
+        self._temperatures_sensors.update(sensors)
+
+    def is_empty(self):
+        return self._analysis_range is None and self._temperatures_range is None
+
+    def extend_analysis_interpolation(self, raw_analysis):
+        # interpolated values between the neighbouring measurements of a changed one change as well
+        if self._analysis_range is None:
+            return
+        since_datetime, until_datetime = self._analysis_range
+        for tag in self._analysis_tags:
+            if tag not in raw_analysis.columns:
+                continue
+            measured = raw_analysis[tag].dropna().index
+            if len(measured) == 0:
+                continue
+            before = measured[measured <= since_datetime]
+            after = measured[measured > until_datetime]
+            if len(before) > 0:
+                since_datetime = min(since_datetime, before.max().to_pydatetime())
+            until_datetime = max(until_datetime, (after.min() if len(after) > 0 else raw_analysis.index.max())
+                                 .to_pydatetime())
+        self._analysis_range = since_datetime, until_datetime
+
+    def _clip(self, since_datetime, until_datetime):
+        until_datetime = min(until_datetime, self._last_output_datetime)
+        if since_datetime >= until_datetime:
+            return None
+        return since_datetime, until_datetime
+
+    def get_read_since(self, default_datetime):
+        since_datetimes = [default_datetime]
+        for changed_range in [self._analysis_range, self._temperatures_range]:
+            if changed_range is not None:
+                since_datetimes.append(changed_range[0] - constants.PREDICTION_SMOOTHING_PERIOD)
+        return min(since_datetimes)
+
+    def get_predictions_range(self, sensor_id, trends_period):
+        predictions_range = None
+        if self._analysis_range is not None:
+            since_datetime, until_datetime = self._analysis_range
+            predictions_range = (since_datetime,
+                                 until_datetime + trends_period + constants.PREDICTION_SMOOTHING_PERIOD)
+        if self._temperatures_range is not None and sensor_id in self._temperatures_sensors:
+            since_datetime, until_datetime = self._temperatures_range
+            predictions_range = LateDataPlan._merge_ranges(
+                predictions_range,
+                (since_datetime, until_datetime + TEMPERATURES_LOOKBACK + constants.PREDICTION_SMOOTHING_PERIOD)
+            )
+        if predictions_range is None:
+            return None
+        return self._clip(*predictions_range)
+
+    def get_statistics_range(self):
+        if self._temperatures_range is None:
+            return None
+        since_datetime, until_datetime = self._temperatures_range
+        return self._clip(since_datetime, until_datetime + STATISTICS_LOOKBACK)
+
+    def get_report(self):
+        lines = []
+        if self._analysis_range is not None:
+            lines.append('late analysis data in ({}, {}]'.format(*self._analysis_range))
+        if self._temperatures_range is not None:
+            lines.append('late temperatures data in ({}, {}] for sensors {}'.format(
+                *self._temperatures_range, ', '.join(sorted(self._temperatures_sensors))))
+        return '\n'.join(lines)
+
+
+class LateDataTracker:
+    """Finds input rows added or corrected after they were processed
+
+    Every run stores per bucket fingerprints of the input tables up to its watermark. The next run counts
+    rows per bucket of the same range and scans values only of the buckets whose rows number changed.
+    Corrections in place keep rows numbers, so all values are scanned again every full_scan_interval.
+    """
+
+    def __init__(self, input_data_handler, output_data_handler, dao, reactor, window=constants.LATE_DATA_WINDOW,
+                 full_scan_interval=constants.LATE_DATA_FULL_SCAN_INTERVAL):
+        reactor_name = reactor.get_name()
+        self._input_data_handler = input_data_handler
+        self._output_data_handler = output_data_handler
+        self._reactor = reactor
+        self._analysis_tags = set(dao.get_chemical_analysis_tags_dao().findall().get(reactor_name, {}).keys())
+        self._temperatures_tags = dao.get_temperatures_tags_dao().findall().get(reactor_name, {})
+        self._window = window
+        self._full_scan_interval = full_scan_interval
+        self._scan_datetime = datetime.datetime.now()
+        # fingerprints checked against the input by find_changes and the datetime they were taken until
+        self._verified_fingerprints = {}
+        self._fully_scanned_tables = set()
+
+    def _get_window_since(self, until_datetime):
+        return pd.Timestamp(until_datetime - self._window).floor(FINGERPRINT_BUCKET).to_pydatetime()
+
+    def _take_row_counts(self, table_type, since_datetime, until_datetime):
+        return to_row_count_fingerprints(self._input_data_handler.get_row_counts(table_type, since_datetime,
+                                                                                 until_datetime))
+
+    def _take_table_fingerprints(self, table_type, since_datetime, until_datetime):
+        values = to_long_fingerprints(self._input_data_handler.get_fingerprints(table_type, since_datetime,
+                                                                                until_datetime))
+        return pd.concat([values, self._take_row_counts(table_type, since_datetime, until_datetime)], sort=False)
+
+    def _is_full_scan_due(self, table_name):
+        scan_datetime = self._output_data_handler.find_input_scan_datetime(table_name)
+        return scan_datetime is None or self._scan_datetime - scan_datetime >= self._full_scan_interval
+
+    def _compare_table(self, table_type, table_name, stored, until_datetime):
+        # returns changed (bucket, column) pairs and the window fingerprints matching the input
+        since_datetime = self._get_window_since(until_datetime)
+        stored = select_buckets(stored, since_datetime, until_datetime)
+        stored_counts = stored.loc[stored[output_schema.FINGERPRINT_COLUMN] == output_schema.ROW_COUNT_FINGERPRINT]
+        scan_since_datetime, scan_until_datetime = since_datetime, until_datetime
+        if stored_counts.shape[0] > 0 and not self._is_full_scan_due(table_name):
+            changes = find_changed_fingerprints(stored_counts, self._take_row_counts(table_type, since_datetime,
+                                                                                     until_datetime))
+            if len(changes) == 0:
+                return changes, stored
+            buckets = pd.to_datetime(changes.get_level_values(0))
+            scan_since_datetime = max(since_datetime, buckets.min().to_pydatetime() - FINGERPRINT_BUCKET)
+            scan_until_datetime = min(until_datetime, buckets.max().to_pydatetime())
+        else:
+            self._fully_scanned_tables.add(table_name)
+        current = self._take_table_fingerprints(table_type, scan_since_datetime, scan_until_datetime)
+        scanned = select_buckets(stored, scan_since_datetime, scan_until_datetime)
+        changes = find_changed_fingerprints(scanned, current)
+        return changes, pd.concat([stored.drop(index=scanned.index.unique()), current], sort=False)
+
+    def find_changes(self, last_output_datetime):
+        plan = LateDataPlan(last_output_datetime)
+        for table_type in self._input_data_handler.get_table_types():
+            table_name = self._input_data_handler.get_table_name(table_type)
+            stored, until_datetime = self._output_data_handler.find_input_fingerprints(table_name)
+            if stored is None:
+                continue
+            changes, verified = self._compare_table(table_type, table_name, stored, until_datetime)
+            self._verified_fingerprints[table_name] = verified, until_datetime
+            if len(changes) == 0:
+                if table_name in self._fully_scanned_tables:
+                    self._output_data_handler.set_input_scan_datetime(table_name, self._scan_datetime)
+                continue
+            buckets, tags = changes.get_level_values(0), changes.get_level_values(1)
+            if table_type != 'temperatures':
+                reactor_changes = np.asarray(tags.isin(self._analysis_tags))
+                if reactor_changes.any():
+                    plan.add_analysis_changes(buckets[reactor_changes], set(tags[reactor_changes]))
+                continue
+            reactor_sensors = set(self._reactor.get_sensor_list())
+            reactor_changes = np.asarray([self._temperatures_tags.get(tag) in reactor_sensors for tag in tags])
+            if reactor_changes.any():
+                sensors = {self._temperatures_tags[tag] for tag in tags[reactor_changes]}
+                plan.add_temperatures_changes(buckets[reactor_changes], find_affected_sensors(self._reactor, sensors))
+        return plan
+
+    def take_fingerprints(self, until_datetime):
+        # whole buckets verified by find_changes are kept, only the ones after them are scanned
+        fingerprints = {}
+        for table_type in self._input_data_handler.get_table_types():
+            table_name = self._input_data_handler.get_table_name(table_type)
+            since_datetime = self._get_window_since(until_datetime)
+            verified, verified_until_datetime = self._verified_fingerprints.get(table_name, (None, None))
+            if verified is None or verified_until_datetime > until_datetime:
+                self._fully_scanned_tables.add(table_name)
+                fingerprints[table_name] = self._take_table_fingerprints(table_type, since_datetime, until_datetime)
+                continue
+            scan_since_datetime = max(since_datetime,
+                                      pd.Timestamp(verified_until_datetime).floor(FINGERPRINT_BUCKET).to_pydatetime())
+            table_fingerprints = [select_buckets(verified, since_datetime, scan_since_datetime)]
+            if scan_since_datetime < until_datetime:
+                table_fingerprints.append(self._take_table_fingerprints(table_type, scan_since_datetime,
+                                                                        until_datetime))
+            fingerprints[table_name] = pd.concat(table_fingerprints, sort=False)
+        return fingerprints
+
+    def store_fingerprints(self, fingerprints, until_datetime):
+        for table_name, table_fingerprints in fingerprints.items():
+            self._output_data_handler.replace_input_fingerprints(table_name, table_fingerprints, until_datetime)
+            if table_name in self._fully_scanned_tables:
+                self._output_data_handler.set_input_scan_datetime(table_name, self._scan_datetime)
@@ -0,0 +1,241 @@
+import warnings
+
+import numpy as np
+
+import exceptions
+
+LINEAR_MODELS = {'LogisticRegression'}
+TREE_MODELS = {'DecisionTreeClassifier', 'ExtraTreeClassifier'}
+TREE_ENSEMBLE_MODELS = {'RandomForestClassifier', 'ExtraTreesClassifier'}
+
+PROBE_ROWS_NUMBER = 256
+EQUIVALENCE_TOLERANCE = 1e-6
+POSITIVE_CLASS_INDEX = 1
+
+
+def _is_binary(model):
+    return len(getattr(model, 'classes_', [])) == 2
+
+
+def _is_linear(model):
+    return type(model).__name__ in LINEAR_MODELS and _is_binary(model) and model.coef_.shape[0] == 1
+
+
+def _get_trees(model):
+    if type(model).__name__ in TREE_MODELS:
+        trees = [model]
+    elif type(model).__name__ in TREE_ENSEMBLE_MODELS:
+        trees = list(model.estimators_)
+    else:
+        return None
+    if not _is_binary(model) or any(tree.n_outputs_ != 1 for tree in trees):
+        return None
+    return trees
+
+
+def _check_features(x, features_number, model_name, dtype='float64', allow_nan=False):
+    # the same checks sklearn runs before predict_proba, compiled evaluators skip sklearn validation
+    if x.ndim != 2:
+        raise ValueError('Expected 2D array, got {}D array instead.'.format(x.ndim))
+    if x.shape[1] != features_number:
+        raise ValueError('X has {} features, but {} is expecting {} features as input.'.format(
+            x.shape[1], model_name, features_number))
+    if not allow_nan and np.isnan(x).any():
+        raise ValueError('Input X contains NaN.')
+    with np.errstate(over='ignore'):
+        finite = not np.isinf(x.astype(dtype)).any()
+    if not finite:
+        raise ValueError('Input X contains infinity or a value too large for {!r}.'.format(np.dtype(dtype)))
+
+
+class _LinearEvaluator:
+    def __init__(self, models):
+        self._coefs = np.hstack([model.coef_.T for model in models])
+        self._intercepts = np.hstack([model.intercept_ for model in models])
+        self._model_name = type(models[0]).__name__
+
+    def get_features_number(self):
+        return self._coefs.shape[0]
+
+    def check(self, x):
+        _check_features(x, self.get_features_number(), self._model_name)
+
+    def evaluate(self, x):
+        # logistic function written through logaddexp does not overflow for large decision values
+        return np.exp(-np.logaddexp(0., -(x @ self._coefs + self._intercepts)))
+
+
+class _TreeEvaluator:
+    def __init__(self, trees, model_name):
+        # node arrays of all trees are stacked into one flat forest, leaves point to themselves,
+        # so every row walks all trees at once for max depth steps without per-estimator calls
+        trees_ = [tree.tree_ for tree in trees]
+        offsets = np.cumsum([0] + [tree_.node_count for tree_ in trees_])
+        features, thresholds, children, probabilities = [], [], [], []
+        for offset, tree_ in zip(offsets, trees_):
+            nodes = np.arange(tree_.node_count)
+            is_leaf = tree_.children_left == -1
+            features.append(np.where(is_leaf, 0, tree_.feature))
+            thresholds.append(np.where(is_leaf, 0., tree_.threshold))
+            # children of node i are at 2 * i for the left one and 2 * i + 1 for the right one
+            children.append(np.stack([np.where(is_leaf, nodes, tree_.children_left),
+                                      np.where(is_leaf, nodes, tree_.children_right)], axis=1).ravel() + offset)
+            values = tree_.value[:, 0, :]
+            probabilities.append(values[:, POSITIVE_CLASS_INDEX] / values.sum(axis=1))
+        self._roots = offsets[:-1, np.newaxis].astype(np.intp)
+        self._features = np.concatenate(features).astype(np.intp)
+        self._thresholds = np.concatenate(thresholds)
+        self._children = np.concatenate(children).astype(np.intp)
+        self._probabilities = np.concatenate(probabilities)
+        self._is_split = np.concatenate([tree_.children_left != -1 for tree_ in trees_])
+        self._max_depth = max(tree_.max_depth for tree_ in trees_)
+        self._tree = trees_[0] if len(trees_) == 1 else None
+        self._features_number = trees[0].n_features_in_
+        self._model_name = model_name
+
+    def get_features_number(self):
+        return self._features_number
+
+    def check(self, x):
+        # sklearn trees compare features as float32, rows with NaN are checked by the original model
+        _check_features(x, self.get_features_number(), self._model_name, 'float32', allow_nan=True)
+
+    def get_splits(self):
+        return [(self._features[self._is_split], self._thresholds[self._is_split])]
+
+    def evaluate(self, x):
+        x = np.asarray(x, dtype='float32')
+        if self._tree is not None:
+            # one tree is walked by a single sklearn call already, numpy steps would only add overhead
+            return self._probabilities[self._tree.apply(np.ascontiguousarray(x))]
+        # features are rounded to float32 like sklearn does and compared to the float64 thresholds,
+        # columns come first so that the rows of one tree gather from neighbouring values
+        rows_number = x.shape[0]
+        x = np.asfortranarray(x, dtype='float64').ravel(order='F')
+        shape = (self._roots.shape[0], rows_number)
+        nodes = np.empty(shape, dtype=np.intp)
+        nodes[:] = self._roots
+        rows = np.arange(rows_number, dtype=np.intp)
+        positions = np.empty(shape, dtype=np.intp)
+        values = np.empty(shape)
+        thresholds = np.empty(shape)
+        go_right = np.empty(shape, dtype=bool)
+        # buffers are allocated once, the steps only gather into them
+        for _ in range(self._max_depth):
+            np.take(self._features, nodes, out=positions, mode='clip')
+            positions *= rows_number
+            positions += rows
+            np.take(x, positions, out=values, mode='clip')
+            np.take(self._thresholds, nodes, out=thresholds, mode='clip')
+            np.greater(values, thresholds, out=go_right)
+            nodes *= 2
+            nodes += go_right
+            np.take(self._children, nodes, out=nodes, mode='clip')
+        return np.take(self._probabilities, nodes).mean(axis=0)
+
+
+class MultiHorizonPredictor:
+    def __init__(self, models):
+        self._horizons = list(models.keys())
+        self._fallback_models = {}
+        self._tree_evaluators = {}
+        self._tree_models = {}
+        linear_horizons = []
+        for horizon, model in models.items():
+            trees = _get_trees(model)
+            if _is_linear(model):
+                linear_horizons.append(horizon)
+            elif trees is not None:
+                self._tree_evaluators[horizon] = _TreeEvaluator(trees, type(model).__name__)
+                self._tree_models[horizon] = model
+            else:
+                self._fallback_models[horizon] = model
+        self._linear_horizons = linear_horizons
+        self._linear_evaluator = _LinearEvaluator([models[horizon] for horizon in linear_horizons]) \
+            if linear_horizons else None
+        self._validate(models)
+
+    @staticmethod
+    def _build_probe(features_number, tree_evaluator=None):
+        random_state = np.random.RandomState(0)
+        probe = random_state.normal(0., 100., (PROBE_ROWS_NUMBER, features_number))
+        if tree_evaluator is not None:
+            splits = tree_evaluator.get_splits()
+            features = np.concatenate([tree_features for tree_features, _ in splits])
+            thresholds = np.concatenate([tree_thresholds for _, tree_thresholds in splits])
+            for feature in range(features_number):
+                # splits separating only missing values have infinite thresholds
+                feature_thresholds = thresholds[(features == feature) & np.isfinite(thresholds)]
+                if feature_thresholds.shape[0] > 0:
+                    probe[:, feature] = random_state.choice(feature_thresholds, PROBE_ROWS_NUMBER) \
+                        + random_state.normal(0., 1e-3, PROBE_ROWS_NUMBER)
+        return probe
+
+    @staticmethod
+    def _original_probabilities(model, probe):
+        feature_names = getattr(model, 'feature_names_in_', None)
+        if feature_names is not None:
+            import pandas as pd
+            probe = pd.DataFrame(probe, columns=feature_names)
+        return model.predict_proba(probe)[:, POSITIVE_CLASS_INDEX]
+
+    def _validate(self, models):
+        # compiled evaluators must reproduce predict_proba, otherwise the original model is kept
+        failed_horizons = []
+        if self._linear_evaluator is not None:
+            probe = MultiHorizonPredictor._build_probe(self._linear_evaluator.get_features_number())
+            compiled = self._linear_evaluator.evaluate(probe)
+            for i, horizon in enumerate(self._linear_horizons):
+                original = MultiHorizonPredictor._original_probabilities(models[horizon], probe)
+                if not np.allclose(compiled[:, i], original, atol=EQUIVALENCE_TOLERANCE):
+                    failed_horizons.append(horizon)
+        for horizon, evaluator in self._tree_evaluators.items():
+            probe = MultiHorizonPredictor._build_probe(evaluator.get_features_number(), evaluator)
+            original = MultiHorizonPredictor._original_probabilities(models[horizon], probe)
+            if not np.allclose(evaluator.evaluate(probe), original, atol=EQUIVALENCE_TOLERANCE):
+                failed_horizons.append(horizon)
+
+        for horizon in failed_horizons:
+            warnings.warn('compiled model for horizon {} does not match the original one'.format(horizon),
+                          exceptions.MissingComponentsWarning)
+            self._tree_evaluators.pop(horizon, None)
+            self._tree_models.pop(horizon, None)
+            self._fallback_models[horizon] = models[horizon]
+        if any(horizon in self._linear_horizons for horizon in failed_horizons):
+            self._linear_horizons = [horizon for horizon in self._linear_horizons if horizon not in failed_horizons]
+            self._linear_evaluator = _LinearEvaluator([models[horizon] for horizon in self._linear_horizons]) \
+                if self._linear_horizons else None
+
+    def get_horizons(self):
+        return list(self._horizons)
+
+    def predict_positive_proba(self, features):
+        x = np.asarray(features, dtype='float64')
+        if self._linear_evaluator is not None:
+            self._linear_evaluator.check(x)
+        for evaluator in self._tree_evaluators.values():
+            evaluator.check(x)
+        result = np.empty((x.shape[0], len(self._horizons)))
+        if self._linear_evaluator is not None:
+            linear_probabilities = self._linear_evaluator.evaluate(x)
+            for i, horizon in enumerate(self._linear_horizons):
+                result[:, self._horizons.index(horizon)] = linear_probabilities[:, i]
+        # sklearn trees route missing values by rules learned in fit or reject them, such rows are left to
+        # the original models, so both the probabilities and the errors stay the same
+        missing_rows = np.isnan(x).any(axis=1) if self._tree_evaluators else None
+        for horizon, evaluator in self._tree_evaluators.items():
+            column = self._horizons.index(horizon)
+            if not missing_rows.any():
+                result[:, column] = evaluator.evaluate(x)
+                continue
+            result[missing_rows, column] = MultiHorizonPredictor._original_probabilities(
+                self._tree_models[horizon], x[missing_rows])
+            if not missing_rows.all():
+                result[~missing_rows, column] = evaluator.evaluate(x[~missing_rows])
+        for horizon, model in self._fallback_models.items():
+            result[:, self._horizons.index(horizon)] = model.predict_proba(features)[:, POSITIVE_CLASS_INDEX]
+        return result
+
+
+def compile_prediction_models(models):
+    return MultiHorizonPredictor(models)
@@ -1,22 +1,25 @@
 import os
 import pickle
-
-from keras.models import load_model
+import threading
+import warnings
 
 import constants
 import exceptions
 from features.features_extraction import NNTemperaturesFeaturesExtractor
+from model.compilation import compile_prediction_models
 
 
 class ModelLoader:
     KERAS_MODELS_ENDING = '.nn'
     PICKLE_ENDING = '.pkl'
 
-    def __init__(self, settings, reactor_names):
+    def __init__(self, settings, reactor_names, caches=None):
         self._reactor_names = reactor_names
         self._keras_weights_dir = settings.get_keras_weights()['dir']
         self._features_models_dir = settings.get_features_models()['dir']
         self._prediction_models_dir = settings.get_prediction_models()['dir']
+        # loaded models by path with the file version they were loaded from, shared between reloads
+        self._caches = caches if caches is not None else {'keras': {}, 'features': {}, 'prediction': {}}
 
     @staticmethod
     def _filter_files_by_ending(filenames):
@@ -28,24 +31,36 @@ class ModelLoader:
         return filename.replace(ModelLoader.KERAS_MODELS_ENDING, '').replace(ModelLoader.PICKLE_ENDING, '')
 
     class _SpecificModelLoader:
-        def __init__(self, path, reactor_names, is_keras=False):
+        def __init__(self, path, reactor_names, is_keras=False, cache=None):
             found_reactor_names = set(os.listdir(path)).intersection(reactor_names)
             self._models = {}
+            self._loaded = {}
             for reactor_name in found_reactor_names:
                 reactor_path = os.path.join(path, reactor_name)
                 saved_models_names = ModelLoader._filter_files_by_ending(os.listdir(reactor_path))
                 self._models[reactor_name] = {
-                    ModelLoader._remove_ending(name): ModelLoader._SpecificModelLoader._load_saved_model(
-                        os.path.join(reactor_path, name),
-                        is_keras
-                    )
+                    ModelLoader._remove_ending(name): self._load_cached_model(os.path.join(reactor_path, name),
+                                                                              is_keras, cache)
                     for name in saved_models_names
                 }
 
+        def _load_cached_model(self, path, is_keras, cache):
+            version = ModelLoader.get_file_version(path)
+            if cache is not None and path in cache and cache[path][0] == version:
+                model = cache[path][1]
+            else:
+                model = ModelLoader._SpecificModelLoader._load_saved_model(path, is_keras)
+            self._loaded[path] = (version, model)
+            return model
+
+        def get_loaded(self):
+            return self._loaded
+
         @staticmethod
         def _load_saved_model(path, is_keras):
             if not is_keras:
                 return pickle.load(file=open(path, 'rb'))
+            from keras.models import load_model
             return NNTemperaturesFeaturesExtractor(constants.NN_PERIOD, constants.NN_INPUT_TIME_INTERVALS_NUMBER,
                                                    constants.NN_OUTPUT_FEATURES_NUMBER, load_model(path))
 
@@ -54,49 +69,98 @@ class ModelLoader:
                 return self._models[reactor_name].get(model_name)
             return None
 
+    @staticmethod
+    def get_file_version(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _get_loader(self, path, model_type, is_keras=False):
+        loader = ModelLoader._SpecificModelLoader(path, self._reactor_names, is_keras, self._caches[model_type])
+        self._caches[model_type] = loader.get_loaded()
+        return loader
+
     def get_keras_models_loader(self):
-        return ModelLoader._SpecificModelLoader(self._keras_weights_dir, self._reactor_names, True)
+        return self._get_loader(self._keras_weights_dir, 'keras', True)
 
     def get_features_models_loader(self):
-        return ModelLoader._SpecificModelLoader(self._features_models_dir, self._reactor_names)
+        return self._get_loader(self._features_models_dir, 'features')
 
     def get_prediction_models_loader(self):
-        return ModelLoader._SpecificModelLoader(self._prediction_models_dir, self._reactor_names)
+        return self._get_loader(self._prediction_models_dir, 'prediction')
+
+    def get_caches(self):
+        return self._caches
+
+    def has_changes(self):
+        for model_type, path in [('keras', self._keras_weights_dir), ('features', self._features_models_dir),
+                                 ('prediction', self._prediction_models_dir)]:
+            current_paths = set()
+            for reactor_name in set(os.listdir(path)).intersection(self._reactor_names):
+                reactor_path = os.path.join(path, reactor_name)
+                current_paths.update(os.path.join(reactor_path, name)
+                                     for name in ModelLoader._filter_files_by_ending(os.listdir(reactor_path)))
+            cache = self._caches[model_type]
+            if current_paths != set(cache):
+                return True
+            if any(ModelLoader.get_file_version(path) != cache[path][0] for path in current_paths):
+                return True
+        return False
 
 
 class ModelRepository:
     def __init__(self, reactors, settings):
-        self._keras_models = {}
-        self._features_models = {}
-        self._prediction_models = {}
-        self._sensors_index = {}
-        models_loader = ModelLoader(settings, {reactor.get_name() for reactor in reactors})
+        self._settings = settings
+        self._reactors = list(reactors)
+        self._reload_lock = threading.Lock()
+        self._compiled_cache = {}
+        self._models_loader = ModelLoader(settings, {reactor.get_name() for reactor in self._reactors})
+        self._state = self._build_state(self._reactors, self._models_loader)
+
+    def _build_state(self, reactors, models_loader):
+        state = {'keras': {}, 'features': {}, 'prediction': {}, 'compiled_prediction': {}, 'sensors_index': {}}
+        keras_models_loader = models_loader.get_keras_models_loader()
+        features_models_loader = models_loader.get_features_models_loader()
+        prediction_models_loader = models_loader.get_prediction_models_loader()
         for reactor in reactors:
             reactor_name = reactor.get_name()
-            self._sensors_index[reactor_name] = self._build_sensors_index(reactor)
-            self._keras_models[reactor_name] = self._build_models_dict(models_loader.get_keras_models_loader(),
-                                                                       reactor)
-            self._features_models[reactor_name] = self._build_models_dict(models_loader.get_features_models_loader(),
-                                                                          reactor)
-            self._prediction_models[reactor_name] = self._build_models_dict(
-                models_loader.get_prediction_models_loader(),
-                reactor
-            )
+            state['sensors_index'][reactor_name] = self._build_sensors_index(reactor)
+            state['keras'][reactor_name] = self._build_models_dict(keras_models_loader, reactor)
+            state['features'][reactor_name] = self._build_models_dict(features_models_loader, reactor)
+            state['prediction'][reactor_name] = self._build_models_dict(prediction_models_loader, reactor)
+            state['compiled_prediction'][reactor_name] = self._compile_models_dict(state['prediction'][reactor_name])
+        return state
+
+    def has_changes(self):
+        return self._models_loader.has_changes()
+
+    def reload(self, reactors=None):
+        with self._reload_lock:
+            reactors = self._reactors if reactors is None else list(reactors)
+            models_loader = ModelLoader(self._settings, {reactor.get_name() for reactor in reactors},
+                                        dict(self._models_loader.get_caches()))
+            try:
+                state = self._build_state(reactors, models_loader)
+            except Exception as e:
+                warnings.warn('models reload failed, previous models are kept: {}'.format(str(e)),
+                              exceptions.MissingComponentsWarning)
+                return False
+            # unchanged files keep their loaded objects, so only changed models were loaded again
+            self._reactors, self._models_loader, self._state = reactors, models_loader, state
+            loaded_models = {id(model) for _, model in models_loader.get_caches()['prediction'].values()}
+            self._compiled_cache = {key: value for key, value in self._compiled_cache.items()
+                                    if key in loaded_models}
+            return True
 
     def _get_sensor_model(self, reactor_name, sensor, model_type):
-        if model_type == 'features':
-            models = self._features_models
-        elif model_type == 'prediction':
-            models = self._prediction_models
-        elif model_type == 'keras':
-            models = self._keras_models
-        else:
+        state = self._state
+        if model_type not in ('features', 'prediction', 'compiled_prediction', 'keras'):
             raise ValueError('model type must be \"features\" or \"prediction\"\
-             or \"keras\"'.format(str(reactor_name)))
+             or \"compiled_prediction\" or \"keras\"'.format(str(reactor_name)))
+        models = state[model_type]
         if reactor_name not in models:
             raise ValueError('no reactor with name {}'.format(str(reactor_name)))
         reactor_model, plates_models = models[reactor_name]
-        plate_name = self._sensors_index[reactor_name][sensor]
+        plate_name = state['sensors_index'][reactor_name][sensor]
         plate_model, sensors_models = plates_models[plate_name]
         sensor_model = sensors_models[sensor]
         if sensor_model is not None:
@@ -117,6 +181,27 @@ class ModelRepository:
     def get_sensor_prediction_model(self, reactor_name, sensor):
         return self._get_sensor_model(reactor_name, sensor, 'prediction')
 
+    def get_sensor_compiled_prediction_model(self, reactor_name, sensor):
+        return self._get_sensor_model(reactor_name, sensor, 'compiled_prediction')
+
+    def _compile_models_dict(self, models_dict):
+        compiled = self._compiled_cache
+
+        def compile_model(models):
+            if models is None:
+                return None
+            # the models object is kept next to its predictor so its id is not reused while cached
+            if id(models) not in compiled or compiled[id(models)][0] is not models:
+                compiled[id(models)] = (models, compile_prediction_models(models))
+            return compiled[id(models)][1]
+
+        reactor_model, plates_models = models_dict
+        compiled_plates_models = {}
+        for plate_name, (plate_model, sensors_models) in plates_models.items():
+            compiled_sensors_models = {sensor: compile_model(model) for sensor, model in sensors_models.items()}
+            compiled_plates_models[plate_name] = (compile_model(plate_model), compiled_sensors_models)
+        return compile_model(reactor_model), compiled_plates_models
+
     @staticmethod
     def _build_models_dict(models_loader, reactor):
         reactor_name = reactor.get_name()
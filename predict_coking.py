@@ -1,27 +1,92 @@
+import argparse
+import logging
 import sys
 import warnings
 
-import pandas as pd
-
 import constants
 import exceptions
-from dao import Dao
-from data_processing import DataPreprocessor, DataPostprocessor
-from datasource.data_handling import InputDataHandler, OutputDataHandler
-from features.features_extraction import FeaturesExtractor
-from model.models_repository import ModelRepository
-from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# move to features postprocessor
+EXCLUDED_FEATURES = ['Бутадиен-1,3, %', 'Массовая доля суммы углеводородов С5 и выше, %']
+FEATURES_ORDER = ['Массовая доля CrO3, %', 'Массовая доля кокса, %', 'Объёмная доля кислорода, %',
+                  'Объёмная доля СО2, %', 'Водород, %', 'Водород, %_coef', 'Водород, %_intercept', 'Азот N2, %',
+                  'Азот N2, %_coef', 'Азот N2, %_intercept', 'Окись углерода, %', 'Окись углерода, %_coef',
+                  'Окись углерода, %_intercept', 'Метан, %', 'Метан, %_coef', 'Метан, %_intercept',
+                  'Сумма этан+этилен, %', 'Сумма этан+этилен, %_coef', 'Сумма этан+этилен, %_intercept',
+                  'Двуокись углерода, %', 'Двуокись углерода, %_coef', 'Двуокись углерода, %_intercept',
+                  'Сумма углеводородов С3, %', 'Сумма углеводородов С3, %_coef',
+                  'Сумма углеводородов С3, %_intercept', 'Изобутан, %', 'Изобутан, %_coef', 'Изобутан, %_intercept',
+                  'н-Бутан, %', 'н-Бутан, %_coef', 'н-Бутан, %_intercept', 'Бутен1+изобутилен, %',
+                  'Бутен1+изобутилен, %_coef', 'Бутен1+изобутилен, %_intercept', 'Сумма бутиленов, %',
+                  'Сумма бутиленов, %_coef', 'Сумма бутиленов, %_intercept', 'Бутадиен-1,3, %_coef',
+                  'Бутадиен-1,3, %_intercept', 'Массовая доля суммы углеводородов С5 и выше, %_coef',
+                  'Массовая доля суммы углеводородов С5 и выше, %_intercept', 'Температура_0', 'Температура_1',
+                  'Температура_2', 'Температура_3', 'Температура_4', 'duration', 'delta_top', 'delta_bot', 'angle1',
+                  'angle2', 'angle3', 'angle4']
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='Predict coking probabilities for isobutane reactor sensors')
+    parser.add_argument('settings_path', help='path to settings .ini file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log stages timings')
+    return parser.parse_args(argv)
+
+
+def extract_sensor_features(models_repo, reactor, sensor_id, temps, chemical, duration_origin=None):
+    from features.features_extraction import FeaturesExtractor
+
+    reactor_name = reactor.get_name()
+    nn_extractor = models_repo.get_sensor_keras_model(reactor_name, sensor_id)
+    trends_extractor, = models_repo.get_sensor_features_model(reactor_name, sensor_id)
+    features_extractor = FeaturesExtractor(nn_extractor, trends_extractor, EXCLUDED_FEATURES)
+    # maybe some features postprocessing
+    return features_extractor.extract(temps, chemical, sensor_id, reactor,
+                                      duration_origin=duration_origin)[FEATURES_ORDER]
+
+
+def predict_sensor_features(models_repo, reactor, sensor_id, features):
+    import pandas as pd
+
+    predictor = models_repo.get_sensor_compiled_prediction_model(reactor.get_name(), sensor_id)
+    return pd.DataFrame(predictor.predict_positive_proba(features), index=features.index,
+                        columns=['{}:{}'.format(sensor_id, horizon) for horizon in predictor.get_horizons()])
+
+
+def predict_sensor(models_repo, reactor, sensor_id, temps, chemical, duration_origin=None):
+    features = extract_sensor_features(models_repo, reactor, sensor_id, temps, chemical, duration_origin)
+    return predict_sensor_features(models_repo, reactor, sensor_id, features)
+
+
+def _warn_no_new_data(last_output_datetime):
+    warnings.warn('no new data since last prediction {}'.format(str(last_output_datetime)),
+                  exceptions.NoNewDataWarning)
 
 
 def main(argv):
-    settings_path = argv[0]
-    settings = Settings(settings_path)
+    args = _parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    # heavy modules are imported by the stage that needs them to keep early exits cheap
+    from snapshot import ConfigurationSnapshot
+
+    settings, dao = ConfigurationSnapshot(args.settings_path).load()
     reactor_name = settings.get_reactor_name()
     bad_sensors = settings.get_excluded_sensors()
 
-    dao = Dao()
-    reactors = dao.get_reactors_dao().findall()
-    models_repo = ModelRepository(reactors, settings)
+    from idle_check import IdleRunCheck
+
+    # runs without new or late rows, the most common ones, exit before pandas and the late data scan are loaded
+    idle_datetime = IdleRunCheck(settings).find_idle_datetime()
+    if idle_datetime is not None:
+        _warn_no_new_data(idle_datetime)
+        return 1
+
+    from data_processing import DataPreprocessor, DataPostprocessor
+    from datasource.data_handling import InputDataHandler, OutputDataHandler
+
     preprocessor = DataPreprocessor(dao)
     reactor = dao.get_reactors_dao().find(reactor_name).exclude_sensors(bad_sensors)
     sensor_list = reactor.get_sensor_list()
@@ -29,60 +94,120 @@ def main(argv):
     input_data_handler = InputDataHandler(settings)
     output_data_handler = OutputDataHandler(settings)
 
+    from late_data import LateDataTracker
+
     last_output_datetime = output_data_handler.find_last_prediction_datetime()
+    late_data_tracker = LateDataTracker(input_data_handler, output_data_handler, dao, reactor)
+    late_data_plan = late_data_tracker.find_changes(last_output_datetime)
+    # late rows are recomputed together with new ones, so data is read from the earliest changed range,
+    # which grows to the measurements interpolated with changed ones and is read again until it is covered
+    read_since_datetime = None
+    raw_chemical = None
+    while read_since_datetime is None or late_data_plan.get_read_since(last_output_datetime) < read_since_datetime:
+        read_since_datetime = late_data_plan.get_read_since(last_output_datetime)
+        since_analysis_datetime = read_since_datetime
+        if last_output_datetime != constants.MIN_DATETIME:
+            since_analysis_datetime = read_since_datetime - constants.ANALYSIS_HISTORY
+        raw_chemical = input_data_handler.get_analysis(since_datetime=since_analysis_datetime)
+        late_data_plan.extend_analysis_interpolation(raw_chemical)
     since_temperatures_datetime = None
-    since_analysis_datetime = last_output_datetime
     if last_output_datetime != constants.MIN_DATETIME:
-        since_temperatures_datetime = last_output_datetime - constants.TEMPERATURES_HISTORY
-        since_analysis_datetime = last_output_datetime - constants.ANALYSIS_HISTORY
-
-    raw_chemical = input_data_handler.get_analysis(since_datetime=since_analysis_datetime)
-    chemical = preprocessor.process_analysis(reactor_name, raw_chemical, last_output_datetime)
-    if chemical.shape[0] == 0:
-        warnings.warn('no new data since last prediction {}'.format(str(last_output_datetime)),
-                      exceptions.NoNewDataWarning)
+        since_temperatures_datetime = read_since_datetime - constants.TEMPERATURES_HISTORY
+
+    # recomputed predictions also need the analysis trends before the earliest changed range
+    all_chemical = preprocessor.process_analysis(reactor_name, raw_chemical)
+    chemical = all_chemical.loc[all_chemical.index > last_output_datetime]
+    if chemical.shape[0] == 0 and late_data_plan.is_empty():
+        _warn_no_new_data(last_output_datetime)
         return 1
+    recompute_duration_origin = None
+    if not late_data_plan.is_empty():
+        logger.info(late_data_plan.get_report())
+        # recomputed rows count duration from the first analysis like a run from scratch,
+        # so they do not depend on where the late rows landed
+        recompute_duration_origin = input_data_handler.find_first_analysis_datetime()
+
+    from model.models_repository import ModelRepository
+    from scheduling import StageScheduler
 
-    raw_temps = input_data_handler.get_temperatures(since_datetime=since_temperatures_datetime)
-    temps = preprocessor.process_temperatures(reactor_name, raw_temps)
-    predictions = pd.DataFrame()
-
-    # move to features postprocessor
-    excluded_features = ['Бутадиен-1,3, %', 'Массовая доля суммы углеводородов С5 и выше, %']
-    features_order = ['Массовая доля CrO3, %', 'Массовая доля кокса, %', 'Объёмная доля кислорода, %',
-                      'Объёмная доля СО2, %', 'Водород, %', 'Водород, %_coef', 'Водород, %_intercept', 'Азот N2, %',
-                      'Азот N2, %_coef', 'Азот N2, %_intercept', 'Окись углерода, %', 'Окись углерода, %_coef',
-                      'Окись углерода, %_intercept', 'Метан, %', 'Метан, %_coef', 'Метан, %_intercept',
-                      'Сумма этан+этилен, %', 'Сумма этан+этилен, %_coef', 'Сумма этан+этилен, %_intercept',
-                      'Двуокись углерода, %', 'Двуокись углерода, %_coef', 'Двуокись углерода, %_intercept',
-                      'Сумма углеводородов С3, %', 'Сумма углеводородов С3, %_coef',
-                      'Сумма углеводородов С3, %_intercept', 'Изобутан, %', 'Изобутан, %_coef', 'Изобутан, %_intercept',
-                      'н-Бутан, %', 'н-Бутан, %_coef', 'н-Бутан, %_intercept', 'Бутен1+изобутилен, %',
-                      'Бутен1+изобутилен, %_coef', 'Бутен1+изобутилен, %_intercept', 'Сумма бутиленов, %',
-                      'Сумма бутиленов, %_coef', 'Сумма бутиленов, %_intercept', 'Бутадиен-1,3, %_coef',
-                      'Бутадиен-1,3, %_intercept', 'Массовая доля суммы углеводородов С5 и выше, %_coef',
-                      'Массовая доля суммы углеводородов С5 и выше, %_intercept', 'Температура_0', 'Температура_1',
-                      'Температура_2', 'Температура_3', 'Температура_4', 'duration', 'delta_top', 'delta_bot', 'angle1',
-                      'angle2', 'angle3', 'angle4']
-
-    for sensor_id in sensor_list:
-        nn_extractor = models_repo.get_sensor_keras_model(reactor_name, sensor_id)
+    postprocessor = DataPostprocessor(reactor)
+    # every sensor is predicted for all new analysis timestamps, so the run bound is known in advance
+    last_new_prediction_datetime = chemical.index.max() if chemical.shape[0] > 0 else None
+    # inputs are fingerprinted before temperatures are read, rows landing in between are only seen as changed later
+    fingerprints_until_datetime = last_new_prediction_datetime or last_output_datetime
+    fingerprints = late_data_tracker.take_fingerprints(fingerprints_until_datetime)
+
+    def read_temperatures():
+        return input_data_handler.get_temperatures(since_datetime=since_temperatures_datetime)
+
+    def process_temperatures(raw_temps):
+        return preprocessor.process_temperatures(reactor_name, raw_temps)
+
+    def load_models():
+        return ModelRepository(dao.get_reactors_dao().findall(), settings)
+
+    def predict_sensor_with_recompute(models_repo, temps, sensor_id):
+        # new rows are predicted like in a run without late data, recomputed ones like in a run from scratch
+        predictions = None
+        if chemical.shape[0] > 0:
+            predictions = postprocessor.process_predictions(
+                predict_sensor(models_repo, reactor, sensor_id, temps, chemical)
+            )
         trends_extractor, = models_repo.get_sensor_features_model(reactor_name, sensor_id)
-        features_extractor = FeaturesExtractor(nn_extractor, trends_extractor, excluded_features)
-        predictions_dict = {}
-        models = models_repo.get_sensor_prediction_model(reactor_name, sensor_id)
-        features = features_extractor.extract(temps, chemical, sensor_id, reactor)[features_order]
-        # maybe some features postprocessing
-        for horizon, model in models.items():
-            predictions_dict['{}:{}'.format(sensor_id, horizon)] = model.predict_proba(features)[:, 1]
+        recompute_range = late_data_plan.get_predictions_range(sensor_id, trends_extractor.get_period())
+        if recompute_range is None:
+            return predictions, None, None
+        # smoothing of the first recomputed predictions needs the preceding ones and their analysis trends
+        since_datetime = recompute_range[0] - constants.PREDICTION_SMOOTHING_PERIOD - trends_extractor.get_period()
+        sensor_chemical = all_chemical.loc[(all_chemical.index > since_datetime)
+                                           & (all_chemical.index <= recompute_range[1])]
+        if sensor_chemical.shape[0] == 0:
+            return predictions, None, None
+        recomputed_predictions = postprocessor.process_predictions(
+            predict_sensor(models_repo, reactor, sensor_id, temps, sensor_chemical, recompute_duration_origin)
+        )
+        return predictions, recomputed_predictions, recompute_range
 
-        predictions = predictions.merge(pd.DataFrame(predictions_dict, index=features.index),
-                                        left_index=True, right_index=True, how='outer')
+    def write_predictions(models_repo, temps):
+        with output_data_handler.open_predictions_writer(last_output_datetime) as predictions_writer:
+            for sensor_id in sensor_list:
+                sensor_predictions, recomputed_predictions, recompute_range = \
+                    predict_sensor_with_recompute(models_repo, temps, sensor_id)
+                if sensor_predictions is not None:
+                    predictions_writer.write(sensor_predictions)
+                if recompute_range is not None:
+                    output_data_handler.replace_predictions(recomputed_predictions, *recompute_range)
+        return predictions_writer.get_last_written_datetime()
 
-    postprocessor = DataPostprocessor(reactor)
-    predictions_renamed = postprocessor.process_predictions(predictions)
-    temps_renamed = postprocessor.process_temperatures(temps)
-    output_data_handler.update_predictions_and_statistics(predictions_renamed, temps_renamed)
+    def build_statistics(temps):
+        temps_renamed = postprocessor.process_temperatures(temps)
+        if last_new_prediction_datetime is None:
+            return temps_renamed, None
+        return temps_renamed, OutputDataHandler.build_statistics(temps_renamed, last_output_datetime,
+                                                                 last_new_prediction_datetime)
+
+    def commit_run(statistics, last_written_datetime):
+        temps_renamed, run_statistics = statistics
+        statistics_range = late_data_plan.get_statistics_range()
+        if statistics_range is not None:
+            output_data_handler.replace_statistics(temps_renamed, *statistics_range)
+        if last_written_datetime is not None:
+            output_data_handler.commit_run(run_statistics, last_written_datetime)
+        # fingerprints move only with the watermark they were taken for, otherwise the next run compares again
+        if (last_written_datetime or last_output_datetime) == fingerprints_until_datetime:
+            late_data_tracker.store_fingerprints(fingerprints, fingerprints_until_datetime)
+
+    scheduler = StageScheduler()
+    scheduler.add('read_temperatures', read_temperatures) \
+        .add('load_models', load_models) \
+        .add('process_temperatures', process_temperatures, ['read_temperatures']) \
+        .add('statistics', build_statistics, ['process_temperatures']) \
+        .add('predictions', write_predictions, ['load_models', 'process_temperatures']) \
+        .add('commit', commit_run, ['statistics', 'predictions'])
+    try:
+        scheduler.run()
+    finally:
+        logger.info(scheduler.get_report())
     return 0
 
 
@@ -0,0 +1,51 @@
+import signal
+import threading
+import time
+import warnings
+
+import constants
+import exceptions
+
+
+class HotReloader:
+    """Reloads changed dictionaries and models of a long running process between its work cycles
+
+    Checks run on every poll interval or after SIGHUP, reloading is never done in the middle of a cycle.
+    """
+
+    def __init__(self, dao, models_repo, poll_interval=constants.HOT_RELOAD_POLL_INTERVAL):
+        self._dao = dao
+        self._models_repo = models_repo
+        self._poll_interval = poll_interval
+        self._requested = threading.Event()
+        self._checked_at = time.monotonic()
+
+    def install_signal_handler(self):
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.request())
+
+    def request(self):
+        self._requested.set()
+
+    def _is_check_due(self):
+        if self._requested.is_set():
+            return True
+        return self._poll_interval is not None and self._poll_interval > 0 \
+            and time.monotonic() - self._checked_at >= self._poll_interval
+
+    def reload_if_needed(self):
+        if not self._is_check_due():
+            return False, False
+        requested = self._requested.is_set()
+        self._requested.clear()
+        self._checked_at = time.monotonic()
+        try:
+            dao_changed = self._dao.reload()
+            models_changed = False
+            if dao_changed or requested or self._models_repo.has_changes():
+                models_changed = self._models_repo.reload(self._dao.get_reactors_dao().findall())
+        except OSError as e:
+            # files may be in the middle of a deployment, they are checked again on the next poll
+            warnings.warn('hot reload check failed: {}'.format(str(e)), exceptions.MissingComponentsWarning)
+            return False, False
+        return dao_changed, models_changed
@@ -0,0 +1,236 @@
+import argparse
+import configparser
+import datetime
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import constants
+import exceptions
+import predict_coking
+from dao import Dao
+from datasource.data_handling import OutputDataHandler
+from datasource.source import SQLSource
+from settings import Settings
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    return float(np.percentile(values, q))
+
+
+class ReplayMetrics:
+    def __init__(self):
+        self._cycles = []
+        self._lags = []
+        self._catch_ups = []
+
+    def add_cycle(self, started_at, duration, processed_rows, landed_lags):
+        self._cycles.append((started_at, duration, processed_rows))
+        self._lags += landed_lags
+
+    def add_catch_up(self, gap_end, duration):
+        self._catch_ups.append((gap_end, duration))
+
+    def get_report(self):
+        durations = [duration for _, duration, _ in self._cycles]
+        rows = sum(processed_rows for _, _, processed_rows in self._cycles)
+        lines = ['cycles: {}'.format(len(self._cycles))]
+        if durations:
+            lines.append('cycle duration: p50 {:.3f} s, max {:.3f} s'.format(_percentile(durations, 50),
+                                                                            max(durations)))
+            lines.append('throughput: {:.1f} input rows/s'.format(rows / max(sum(durations), 1e-9)))
+        if self._lags:
+            lines.append('arrival to prediction lag: p50 {:.3f} s, p99 {:.3f} s, max {:.3f} s'.format(
+                _percentile(self._lags, 50), _percentile(self._lags, 99), max(self._lags)))
+        for gap_end, duration in self._catch_ups:
+            lines.append('catch-up after gap ending at {}: {}'.format(
+                gap_end, 'not reached' if duration is None else '{:.3f} s'.format(duration)))
+        return '\n'.join(lines)
+
+
+class SyntheticHistorian:
+    def __init__(self, settings, dao, since_datetime, days, analysis_period=datetime.timedelta(hours=4)):
+        reactor_name = settings.get_reactor_name()
+        random_state = np.random.RandomState(0)
+        temperatures_index = pd.date_range(since_datetime, since_datetime + datetime.timedelta(days=days),
+                                           freq='1min', name=constants.INPUT_DATETIME_COLUMN)
+        temperatures_tags = list(dao.get_temperatures_tags_dao().findall()[reactor_name].keys())
+        drift = np.cumsum(random_state.normal(0., 0.05, (len(temperatures_index), len(temperatures_tags))), axis=0)
+        self._tables = {
+            'temperatures': pd.DataFrame(550. + drift + random_state.normal(0., 1., drift.shape),
+                                         index=temperatures_index, columns=temperatures_tags)
+        }
+        analysis_index = pd.date_range(since_datetime, temperatures_index[-1], freq=analysis_period,
+                                       name=constants.INPUT_DATETIME_COLUMN)
+        analysis_tags = list(dao.get_chemical_analysis_tags_dao().findall()[reactor_name].keys())
+        analysis_tables = [table_type for table_type in settings.get_input_tables() if table_type != 'temperatures']
+        for i, table_type in enumerate(analysis_tables):
+            table_tags = analysis_tags[i::len(analysis_tables)]
+            self._tables[table_type] = pd.DataFrame(random_state.uniform(0., 10., (len(analysis_index),
+                                                                                   len(table_tags))),
+                                                    index=analysis_index, columns=table_tags)
+
+    def get_tables(self):
+        return self._tables
+
+
+class RecordedHistorian:
+    def __init__(self, settings, path):
+        self._tables = {}
+        for table_type in settings.get_input_tables():
+            table_path = os.path.join(path, '{}.csv'.format(table_type))
+            self._tables[table_type] = pd.read_csv(table_path, index_col=constants.INPUT_DATETIME_COLUMN,
+                                                   parse_dates=[constants.INPUT_DATETIME_COLUMN]).sort_index()
+
+    def get_tables(self):
+        return self._tables
+
+
+class ReplayHarness:
+    def __init__(self, settings_path, workdir, historian_tables, speed, cycle_interval, gaps=()):
+        self._settings_path = ReplayHarness._build_replay_settings(settings_path, workdir)
+        self._settings = Settings(self._settings_path)
+        self._tables = historian_tables
+        self._speed = speed
+        self._cycle_interval = cycle_interval
+        self._gaps = sorted(gaps)
+        self._input_source = SQLSource(self._settings.get_input(), constants.INPUT_DATETIME_COLUMN)
+        self._output_data_handler = OutputDataHandler(self._settings)
+        self._table_names = self._settings.get_input_tables()
+        self._written_until = None
+        self._arrivals = {}
+        self._metrics = ReplayMetrics()
+
+    @staticmethod
+    def _build_replay_settings(settings_path, workdir):
+        os.makedirs(workdir, exist_ok=True)
+        config = configparser.ConfigParser()
+        config.read(settings_path)
+        # only connections are replaced, read and write options of the replayed pipeline are kept
+        for section, database in [('INPUT', 'input.db'), ('OUTPUT', 'output.db')]:
+            config[section].update({'db_type': 'sqlite', 'hostname': '', 'username': '', 'password': '', 'port': '',
+                                    'database': os.path.abspath(os.path.join(workdir, database))})
+        replay_settings_path = os.path.join(workdir, 'settings.replay.ini')
+        with open(replay_settings_path, 'w') as f:
+            config.write(f)
+        return replay_settings_path
+
+    def _get_start_datetime(self):
+        return min(table.index.min() for table in self._tables.values())
+
+    def _get_end_datetime(self):
+        return max(table.index.max() for table in self._tables.values())
+
+    def _feed(self, until_datetime):
+        arrived_at = time.monotonic()
+        for table_type, table in self._tables.items():
+            new_rows = table.loc[table.index <= until_datetime]
+            if self._written_until is not None:
+                new_rows = new_rows.loc[new_rows.index > self._written_until]
+            self._input_source.write_new_data(self._table_names[table_type], new_rows)
+            if table_type != 'temperatures':
+                for dt in new_rows.index:
+                    self._arrivals.setdefault(dt, arrived_at)
+        self._written_until = until_datetime
+
+    def _count_rows(self, since_datetime, until_datetime):
+        return sum(int(((table.index > since_datetime) & (table.index <= until_datetime)).sum())
+                   for table in self._tables.values())
+
+    def _run_cycle(self):
+        last_datetime = self._output_data_handler.find_last_prediction_datetime()
+        started_at = time.monotonic()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', exceptions.NoNewDataWarning)
+            predict_coking.main([self._settings_path])
+        finished_at = time.monotonic()
+        new_last_datetime = self._output_data_handler.find_last_prediction_datetime()
+        landed = [dt for dt in self._arrivals if last_datetime < dt <= new_last_datetime]
+        lags = [finished_at - self._arrivals.pop(dt) for dt in landed]
+        self._metrics.add_cycle(started_at, finished_at - started_at,
+                                self._count_rows(last_datetime, new_last_datetime), lags)
+        return new_last_datetime
+
+    def run(self):
+        start_datetime = self._get_start_datetime()
+        end_datetime = self._get_end_datetime()
+        started_at = time.monotonic()
+        last_datetime = constants.MIN_DATETIME
+        gap_end = None
+        catch_up_started_at = None
+        catch_up_target = None
+        gaps = list(self._gaps)
+        while True:
+            elapsed = datetime.timedelta(seconds=(time.monotonic() - started_at) * self._speed)
+            simulated_datetime = start_datetime + elapsed
+            self._feed(min(simulated_datetime, end_datetime))
+            if gaps and gaps[0][0] <= simulated_datetime:
+                # a gap starting while a cycle ran is entered late rather than skipped, so gaps shorter
+                # than a cycle still hold the following cycles back
+                gap_end = gaps[0][1]
+                if simulated_datetime < gap_end:
+                    time.sleep(self._cycle_interval)
+                    continue
+                gaps.pop(0)
+            if gap_end is not None and catch_up_started_at is None:
+                catch_up_started_at = time.monotonic()
+                catch_up_target = max(self._arrivals) if self._arrivals else last_datetime
+            previous_last_datetime = last_datetime
+            last_datetime = self._run_cycle()
+            if catch_up_started_at is not None and last_datetime >= catch_up_target:
+                self._metrics.add_catch_up(gap_end, time.monotonic() - catch_up_started_at)
+                gap_end, catch_up_started_at = None, None
+            if simulated_datetime >= end_datetime and (not self._arrivals or last_datetime == previous_last_datetime):
+                break
+            time.sleep(self._cycle_interval)
+        if gap_end is not None:
+            self._metrics.add_catch_up(gap_end, None)
+        return self._metrics
+
+
+def _parse_gap(value):
+    start, duration = value.split(':')
+    return float(start), float(duration)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='Replay historian data into a local database '
+                                                 'while repeatedly running the prediction cycle')
+    parser.add_argument('settings_path', help='path to settings .ini file providing reactor and models')
+    parser.add_argument('--workdir', default='replay', help='directory for local databases and settings')
+    parser.add_argument('--dataset', default=None,
+                        help='directory with <input table type>.csv files, synthetic data is used if not set')
+    parser.add_argument('--synthetic-days', type=float, default=3.)
+    parser.add_argument('--speed', type=float, default=3600.,
+                        help='simulated seconds per wall clock second')
+    parser.add_argument('--cycle-interval', type=float, default=1., help='wall clock seconds between cycles')
+    parser.add_argument('--gap', type=_parse_gap, action='append', default=[],
+                        help='simulated outage as <start hours>:<duration hours> from the replay start')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_args(argv)
+    settings = Settings(args.settings_path)
+    if args.dataset is not None:
+        historian = RecordedHistorian(settings, args.dataset)
+    else:
+        historian = SyntheticHistorian(settings, Dao(), datetime.datetime(2020, 1, 1), args.synthetic_days)
+    tables = historian.get_tables()
+    start_datetime = min(table.index.min() for table in tables.values())
+    gaps = [(start_datetime + datetime.timedelta(hours=start),
+             start_datetime + datetime.timedelta(hours=start + duration))
+            for start, duration in args.gap]
+    harness = ReplayHarness(args.settings_path, args.workdir, tables, args.speed, args.cycle_interval, gaps)
+    print(harness.run().get_report())
+    return 0
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
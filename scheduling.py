@@ -0,0 +1,94 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import constants
+
+
+class Stage:
+    def __init__(self, name, function, dependencies):
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.started_at = None
+        self.finished_at = None
+
+    def get_duration(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+class StageScheduler:
+    def __init__(self, max_workers=constants.STAGES_MAX_WORKERS):
+        self._max_workers = max_workers
+        self._stages = {}
+        self._started_at = None
+        self._finished_at = None
+
+    def add(self, name, function, dependencies=()):
+        if name in self._stages:
+            raise ValueError('stage {} is already added'.format(name))
+        missing_dependencies = [dependency for dependency in dependencies if dependency not in self._stages]
+        if missing_dependencies:
+            raise ValueError('stage {} depends on unknown stages {}'.format(name, missing_dependencies))
+        self._stages[name] = Stage(name, function, dependencies)
+        return self
+
+    def _run_stage(self, stage, results):
+        stage.started_at = time.monotonic()
+        try:
+            return stage.function(*[results[dependency] for dependency in stage.dependencies])
+        finally:
+            stage.finished_at = time.monotonic()
+
+    def run(self):
+        results = {}
+        pending = dict(self._stages)
+        running = {}
+        self._started_at = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        try:
+            while pending or running:
+                ready = [stage for stage in pending.values()
+                         if all(dependency in results for dependency in stage.dependencies)]
+                for stage in ready:
+                    del pending[stage.name]
+                    running[executor.submit(self._run_stage, stage, results)] = stage
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    # a failed stage fails the run at once, its dependants are never started
+                    results[stage.name] = future.result()
+        finally:
+            self._finished_at = time.monotonic()
+            # stages still running after a failure are not waited for, queued ones are cancelled
+            executor.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def get_critical_path(self):
+        finished_stages = [stage for stage in self._stages.values() if stage.finished_at is not None]
+        if not finished_stages:
+            return []
+        stage = max(finished_stages, key=lambda s: s.finished_at)
+        path = [stage]
+        while stage.dependencies:
+            # stages of a failed run may depend on ones that never finished
+            finished_dependencies = [self._stages[dependency] for dependency in stage.dependencies
+                                     if self._stages[dependency].finished_at is not None]
+            if not finished_dependencies:
+                break
+            stage = max(finished_dependencies, key=lambda s: s.finished_at)
+            path.append(stage)
+        return [stage.name for stage in reversed(path)]
+
+    def get_report(self):
+        lines = ['stages finished in {:.3f} s'.format(self._finished_at - self._started_at)]
+        for stage in sorted(self._stages.values(), key=lambda s: (s.started_at is None, s.started_at)):
+            if stage.get_duration() is None:
+                lines.append('  {}: not finished'.format(stage.name))
+                continue
+            lines.append('  {}: started at +{:.3f} s, took {:.3f} s'.format(stage.name,
+                                                                           stage.started_at - self._started_at,
+                                                                           stage.get_duration()))
+        lines.append('critical path: {}'.format(' -> '.join(self.get_critical_path())))
+        return '\n'.join(lines)
@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import datetime
+import json
+import sys
+import time
+from collections import deque, defaultdict
+
+import pandas as pd
+
+import constants
+import exceptions
+from data_processing import DataPreprocessor
+from datasource.data_handling import InputDataHandler
+from features.features_extraction import calculate_duration
+from model.models_repository import ModelRepository
+from predict_coking import extract_sensor_features, predict_sensor_features
+from reloading import HotReloader
+from snapshot import ConfigurationSnapshot
+
+DATA_HISTORY = max(constants.TEMPERATURES_HISTORY, constants.ANALYSIS_HISTORY)
+
+
+class LatencyTracker:
+    def __init__(self, window=constants.SCORING_LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._requests_number = 0
+        self._batches_number = 0
+
+    def add_request(self, latency):
+        self._latencies.append(latency)
+        self._requests_number += 1
+
+    def add_batch(self):
+        self._batches_number += 1
+
+    @staticmethod
+    def _percentile(sorted_values, q):
+        if not sorted_values:
+            return None
+        return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+    def get_report(self):
+        latencies = sorted(self._latencies)
+        return {
+            'requests': self._requests_number,
+            'batches': self._batches_number,
+            'p50_ms': None if not latencies else self._percentile(latencies, 0.5) * 1000.,
+            'p99_ms': None if not latencies else self._percentile(latencies, 0.99) * 1000.
+        }
+
+
+class _DataCache:
+    def __init__(self, settings, dao, ttl):
+        self._reactor_name = settings.get_reactor_name()
+        self._input_data_handler = InputDataHandler(settings)
+        self._preprocessor = DataPreprocessor(dao)
+        self._ttl = ttl
+        self._since_datetime = None
+        self._loaded_at = None
+        self._temperatures = None
+        self._analysis = None
+
+    def _is_valid(self, since_datetime):
+        return self._loaded_at is not None \
+            and time.monotonic() - self._loaded_at < self._ttl \
+            and since_datetime >= self._since_datetime
+
+    def get(self, since_datetime):
+        if not self._is_valid(since_datetime):
+            # data is reloaded for the requested span only, so one early request is not kept in memory for good
+            raw_analysis = self._input_data_handler.get_analysis(since_datetime=since_datetime - DATA_HISTORY)
+            raw_temperatures = self._input_data_handler.get_temperatures(since_datetime=since_datetime - DATA_HISTORY)
+            self._analysis = self._preprocessor.process_analysis(self._reactor_name, raw_analysis)
+            self._temperatures = self._preprocessor.process_temperatures(self._reactor_name, raw_temperatures)
+            self._since_datetime = since_datetime
+            self._loaded_at = time.monotonic()
+        return self._temperatures, self._analysis
+
+
+class ScoringRequest:
+    def __init__(self, reactor_name, sensor_id, since_datetime, until_datetime):
+        self.reactor_name = reactor_name
+        self.sensor_id = sensor_id
+        self.since_datetime = since_datetime
+        self.until_datetime = until_datetime
+
+    @staticmethod
+    def from_json(body):
+        params = json.loads(body)
+        return ScoringRequest(params['reactor'], params['sensor'],
+                              datetime.datetime.fromisoformat(params['since']),
+                              datetime.datetime.fromisoformat(params['until']))
+
+
+class ScoringService:
+    def __init__(self, settings, dao, batch_window=constants.SCORING_BATCH_WINDOW,
+                 max_batch_size=constants.SCORING_MAX_BATCH_SIZE, data_ttl=constants.SCORING_DATA_TTL,
+                 reload_interval=constants.HOT_RELOAD_POLL_INTERVAL):
+        self._settings = settings
+        self._dao = dao
+        self._reactor_name = settings.get_reactor_name()
+        self._reactor = dao.get_reactors_dao().find(self._reactor_name)
+        self._models_repo = ModelRepository(dao.get_reactors_dao().findall(), settings)
+        self._data_ttl = data_ttl
+        self._data_cache = _DataCache(settings, dao, data_ttl)
+        self._reloader = HotReloader(dao, self._models_repo, reload_interval)
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        self._latency_tracker = LatencyTracker()
+        self._queue = None
+
+    def _validate(self, request):
+        if request.reactor_name != self._reactor_name:
+            raise exceptions.InvalidRequest('service is configured for reactor {}'.format(self._reactor_name))
+        try:
+            self._reactor.find_plate_number(request.sensor_id)
+        except ValueError as e:
+            raise exceptions.InvalidRequest(str(e))
+        if request.since_datetime > request.until_datetime:
+            raise exceptions.InvalidRequest('since must not be later than until')
+
+    def get_reloader(self):
+        return self._reloader
+
+    def _reload_if_needed(self):
+        dao_changed, _ = self._reloader.reload_if_needed()
+        if dao_changed:
+            self._reactor = self._dao.get_reactors_dao().find(self._reactor_name)
+            self._data_cache = _DataCache(self._settings, self._dao, self._data_ttl)
+
+    def _score_batch(self, requests):
+        # batches run one at a time, so swapping models here never affects a batch in progress
+        self._reload_if_needed()
+        temperatures, analysis = self._data_cache.get(min(request.since_datetime for request in requests))
+        requests_by_sensor = defaultdict(list)
+        for request in requests:
+            requests_by_sensor[request.sensor_id].append(request)
+        results = {}
+        for sensor_id, sensor_requests in requests_by_sensor.items():
+            try:
+                results.update(self._score_sensor_requests(sensor_id, sensor_requests, temperatures, analysis))
+            except Exception as e:
+                # requests coalesced from other clients must not fail because of one sensor
+                results.update({id(request): e for request in sensor_requests})
+        return results
+
+    def _score_sensor_requests(self, sensor_id, requests, temperatures, analysis):
+        since_datetime = min(request.since_datetime for request in requests)
+        until_datetime = max(request.until_datetime for request in requests)
+        sensor_analysis = analysis.loc[since_datetime: until_datetime]
+        if sensor_analysis.shape[0] == 0:
+            return {id(request): ScoringService._format_result(request, None) for request in requests}
+        features = extract_sensor_features(self._models_repo, self._reactor, sensor_id, temperatures, sensor_analysis)
+        # duration is measured from the first timestamp of every request, so each one gets its own rows
+        requests_features = []
+        for request in requests:
+            request_features = features.loc[request.since_datetime: request.until_datetime].copy()
+            if request_features.shape[0] > 0:
+                request_features['duration'] = calculate_duration(request_features.index)['duration']
+            requests_features.append(request_features)
+        if sum(request_features.shape[0] for request_features in requests_features) == 0:
+            return {id(request): ScoringService._format_result(request, None) for request in requests}
+        predictions = predict_sensor_features(self._models_repo, self._reactor, sensor_id,
+                                              pd.concat(requests_features))
+        results = {}
+        offset = 0
+        for request, request_features in zip(requests, requests_features):
+            rows_number = request_features.shape[0]
+            results[id(request)] = ScoringService._format_result(request,
+                                                                 predictions.iloc[offset: offset + rows_number])
+            offset += rows_number
+        return results
+
+    @staticmethod
+    def _format_result(request, predictions):
+        result = {'reactor': request.reactor_name, 'sensor': request.sensor_id, 'timestamps': [], 'probabilities': {}}
+        if predictions is None:
+            return result
+        result['timestamps'] = [str(dt) for dt in predictions.index]
+        for col in predictions.columns:
+            horizon = col.split(':')[-1]
+            result['probabilities'][horizon] = predictions[col].tolist()
+        return result
+
+    async def _collect_batch(self):
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self._batch_window.total_seconds()
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            self._latency_tracker.add_batch()
+            requests = [request for request, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self._score_batch, requests)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for request, future in batch:
+                if future.done():
+                    continue
+                result = results[id(request)]
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def score(self, request):
+        started_at = time.monotonic()
+        try:
+            self._validate(request)
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((request, future))
+            return await future
+        finally:
+            # failed requests are kept in the percentiles, otherwise slow failures would be hidden
+            self._latency_tracker.add_request(time.monotonic() - started_at)
+
+    def get_stats(self):
+        return self._latency_tracker.get_report()
+
+    async def _handle_http(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return 200, self.get_stats()
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'POST' and path == '/score':
+            try:
+                request = ScoringRequest.from_json(body)
+            except (KeyError, ValueError, TypeError) as e:
+                return 400, {'error': 'malformed request: {}'.format(str(e))}
+            # only errors of the request itself are client errors, any other one fails with 500
+            try:
+                return 200, await self.score(request)
+            except (exceptions.InvalidRequest, exceptions.MissingModel) as e:
+                return 400, {'error': str(e)}
+        return 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+
+    @staticmethod
+    async def _read_http_request(request_line, reader):
+        method, path = request_line.split(' ')[:2]
+        content_length = 0
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if not header:
+                break
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-length':
+                content_length = int(value.strip())
+        body = (await reader.readexactly(content_length)).decode('utf-8') if content_length else ''
+        return method, path, body
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            if not request_line:
+                return
+            try:
+                method, path, body = await ScoringService._read_http_request(request_line, reader)
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                status, response = 400, {'error': 'malformed request: {}'.format(str(e))}
+            else:
+                try:
+                    status, response = await self._handle_http(method, path, body)
+                except Exception as e:
+                    status, response = 500, {'error': str(e)}
+            payload = json.dumps(response, ensure_ascii=False).encode('utf-8')
+            writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'
+                         .format(status, 'OK' if status == 200 else 'Error', len(payload)).encode('latin-1'))
+            writer.write(payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host=None, port=None, unix_socket=None):
+        self._queue = asyncio.Queue()
+        batches_task = asyncio.ensure_future(self._run_batches())
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches_task.cancel()
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='Serve on-demand coking probabilities for reactor sensors')
+    parser.add_argument('settings_path', help='path to settings .ini file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=constants.SCORING_DEFAULT_PORT)
+    parser.add_argument('--unix-socket', default=None, help='listen on unix socket instead of tcp')
+    parser.add_argument('--batch-window-ms', type=float,
+                        default=constants.SCORING_BATCH_WINDOW.total_seconds() * 1000.)
+    parser.add_argument('--max-batch-size', type=int, default=constants.SCORING_MAX_BATCH_SIZE)
+    parser.add_argument('--data-ttl', type=float, default=constants.SCORING_DATA_TTL,
+                        help='seconds to keep loaded input data warm')
+    parser.add_argument('--reload-interval', type=float, default=constants.HOT_RELOAD_POLL_INTERVAL,
+                        help='seconds between checks for changed models and dictionaries, 0 reloads on SIGHUP only')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_args(argv)
+    settings, dao = ConfigurationSnapshot(args.settings_path).load()
+    service = ScoringService(settings, dao, datetime.timedelta(milliseconds=args.batch_window_ms),
+                             args.max_batch_size, args.data_ttl, args.reload_interval)
+    service.get_reloader().install_signal_handler()
+    asyncio.run(service.serve(args.host, args.port, args.unix_socket))
+    return 0
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,163 @@
+import argparse
+import datetime
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import traceback
+
+import constants
+from data_processing import DataPreprocessor, DataPostprocessor
+from datasource.data_handling import InputDataHandler, OutputDataHandler
+from datasource.source import SQLSource
+from model.models_repository import ModelRepository
+from predict_coking import predict_sensor
+from reloading import HotReloader
+from sharding.work_queue import FileWorkQueue, SQLWorkQueue, build_work_units, PENDING, LEASED
+from snapshot import ConfigurationSnapshot
+
+
+def _build_queue(settings, queue_dir):
+    if queue_dir is not None:
+        return FileWorkQueue(queue_dir)
+    table_name = settings.get_output_tables().get('work_units', constants.DEFAULT_WORK_UNITS_TABLE)
+    return SQLWorkQueue(SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN), table_name)
+
+
+class ShardWorker:
+    def __init__(self, settings, dao, queue, lease_timeout=constants.WORK_UNIT_LEASE_TIMEOUT,
+                 reload_interval=constants.HOT_RELOAD_POLL_INTERVAL):
+        self._worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._queue = queue
+        self._lease_timeout = lease_timeout
+        self._dao = dao
+        self._reactor_name = settings.get_reactor_name()
+        self._reactor = dao.get_reactors_dao().find(self._reactor_name)
+        self._models_repo = ModelRepository(dao.get_reactors_dao().findall(), settings)
+        self._preprocessor = DataPreprocessor(dao)
+        self._postprocessor = DataPostprocessor(self._reactor)
+        self._input_data_handler = InputDataHandler(settings)
+        self._output_data_handler = OutputDataHandler(settings)
+        self._reloader = HotReloader(dao, self._models_repo, reload_interval)
+
+    def get_reloader(self):
+        return self._reloader
+
+    def _reload_if_needed(self):
+        dao_changed, _ = self._reloader.reload_if_needed()
+        if dao_changed:
+            self._reactor = self._dao.get_reactors_dao().find(self._reactor_name)
+            self._preprocessor = DataPreprocessor(self._dao)
+            self._postprocessor = DataPostprocessor(self._reactor)
+
+    def process(self, unit):
+        if unit.reactor_name != self._reactor_name:
+            raise ValueError('worker is configured for reactor {}'.format(self._reactor_name))
+        # units of a plan are predicted like one run started at the plan since datetime, so duration is counted
+        # from the first analysis of the plan and smoothing reaches back to the preceding predictions but not
+        # before the plan, only rows of the unit itself are written
+        raw_chemical = self._input_data_handler.get_analysis(
+            since_datetime=unit.origin_datetime - constants.ANALYSIS_HISTORY
+        )
+        plan_chemical = self._preprocessor.process_analysis(self._reactor_name, raw_chemical, unit.origin_datetime)
+        unit_chemical = plan_chemical.loc[plan_chemical.index <= unit.until_datetime]
+        if unit_chemical.loc[unit_chemical.index > unit.since_datetime].shape[0] == 0:
+            return
+        since_datetime = unit.since_datetime - constants.PREDICTION_SMOOTHING_PERIOD
+        raw_temps = self._input_data_handler.get_temperatures(
+            since_datetime=since_datetime - constants.TEMPERATURES_HISTORY,
+            until_datetime=unit.until_datetime
+        )
+        temps = self._preprocessor.process_temperatures(self._reactor_name, raw_temps)
+        for sensor_id in unit.sensors:
+            # the preceding predictions need the analysis trends before them as well
+            trends_extractor, = self._models_repo.get_sensor_features_model(self._reactor_name, sensor_id)
+            chemical = unit_chemical.loc[unit_chemical.index > since_datetime - trends_extractor.get_period()]
+            predictions = self._postprocessor.process_predictions(
+                predict_sensor(self._models_repo, self._reactor, sensor_id, temps, chemical, plan_chemical.index[0])
+            )
+            # rows of the unit are replaced as a whole, so a retried or duplicated unit leaves no duplicates
+            self._output_data_handler.replace_predictions(predictions, unit.since_datetime, unit.until_datetime)
+
+    def run(self, exit_when_empty=False, poll_interval=constants.WORK_QUEUE_POLL_INTERVAL):
+        while True:
+            self._reload_if_needed()
+            unit = self._queue.claim(self._worker_id, self._lease_timeout)
+            if unit is None:
+                progress = self._queue.get_progress()
+                if exit_when_empty and progress[PENDING] == 0 and progress[LEASED] == 0:
+                    return
+                time.sleep(poll_interval)
+                continue
+            try:
+                self.process(unit)
+            except Exception:
+                self._queue.fail(unit.unit_id, self._worker_id, traceback.format_exc())
+                continue
+            self._queue.complete(unit.unit_id, self._worker_id)
+
+
+def _run_worker(settings_path, queue_dir, lease_timeout, exit_when_empty):
+    settings, dao = ConfigurationSnapshot(settings_path).load()
+    worker = ShardWorker(settings, dao, _build_queue(settings, queue_dir), lease_timeout)
+    worker.get_reloader().install_signal_handler()
+    worker.run(exit_when_empty)
+
+
+def _parse_datetime(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description='Sharded coking prediction over a shared work queue')
+    parser.add_argument('settings_path', help='path to settings .ini file')
+    parser.add_argument('--queue-dir', default=None,
+                        help='directory of a local file queue, a table in the output database is used if not set')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    plan = commands.add_parser('plan', help='put work units for a time range on the queue')
+    plan.add_argument('--since', type=_parse_datetime, required=True)
+    plan.add_argument('--until', type=_parse_datetime, required=True)
+    plan.add_argument('--chunk-hours', type=float, default=constants.WORK_UNIT_CHUNK.total_seconds() / 3600.)
+    plan.add_argument('--sensors-per-unit', type=int, default=constants.WORK_UNIT_SENSORS_NUMBER)
+
+    work = commands.add_parser('work', help='pull and process work units')
+    work.add_argument('--processes', type=int, default=1, help='number of local worker processes')
+    work.add_argument('--lease-minutes', type=float,
+                      default=constants.WORK_UNIT_LEASE_TIMEOUT.total_seconds() / 60.)
+    work.add_argument('--exit-when-empty', action='store_true')
+
+    commands.add_parser('progress', help='print work units counts by status')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = _parse_args(argv)
+    settings, dao = ConfigurationSnapshot(args.settings_path).load()
+    if args.command == 'plan':
+        reactor_name = settings.get_reactor_name()
+        reactor = dao.get_reactors_dao().find(reactor_name).exclude_sensors(settings.get_excluded_sensors())
+        units = build_work_units(reactor_name, reactor.get_sensor_list(), args.since, args.until,
+                                 datetime.timedelta(hours=args.chunk_hours), args.sensors_per_unit)
+        _build_queue(settings, args.queue_dir).put(units)
+        print('{} work units planned'.format(len(units)))
+    elif args.command == 'work':
+        lease_timeout = datetime.timedelta(minutes=args.lease_minutes)
+        processes = [multiprocessing.Process(target=_run_worker,
+                                             args=(args.settings_path, args.queue_dir, lease_timeout,
+                                                   args.exit_when_empty))
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        progress = _build_queue(settings, args.queue_dir).get_progress()
+        print(', '.join('{}: {}'.format(status, number) for status, number in progress.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
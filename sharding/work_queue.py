@@ -0,0 +1,286 @@
+import datetime
+import json
+import os
+import time
+
+import sqlalchemy
+
+import constants
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATUSES = [PENDING, LEASED, DONE, FAILED]
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class WorkUnit:
+    def __init__(self, unit_id, reactor_name, sensors, since_datetime, until_datetime, status=PENDING, attempts=0,
+                 worker_id=None, lease_expires_at=None, error=None, origin_datetime=None):
+        self.unit_id = unit_id
+        self.reactor_name = reactor_name
+        self.sensors = list(sensors)
+        self.since_datetime = since_datetime
+        self.until_datetime = until_datetime
+        # since datetime of the whole plan, units are predicted like one run started there
+        self.origin_datetime = since_datetime if origin_datetime is None else origin_datetime
+        self.status = status
+        self.attempts = attempts
+        self.worker_id = worker_id
+        self.lease_expires_at = lease_expires_at
+        self.error = error
+
+    def is_claimable(self, now):
+        return self.status == PENDING or (self.status == LEASED and self.lease_expires_at < now)
+
+    def to_dict(self):
+        return {
+            'unit_id': self.unit_id,
+            'reactor_name': self.reactor_name,
+            'sensors': self.sensors,
+            'since_datetime': self.since_datetime.strftime(DATETIME_FORMAT),
+            'until_datetime': self.until_datetime.strftime(DATETIME_FORMAT),
+            'origin_datetime': self.origin_datetime.strftime(DATETIME_FORMAT),
+            'status': self.status,
+            'attempts': self.attempts,
+            'worker_id': self.worker_id,
+            'lease_expires_at': None if self.lease_expires_at is None
+            else self.lease_expires_at.strftime(DATETIME_FORMAT),
+            'error': self.error
+        }
+
+    @staticmethod
+    def from_dict(params):
+        lease_expires_at = params['lease_expires_at']
+        origin_datetime = params.get('origin_datetime')
+        return WorkUnit(params['unit_id'], params['reactor_name'], params['sensors'],
+                        datetime.datetime.strptime(params['since_datetime'], DATETIME_FORMAT),
+                        datetime.datetime.strptime(params['until_datetime'], DATETIME_FORMAT),
+                        params['status'], params['attempts'], params['worker_id'],
+                        None if lease_expires_at is None else datetime.datetime.strptime(lease_expires_at,
+                                                                                         DATETIME_FORMAT),
+                        params['error'],
+                        None if origin_datetime is None else datetime.datetime.strptime(origin_datetime,
+                                                                                        DATETIME_FORMAT))
+
+
+def build_work_units(reactor_name, sensors, since_datetime, until_datetime, chunk, sensors_per_unit):
+    units = []
+    chunk_since = since_datetime
+    while chunk_since < until_datetime:
+        chunk_until = min(chunk_since + chunk, until_datetime)
+        for i in range(0, len(sensors), sensors_per_unit):
+            unit_id = '{}:{}:{}:{}'.format(reactor_name, chunk_since.strftime('%Y%m%d%H%M'),
+                                           chunk_until.strftime('%Y%m%d%H%M'), i // sensors_per_unit)
+            units.append(WorkUnit(unit_id, reactor_name, sensors[i: i + sensors_per_unit], chunk_since, chunk_until,
+                                  origin_datetime=since_datetime))
+        chunk_since = chunk_until
+    return units
+
+
+class _WorkQueue:
+    def __init__(self, max_attempts=constants.WORK_UNIT_MAX_ATTEMPTS):
+        self._max_attempts = max_attempts
+
+    def _next_status_after_failure(self, unit):
+        return PENDING if unit.attempts < self._max_attempts else FAILED
+
+
+class FileWorkQueue(_WorkQueue):
+    """Work queue kept as one JSON file per unit in a directory shared by local workers"""
+
+    LOCK_NAME = 'queue.lock'
+    UNIT_ENDING = '.json'
+
+    def __init__(self, path, max_attempts=constants.WORK_UNIT_MAX_ATTEMPTS,
+                 lock_timeout=constants.WORK_QUEUE_LOCK_TIMEOUT):
+        super().__init__(max_attempts)
+        self._path = path
+        self._lock_path = os.path.join(path, FileWorkQueue.LOCK_NAME)
+        self._lock_timeout = lock_timeout
+        os.makedirs(path, exist_ok=True)
+
+    def _lock(self):
+        while True:
+            try:
+                os.close(os.open(self._lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self._lock_path) > self._lock_timeout:
+                        os.remove(self._lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(0.01)
+
+    def _unlock(self):
+        os.remove(self._lock_path)
+
+    def _unit_path(self, unit_id):
+        return os.path.join(self._path, unit_id.replace(':', '_') + FileWorkQueue.UNIT_ENDING)
+
+    def _read_units(self):
+        units = []
+        for name in sorted(os.listdir(self._path)):
+            if name.endswith(FileWorkQueue.UNIT_ENDING):
+                with open(os.path.join(self._path, name), 'r', encoding='utf-8') as f:
+                    units.append(WorkUnit.from_dict(json.load(f)))
+        return units
+
+    def _read_unit(self, unit_id):
+        with open(self._unit_path(unit_id), 'r', encoding='utf-8') as f:
+            return WorkUnit.from_dict(json.load(f))
+
+    def _write_unit(self, unit):
+        path = self._unit_path(unit.unit_id)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(unit.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def put(self, units):
+        self._lock()
+        try:
+            for unit in units:
+                if not os.path.exists(self._unit_path(unit.unit_id)):
+                    self._write_unit(unit)
+        finally:
+            self._unlock()
+
+    def claim(self, worker_id, lease_timeout):
+        now = datetime.datetime.now()
+        self._lock()
+        try:
+            for unit in self._read_units():
+                if not unit.is_claimable(now):
+                    continue
+                if unit.attempts >= self._max_attempts:
+                    unit.status = FAILED
+                    self._write_unit(unit)
+                    continue
+                unit.status, unit.worker_id = LEASED, worker_id
+                unit.attempts += 1
+                unit.lease_expires_at = now + lease_timeout
+                self._write_unit(unit)
+                return unit
+            return None
+        finally:
+            self._unlock()
+
+    def _finish(self, unit_id, worker_id, error=None):
+        self._lock()
+        try:
+            unit = self._read_unit(unit_id)
+            if unit.status != LEASED or unit.worker_id != worker_id:
+                return False
+            unit.status = DONE if error is None else self._next_status_after_failure(unit)
+            unit.error = error
+            self._write_unit(unit)
+            return True
+        finally:
+            self._unlock()
+
+    def complete(self, unit_id, worker_id):
+        return self._finish(unit_id, worker_id)
+
+    def fail(self, unit_id, worker_id, error):
+        return self._finish(unit_id, worker_id, error)
+
+    def get_progress(self):
+        self._lock()
+        try:
+            units = self._read_units()
+        finally:
+            self._unlock()
+        return {status: sum(unit.status == status for unit in units) for status in STATUSES}
+
+
+class SQLWorkQueue(_WorkQueue):
+    """Work queue kept as a table in the output database, claims are optimistic conditional updates"""
+
+    def __init__(self, source, table_name, max_attempts=constants.WORK_UNIT_MAX_ATTEMPTS):
+        super().__init__(max_attempts)
+        self._engine = source.get_engine()
+        self._table = sqlalchemy.Table(table_name, sqlalchemy.MetaData(),
+                                       sqlalchemy.Column('unit_id', sqlalchemy.String(128), primary_key=True),
+                                       sqlalchemy.Column('unit', sqlalchemy.Text, nullable=False),
+                                       sqlalchemy.Column('status', sqlalchemy.String(16), nullable=False, index=True),
+                                       sqlalchemy.Column('attempts', sqlalchemy.Integer, nullable=False),
+                                       sqlalchemy.Column('worker_id', sqlalchemy.String(128)),
+                                       sqlalchemy.Column('lease_expires_at', sqlalchemy.DateTime))
+        self._table.create(self._engine, checkfirst=True)
+
+    def _select_units(self, connection, condition=None):
+        query = self._table.select()
+        if condition is not None:
+            query = query.where(condition)
+        units = []
+        for row in connection.execute(query).fetchall():
+            unit = WorkUnit.from_dict(json.loads(row[1]))
+            unit.status, unit.attempts, unit.worker_id, unit.lease_expires_at = row[2], row[3], row[4], row[5]
+            units.append(unit)
+        return units
+
+    def _update(self, connection, unit, condition):
+        values = {'status': unit.status, 'attempts': unit.attempts, 'worker_id': unit.worker_id,
+                  'lease_expires_at': unit.lease_expires_at,
+                  'unit': json.dumps(unit.to_dict(), ensure_ascii=False)}
+        query = self._table.update().where(sqlalchemy.and_(self._table.c.unit_id == unit.unit_id, condition))
+        return connection.execute(query.values(values)).rowcount == 1
+
+    def put(self, units):
+        with self._engine.begin() as connection:
+            existing = {unit.unit_id for unit in self._select_units(connection)}
+            for unit in units:
+                if unit.unit_id not in existing:
+                    connection.execute(self._table.insert().values(
+                        unit_id=unit.unit_id, unit=json.dumps(unit.to_dict(), ensure_ascii=False),
+                        status=unit.status, attempts=unit.attempts, worker_id=None, lease_expires_at=None))
+
+    def claim(self, worker_id, lease_timeout):
+        now = datetime.datetime.now()
+        claimable = sqlalchemy.or_(self._table.c.status == PENDING,
+                                   sqlalchemy.and_(self._table.c.status == LEASED,
+                                                   self._table.c.lease_expires_at < now))
+        with self._engine.begin() as connection:
+            candidates = self._select_units(connection, claimable)
+        for unit in candidates:
+            # the update succeeds only if no other worker claimed the unit since it was read
+            unchanged = sqlalchemy.and_(claimable, self._table.c.attempts == unit.attempts)
+            if unit.attempts >= self._max_attempts:
+                unit.status = FAILED
+                with self._engine.begin() as connection:
+                    self._update(connection, unit, unchanged)
+                continue
+            unit.status, unit.worker_id = LEASED, worker_id
+            unit.attempts += 1
+            unit.lease_expires_at = now + lease_timeout
+            with self._engine.begin() as connection:
+                if self._update(connection, unit, unchanged):
+                    return unit
+        return None
+
+    def _finish(self, unit_id, worker_id, error=None):
+        owned = sqlalchemy.and_(self._table.c.status == LEASED, self._table.c.worker_id == worker_id)
+        with self._engine.begin() as connection:
+            units = self._select_units(connection, sqlalchemy.and_(self._table.c.unit_id == unit_id, owned))
+            if not units:
+                return False
+            unit = units[0]
+            unit.status = DONE if error is None else self._next_status_after_failure(unit)
+            unit.error = error
+            return self._update(connection, unit, owned)
+
+    def complete(self, unit_id, worker_id):
+        return self._finish(unit_id, worker_id)
+
+    def fail(self, unit_id, worker_id, error):
+        return self._finish(unit_id, worker_id, error)
+
+    def get_progress(self):
+        with self._engine.begin() as connection:
+            units = self._select_units(connection)
+        return {status: sum(unit.status == status for unit in units) for status in STATUSES}
@@ -0,0 +1,51 @@
+import os
+import pickle
+
+import dao
+from dao import Dao
+from settings import Settings
+
+
+class ConfigurationSnapshot:
+    SNAPSHOT_ENDING = '.snapshot'
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, settings_path, snapshot_path=None):
+        self._settings_path = os.path.abspath(settings_path)
+        if snapshot_path is None:
+            snapshot_path = self._settings_path + ConfigurationSnapshot.SNAPSHOT_ENDING
+        self._snapshot_path = snapshot_path
+
+    def _build_key(self):
+        paths = [self._settings_path] + dao.DICT_PATHS
+        return ConfigurationSnapshot.SNAPSHOT_VERSION, tuple((path, os.stat(path).st_mtime_ns) for path in paths)
+
+    def _read(self, key):
+        try:
+            with open(self._snapshot_path, 'rb') as f:
+                saved_key, settings, saved_dao = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError):
+            return None
+        if saved_key != key:
+            return None
+        return settings, saved_dao
+
+    def _write(self, key, settings, built_dao):
+        tmp_path = '{}.{}.tmp'.format(self._snapshot_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((key, settings, built_dao), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._snapshot_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self):
+        key = self._build_key()
+        cached = self._read(key)
+        if cached is not None:
+            return cached
+        settings = Settings(self._settings_path)
+        built_dao = Dao()
+        self._write(key, settings, built_dao)
+        return settings, built_dao
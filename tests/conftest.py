@@ -0,0 +1,164 @@
+import configparser
+import datetime
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEVELOPMENT_SETTINGS_PATH = os.path.join(REPO_DIR, 'resources', 'settings.development.ini')
+
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+import aggregation  # noqa: E402
+import constants  # noqa: E402
+import exceptions  # noqa: E402
+import predict_coking  # noqa: E402
+from dao import Dao  # noqa: E402
+from datasource.source import SQLSource  # noqa: E402
+from features.features_extraction import AnalysisLinearTrendsExtractor, NN_TEMPERATURE_PREFIX  # noqa: E402
+from model.compilation import compile_prediction_models  # noqa: E402
+from replay import SyntheticHistorian  # noqa: E402
+from settings import Settings  # noqa: E402
+
+HISTORIAN_SINCE = datetime.datetime(2020, 1, 1)
+
+
+def build_settings(workdir, input_params=None, output_params=None):
+    """Writes development reactor settings with sqlite input and output databases in workdir"""
+    config = configparser.ConfigParser()
+    config.read(DEVELOPMENT_SETTINGS_PATH, encoding='utf-8')
+    for section, database, params in [('INPUT', 'input.db', input_params), ('OUTPUT', 'output.db', output_params)]:
+        config[section].update({'db_type': 'sqlite', 'hostname': '', 'username': '', 'password': '', 'port': '',
+                                'database': os.path.join(str(workdir), database)})
+        config[section].update(params or {})
+    config['OUTPUT TABLES']['plates_temperatures_std'] = 'plates_temps_std'
+    for section in ['KERAS WEIGHTS', 'FEATURES MODELS', 'PREDICTION MODELS']:
+        models_dir = os.path.join(str(workdir), section.lower().replace(' ', '_'))
+        os.makedirs(models_dir, exist_ok=True)
+        config[section]['dir'] = models_dir
+    path = os.path.join(str(workdir), 'settings.ini')
+    with open(path, 'w', encoding='utf-8') as f:
+        config.write(f)
+    return path
+
+
+@pytest.fixture
+def settings_path(tmp_path):
+    return build_settings(tmp_path)
+
+
+class Historian:
+    """Synthetic historian tables fed into the sqlite input database of the settings"""
+
+    def __init__(self, settings_path, days=3):
+        self.settings_path = settings_path
+        self.settings = Settings(settings_path)
+        self.tables = SyntheticHistorian(self.settings, Dao(), HISTORIAN_SINCE, days).get_tables()
+        self.source = SQLSource(self.settings.get_input(), constants.INPUT_DATETIME_COLUMN)
+        self._written_until = None
+
+    def feed(self, until_datetime=None):
+        for table_type, table in self.tables.items():
+            rows = table if until_datetime is None else table.loc[table.index <= until_datetime]
+            if self._written_until is not None:
+                rows = rows.loc[rows.index > self._written_until]
+            self.source.write_new_data(self.settings.get_input_tables()[table_type], rows)
+        self._written_until = until_datetime or max(table.index.max() for table in self.tables.values())
+        return self
+
+    def get_analysis_datetimes(self):
+        return self.tables['catalyst_analysis'].index
+
+
+@pytest.fixture
+def historian(settings_path):
+    return Historian(settings_path)
+
+
+class IntervalMeansExtractor:
+    """Keras free stand-in for the NN temperatures features extractor, features are plain interval means"""
+
+    def extract(self, temperature_sensor_data, timestamps):
+        interval = constants.NN_PERIOD / constants.NN_OUTPUT_FEATURES_NUMBER
+        rows = [[aggregation.mean(temperature_sensor_data.loc[dt + constants.ONE_SECOND_DELTA - interval * (i + 1):
+                                                              dt - interval * i])
+                 for i in range(constants.NN_OUTPUT_FEATURES_NUMBER)]
+                for dt in timestamps]
+        columns = [NN_TEMPERATURE_PREFIX + str(i) for i in range(constants.NN_OUTPUT_FEATURES_NUMBER)]
+        return pd.DataFrame(rows, index=timestamps, columns=columns).fillna(0.)
+
+
+class LightModelRepository:
+    """Models repository of the same models for every sensor, fitted on random data without keras"""
+
+    HORIZONS = ['24', '72']
+    TRENDS_TAGS = [feature[:-len('_coef')] for feature in predict_coking.FEATURES_ORDER if feature.endswith('_coef')]
+
+    def __init__(self, missing_sensors=()):
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.tree import DecisionTreeClassifier
+
+        random_state = np.random.RandomState(0)
+        x = random_state.normal(0., 1., (200, len(predict_coking.FEATURES_ORDER)))
+        y = (x[:, 0] + random_state.normal(0., 1., 200) > 0).astype('int64')
+        self._predictor = compile_prediction_models({
+            LightModelRepository.HORIZONS[0]: LogisticRegression().fit(x, y),
+            LightModelRepository.HORIZONS[1]: DecisionTreeClassifier(max_depth=4, random_state=0).fit(x, y)
+        })
+        self._temperatures_extractor = IntervalMeansExtractor()
+        self._trends_extractor = AnalysisLinearTrendsExtractor(constants.TWELVE_HOURS_DELTA,
+                                                               LightModelRepository.TRENDS_TAGS)
+        self._missing_sensors = set(missing_sensors)
+
+    def _check_sensor(self, reactor_name, sensor):
+        if sensor in self._missing_sensors:
+            raise exceptions.MissingModel('no model for sensor {} in reactor {} found'.format(sensor, reactor_name))
+
+    def get_sensor_keras_model(self, reactor_name, sensor):
+        self._check_sensor(reactor_name, sensor)
+        return self._temperatures_extractor
+
+    def get_sensor_features_model(self, reactor_name, sensor):
+        self._check_sensor(reactor_name, sensor)
+        return self._trends_extractor,
+
+    def get_sensor_compiled_prediction_model(self, reactor_name, sensor):
+        self._check_sensor(reactor_name, sensor)
+        return self._predictor
+
+    def has_changes(self):
+        return False
+
+    def reload(self, reactors=None):
+        return False
+
+
+class SmoothPredictor:
+    """Compiled predictor stand-in whose probabilities stay away from 0 and 1, so every feature shows in them"""
+
+    DURATION_WEIGHT = 1e-2
+
+    def __init__(self, horizons, seed=0):
+        random_state = np.random.RandomState(seed)
+        self._horizons = list(horizons)
+        # raw features range from percents to hundreds of degrees, small weights keep logits near zero
+        self._weights = random_state.normal(0., 1e-4, (len(predict_coking.FEATURES_ORDER), len(horizons)))
+        self._weights[predict_coking.FEATURES_ORDER.index('duration')] = SmoothPredictor.DURATION_WEIGHT
+
+    def get_horizons(self):
+        return list(self._horizons)
+
+    def predict_positive_proba(self, features):
+        return 1. / (1. + np.exp(-(np.asarray(features, dtype='float64') @ self._weights)))
+
+
+class SmoothModelRepository(LightModelRepository):
+    """Light models repository predicting not saturated probabilities from raw features"""
+
+    def __init__(self, missing_sensors=()):
+        super().__init__(missing_sensors)
+        self._predictor = SmoothPredictor(LightModelRepository.HORIZONS)
@@ -0,0 +1,121 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from conftest import HISTORIAN_SINCE, Historian, LightModelRepository, build_settings
+
+import aggregation
+import constants
+import predict_coking
+from datasource.source import SQLSource
+from settings import Settings
+from features.features_extraction import collect_interval_mean_temperatures, NNTemperaturesFeaturesExtractor
+
+SINCE_DATETIME = datetime.datetime(2020, 1, 1)
+TAGS = ['T1', 'T2', 'T3']
+OUTPUT_TABLES = ['predictions', 'temperatures', 'temperatures_diff', 'plates_temperatures_std', 'temperatures_std']
+
+
+class _WeightsShape:
+    input_shape = (None, constants.NN_INPUT_TIME_INTERVALS_NUMBER)
+    output_shape = (None, constants.NN_OUTPUT_FEATURES_NUMBER)
+
+    def get_layer(self, index):
+        return self
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = SQLSource({'db_type': 'sqlite', 'username': '', 'password': '', 'hostname': '', 'port': '',
+                        'database': str(tmp_path / 'input.db')}, constants.INPUT_DATETIME_COLUMN)
+    index = pd.date_range(SINCE_DATETIME, SINCE_DATETIME + datetime.timedelta(days=3), freq='1min',
+                          name=constants.INPUT_DATETIME_COLUMN)
+    random_state = np.random.RandomState(0)
+    values = 500. + np.cumsum(random_state.normal(0., 1., (len(index), len(TAGS))), axis=0)
+    source.write_new_data('temps', pd.DataFrame(values, index=index, columns=TAGS))
+    return source
+
+
+def _get_timestamps():
+    return pd.date_range(SINCE_DATETIME + datetime.timedelta(days=2), periods=6, freq='4h')
+
+
+def _read(source, bucket_minutes):
+    if bucket_minutes is None:
+        return source.get_data_since('temps')
+    return source.get_aggregated_data_since('temps', bucket_minutes)
+
+
+def test_interval_means_match_raw_rows(source):
+    raw = _read(source, None)
+    aggregated = _read(source, 1)
+    timestamps = _get_timestamps()
+    pd.testing.assert_frame_equal(
+        collect_interval_mean_temperatures(aggregated, constants.TWELVE_HOURS_DELTA, timestamps),
+        collect_interval_mean_temperatures(raw, constants.TWELVE_HOURS_DELTA, timestamps)
+    )
+
+    extractor = NNTemperaturesFeaturesExtractor(constants.NN_PERIOD, constants.NN_INPUT_TIME_INTERVALS_NUMBER,
+                                                constants.NN_OUTPUT_FEATURES_NUMBER, _WeightsShape())
+    for dt in timestamps:
+        np.testing.assert_allclose(extractor._calculate_features_row_for_datetime(aggregated['T1'], dt),
+                                   extractor._calculate_features_row_for_datetime(raw['T1'], dt))
+
+
+@pytest.mark.parametrize('bucket_minutes', [1, 5])
+def test_rolling_statistics_match_raw_rows(source, bucket_minutes):
+    raw = _read(source, None)
+    aggregated = _read(source, bucket_minutes)
+    expected_means = aggregation.rolling_mean(raw, constants.STATISTICS_SMOOTHING_PERIOD)
+    expected_stds = aggregation.rolling_std(raw, constants.TEMPERATURES_STD_PERIOD)
+    means = aggregation.rolling_mean(aggregated, constants.STATISTICS_SMOOTHING_PERIOD)
+    stds = aggregation.rolling_std(aggregated, constants.TEMPERATURES_STD_PERIOD)
+    assert means.index.isin(expected_means.index).all()
+    pd.testing.assert_frame_equal(means, expected_means.loc[means.index], check_freq=False)
+    pd.testing.assert_frame_equal(stds, expected_stds.loc[stds.index], check_freq=False)
+
+
+def test_aggregated_windows_exclude_later_rows(source):
+    timestamps = _get_timestamps()
+    before = collect_interval_mean_temperatures(_read(source, 5), constants.TWELVE_HOURS_DELTA, timestamps)
+    # rows inside the bucket starting at the last timestamp are later than every window
+    late_rows = pd.DataFrame(1000., columns=TAGS,
+                             index=pd.DatetimeIndex([timestamps[-1] + datetime.timedelta(seconds=seconds)
+                                                     for seconds in [1, 30, 299]],
+                                                    name=constants.INPUT_DATETIME_COLUMN))
+    source.write_new_data('temps', late_rows)
+    after = collect_interval_mean_temperatures(_read(source, 5), constants.TWELVE_HOURS_DELTA, timestamps)
+    pd.testing.assert_frame_equal(after, before)
+
+
+def _read_output_tables(settings):
+    output_source = SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN)
+    tables = {}
+    for table_type in OUTPUT_TABLES:
+        table = output_source.get_data_since(settings.get_output_tables()[table_type]).reset_index()
+        keys = [col for col in table.columns if table[col].dtype != 'float64']
+        tables[table_type] = table.sort_values(keys).reset_index(drop=True)
+    return tables
+
+
+def test_aggregated_run_matches_raw_run(tmp_path, monkeypatch):
+    monkeypatch.setattr('model.models_repository.ModelRepository',
+                        lambda reactors, settings: LightModelRepository())
+    # raw temperatures are one row a minute, so one minute buckets hold exactly the raw rows
+    historian = Historian(build_settings(tmp_path / 'raw'))
+    aggregated_settings_path = build_settings(tmp_path / 'aggregated',
+                                              input_params={'database': historian.settings.get_input()['database'],
+                                                            'temperatures_aggregation_minutes': '1'})
+    # the second run appends to the first one, statistics windows reach back over the previous run
+    for until_datetime in [HISTORIAN_SINCE + datetime.timedelta(days=2), None]:
+        historian.feed(until_datetime)
+        assert predict_coking.main([historian.settings_path]) == 0
+        assert predict_coking.main([aggregated_settings_path]) == 0
+
+    raw_tables = _read_output_tables(historian.settings)
+    aggregated_tables = _read_output_tables(Settings(aggregated_settings_path))
+    for table_type in OUTPUT_TABLES:
+        assert raw_tables[table_type].shape[0] > 0
+        pd.testing.assert_frame_equal(aggregated_tables[table_type], raw_tables[table_type],
+                                      check_exact=False, rtol=1e-9)
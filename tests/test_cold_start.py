@@ -0,0 +1,75 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from datasource.data_handling import OutputDataHandler
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# wall clock budgets, generous enough for a loaded machine: a whole process run for help,
+# the main call after interpreter startup for the no new data exit, which loads only sqlalchemy
+HELP_BUDGET = 0.5
+NO_NEW_DATA_BUDGET = 0.5
+HELP_FORBIDDEN_MODULES = ['pandas', 'numpy', 'sqlalchemy', 'keras', 'sklearn']
+NO_NEW_DATA_FORBIDDEN_MODULES = ['pandas', 'numpy', 'late_data', 'keras', 'sklearn', 'tensorflow', 'model']
+
+
+def _run_predict_coking(args):
+    started_at = time.monotonic()
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(REPO_DIR, 'predict_coking.py')] + args,
+                            cwd=REPO_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    duration = time.monotonic() - started_at
+    imported = {line.split('|')[-1].strip().split('.')[0] for line in result.stderr.splitlines()
+                if line.startswith('import time:')}
+    return result, duration, imported
+
+
+def _run_predict_coking_main(args):
+    """Runs predict_coking.main in a fresh interpreter, returns its result, duration and heavy modules imported"""
+    script = '\n'.join([
+        'import json, sys, time',
+        'import predict_coking',
+        'started_at = time.monotonic()',
+        'code = predict_coking.main({!r})'.format(args),
+        'duration = time.monotonic() - started_at',
+        'imported = sorted({name.split(".")[0] for name in sys.modules})',
+        'print(json.dumps([code, duration, imported]))'
+    ])
+    result = subprocess.run([sys.executable, '-c', script], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+    code, duration, imported = json.loads(result.stdout.splitlines()[-1])
+    return result, code, duration, set(imported)
+
+
+def test_help_skips_heavy_imports():
+    _run_predict_coking(['--help'])
+    result, duration, imported = _run_predict_coking(['--help'])
+    assert result.returncode == 0
+    assert 'settings_path' in result.stdout
+    assert duration < HELP_BUDGET
+    assert not imported.intersection(HELP_FORBIDDEN_MODULES)
+
+
+def test_no_new_data_exits_before_loading_models(historian):
+    historian.feed()
+    output_data_handler = OutputDataHandler(historian.settings)
+    output_data_handler.find_last_prediction_datetime()
+    last_analysis_datetime = historian.get_analysis_datetimes().max().to_pydatetime()
+    output_data_handler._sink.set_watermark(historian.settings.get_output_tables()['predictions'],
+                                            last_analysis_datetime)
+
+    # the first run builds the configuration snapshot, the budget is for the following ones
+    _run_predict_coking([historian.settings_path])
+    result, duration, imported = _run_predict_coking([historian.settings_path])
+    assert result.returncode == 0
+    assert 'NoNewDataWarning' in result.stderr
+    assert not imported.intersection(NO_NEW_DATA_FORBIDDEN_MODULES)
+
+    result, code, duration, imported = _run_predict_coking_main([historian.settings_path])
+    assert code == 1
+    assert 'NoNewDataWarning' in result.stderr
+    assert duration < NO_NEW_DATA_BUDGET
+    assert not imported.intersection(NO_NEW_DATA_FORBIDDEN_MODULES)
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import ExtraTreesClassifier, GradientBoostingClassifier, RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from model.compilation import POSITIVE_CLASS_INDEX, compile_prediction_models
+
+FEATURES_NUMBER = 6
+FEATURE_NAMES = ['feature_{}'.format(i) for i in range(FEATURES_NUMBER)]
+TOLERANCE = 1e-9
+
+MODELS = {
+    'logistic_regression': lambda: LogisticRegression(C=10.),
+    'decision_tree': lambda: DecisionTreeClassifier(max_depth=6, random_state=0),
+    'random_forest': lambda: RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0),
+    'extra_trees': lambda: ExtraTreesClassifier(n_estimators=10, max_depth=5, random_state=0),
+    'fallback': lambda: GradientBoostingClassifier(n_estimators=10, random_state=0)
+}
+
+
+def _build_dataset(rows_number, seed):
+    random_state = np.random.RandomState(seed)
+    x = random_state.normal(0., 3., (rows_number, FEATURES_NUMBER))
+    y = (x[:, 0] + 0.5 * x[:, 1] * x[:, 2] + random_state.normal(0., 1., rows_number) > 0).astype(int)
+    return pd.DataFrame(x, columns=FEATURE_NAMES), y
+
+
+def _fit(name):
+    x, y = _build_dataset(500, 0)
+    return MODELS[name]().fit(x, y)
+
+
+@pytest.mark.parametrize('name', sorted(MODELS))
+def test_compiled_model_matches_predict_proba(name):
+    model = _fit(name)
+    predictor = compile_prediction_models({'24': model})
+    # only models without a compiled evaluator keep calling predict_proba
+    assert ('24' in predictor._fallback_models) == (name == 'fallback')
+    x, _ = _build_dataset(300, 1)
+
+    expected = model.predict_proba(x)[:, POSITIVE_CLASS_INDEX]
+    np.testing.assert_allclose(predictor.predict_positive_proba(x)[:, 0], expected, atol=TOLERANCE)
+    np.testing.assert_allclose(predictor.predict_positive_proba(x.values)[:, 0], expected, atol=TOLERANCE)
+
+
+def test_mixed_horizons_keep_their_order():
+    models = {str(24 * (i + 1)): _fit(name) for i, name in enumerate(sorted(MODELS))}
+    models['240'] = _fit('logistic_regression')
+    predictor = compile_prediction_models(models)
+    x, _ = _build_dataset(300, 2)
+
+    probabilities = predictor.predict_positive_proba(x)
+    for i, horizon in enumerate(predictor.get_horizons()):
+        np.testing.assert_allclose(probabilities[:, i], models[horizon].predict_proba(x)[:, POSITIVE_CLASS_INDEX],
+                                   atol=TOLERANCE)
+
+
+def test_large_decision_values_do_not_overflow():
+    predictor = compile_prediction_models({'24': _fit('logistic_regression')})
+    x = np.full((2, FEATURES_NUMBER), 1e6)
+    x[1] *= -1
+    with np.errstate(over='raise'):
+        probabilities = predictor.predict_positive_proba(x)
+    assert np.isfinite(probabilities).all()
+
+
+def _predict_or_error(predict, x):
+    try:
+        return predict(x)[:, -1], None
+    except ValueError as e:
+        return None, str(e).splitlines()[0]
+
+
+@pytest.mark.parametrize('name', ['logistic_regression', 'decision_tree', 'random_forest', 'extra_trees'])
+@pytest.mark.parametrize('value', [np.nan, np.inf, 1e300])
+@pytest.mark.parametrize('rows', [[1], [0, 2], [0, 1, 2]])
+def test_non_finite_features_match_predict_proba(name, value, rows):
+    model = _fit(name)
+    predictor = compile_prediction_models({'24': model})
+    x, _ = _build_dataset(3, 1)
+    x.iloc[rows, 2] = value
+
+    # rows with missing values are predicted like sklearn does or rejected with its message
+    expected, expected_error = _predict_or_error(model.predict_proba, x)
+    probabilities, error = _predict_or_error(predictor.predict_positive_proba, x)
+    assert error == expected_error
+    if expected is not None:
+        np.testing.assert_allclose(probabilities, expected, atol=TOLERANCE)
+
+
+def test_missing_values_are_routed_like_sklearn():
+    x, y = _build_dataset(500, 0)
+    x.iloc[::7, 0] = np.nan
+    # trees fitted on missing values learn the side each split sends them to
+    model = RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0).fit(x, y)
+    predictor = compile_prediction_models({'24': model})
+    x_test, _ = _build_dataset(300, 1)
+    x_test.iloc[::3, 0] = np.nan
+
+    np.testing.assert_allclose(predictor.predict_positive_proba(x_test)[:, 0],
+                               model.predict_proba(x_test)[:, POSITIVE_CLASS_INDEX], atol=TOLERANCE)
+
+
+@pytest.mark.parametrize('name', sorted(MODELS))
+def test_features_number_is_checked(name):
+    predictor = compile_prediction_models({'24': _fit(name)})
+    x, _ = _build_dataset(3, 1)
+    with pytest.raises(ValueError, match='X has {} features'.format(FEATURES_NUMBER - 1)):
+        predictor.predict_positive_proba(x.values[:, 1:])
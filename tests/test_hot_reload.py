@@ -0,0 +1,199 @@
+import os
+import pickle
+import shutil
+import signal
+
+import numpy as np
+import pytest
+from sklearn.linear_model import LogisticRegression
+
+import dao
+import exceptions
+from dao import Dao
+from model.models_repository import ModelLoader, ModelRepository
+from reloading import HotReloader
+from settings import Settings
+
+CHANGED_SENSOR = 'BTIR-1317-1'
+UNCHANGED_SENSOR = 'BTIR-1310-1'
+FEATURES_NUMBER = 4
+
+
+def _fit_models(seed):
+    random_state = np.random.RandomState(seed)
+    x = random_state.normal(0., 1., (100, FEATURES_NUMBER))
+    y = (x[:, 0] + random_state.normal(0., 1., 100) > 0).astype('int64')
+    return {'24': LogisticRegression().fit(x, y), '72': LogisticRegression(C=0.1).fit(x, y)}
+
+
+def _bump_version(path):
+    # a deployment in the same second may keep the mtime, the version is moved on explicitly
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+class ModelsDir:
+    def __init__(self, settings):
+        self._path = os.path.join(settings.get_prediction_models()['dir'], settings.get_reactor_name())
+        os.makedirs(self._path, exist_ok=True)
+
+    def get_path(self, sensor):
+        return os.path.join(self._path, sensor + ModelLoader.PICKLE_ENDING)
+
+    def write(self, sensor, seed):
+        path = self.get_path(sensor)
+        with open(path, 'wb') as f:
+            pickle.dump(_fit_models(seed), f)
+        _bump_version(path)
+
+    def write_truncated(self, sensor, seed):
+        path = self.get_path(sensor)
+        with open(path, 'wb') as f:
+            f.write(pickle.dumps(_fit_models(seed))[:100])
+        _bump_version(path)
+
+
+@pytest.fixture
+def dict_paths(tmp_path, monkeypatch):
+    # dictionaries are copied, so changing them leaves the resources of the repository untouched
+    paths = {}
+    for name in ['REACTORS_PATH', 'CHEMICAL_ANALYSIS_TAGS_PATH', 'TEMPERATURES_TAGS_PATH']:
+        paths[name] = str(tmp_path / os.path.basename(getattr(dao, name)))
+        shutil.copyfile(getattr(dao, name), paths[name])
+        monkeypatch.setattr(dao, name, paths[name])
+    monkeypatch.setattr(dao, 'DICT_PATHS', list(paths.values()))
+    return paths
+
+
+@pytest.fixture
+def models_dir(settings_path):
+    models_dir = ModelsDir(Settings(settings_path))
+    models_dir.write(CHANGED_SENSOR, 0)
+    models_dir.write(UNCHANGED_SENSOR, 1)
+    return models_dir
+
+
+@pytest.fixture
+def loaded_paths(monkeypatch):
+    paths = []
+    load_saved_model = ModelLoader._SpecificModelLoader._load_saved_model
+
+    def record_load(path, is_keras):
+        paths.append(path)
+        return load_saved_model(path, is_keras)
+
+    monkeypatch.setattr(ModelLoader._SpecificModelLoader, '_load_saved_model', staticmethod(record_load))
+    return paths
+
+
+@pytest.fixture
+def sighup_handler():
+    handler = signal.getsignal(signal.SIGHUP)
+    yield
+    signal.signal(signal.SIGHUP, handler)
+
+
+def _build_repository(settings_path, built_dao):
+    return ModelRepository(built_dao.get_reactors_dao().findall(), Settings(settings_path))
+
+
+def _get_predictors(models_repo, reactor_name):
+    return {sensor: models_repo.get_sensor_compiled_prediction_model(reactor_name, sensor)
+            for sensor in [CHANGED_SENSOR, UNCHANGED_SENSOR]}
+
+
+def test_only_changed_models_are_reloaded(settings_path, models_dir, loaded_paths):
+    reactor_name = Settings(settings_path).get_reactor_name()
+    models_repo = _build_repository(settings_path, Dao())
+    predictors = _get_predictors(models_repo, reactor_name)
+    unchanged_models = models_repo.get_sensor_prediction_model(reactor_name, UNCHANGED_SENSOR)
+    del loaded_paths[:]
+
+    assert not models_repo.has_changes()
+    models_dir.write(CHANGED_SENSOR, 2)
+    assert models_repo.has_changes()
+    assert models_repo.reload()
+
+    assert loaded_paths == [models_dir.get_path(CHANGED_SENSOR)]
+    reloaded_predictors = _get_predictors(models_repo, reactor_name)
+    assert reloaded_predictors[CHANGED_SENSOR] is not predictors[CHANGED_SENSOR]
+    assert reloaded_predictors[UNCHANGED_SENSOR] is predictors[UNCHANGED_SENSOR]
+    assert models_repo.get_sensor_prediction_model(reactor_name, UNCHANGED_SENSOR) is unchanged_models
+    assert not models_repo.has_changes()
+
+
+def test_only_changed_dictionaries_are_reloaded(dict_paths):
+    built_dao = Dao()
+    reactors_dao = built_dao.get_reactors_dao()
+    temperatures_tags_dao = built_dao.get_temperatures_tags_dao()
+
+    assert not built_dao.reload()
+    _bump_version(dict_paths['CHEMICAL_ANALYSIS_TAGS_PATH'])
+    assert built_dao.reload()
+
+    assert built_dao.get_reactors_dao() is reactors_dao
+    assert built_dao.get_temperatures_tags_dao() is temperatures_tags_dao
+    assert not built_dao.has_changes()
+
+
+def test_truncated_model_keeps_previous_one(settings_path, models_dir):
+    reactor_name = Settings(settings_path).get_reactor_name()
+    models_repo = _build_repository(settings_path, Dao())
+    predictors = _get_predictors(models_repo, reactor_name)
+
+    models_dir.write_truncated(CHANGED_SENSOR, 2)
+    with pytest.warns(exceptions.MissingComponentsWarning, match='previous models are kept'):
+        assert not models_repo.reload()
+
+    assert _get_predictors(models_repo, reactor_name) == predictors
+    # the failed file is tried again once it is fixed
+    assert models_repo.has_changes()
+    models_dir.write(CHANGED_SENSOR, 2)
+    assert models_repo.reload()
+    assert _get_predictors(models_repo, reactor_name)[CHANGED_SENSOR] is not predictors[CHANGED_SENSOR]
+
+
+def test_broken_dictionary_keeps_previous_one(dict_paths):
+    built_dao = Dao()
+    reactors_dao = built_dao.get_reactors_dao()
+    with open(dict_paths['REACTORS_PATH'], 'r+', encoding='utf-8') as f:
+        f.truncate(10)
+    _bump_version(dict_paths['REACTORS_PATH'])
+
+    with pytest.warns(exceptions.MissingComponentsWarning, match='previous ones are kept'):
+        assert not built_dao.reload()
+    assert built_dao.get_reactors_dao() is reactors_dao
+
+
+def test_sighup_triggers_reload(settings_path, models_dir, sighup_handler):
+    reactor_name = Settings(settings_path).get_reactor_name()
+    built_dao = Dao()
+    models_repo = _build_repository(settings_path, built_dao)
+    predictors = _get_predictors(models_repo, reactor_name)
+    # polling is off, only the signal requests a check
+    reloader = HotReloader(built_dao, models_repo, poll_interval=0)
+    reloader.install_signal_handler()
+
+    models_dir.write(CHANGED_SENSOR, 2)
+    assert reloader.reload_if_needed() == (False, False)
+    assert _get_predictors(models_repo, reactor_name) == predictors
+
+    os.kill(os.getpid(), signal.SIGHUP)
+    assert reloader.reload_if_needed() == (False, True)
+    assert _get_predictors(models_repo, reactor_name)[CHANGED_SENSOR] is not predictors[CHANGED_SENSOR]
+    assert reloader.reload_if_needed() == (False, False)
+
+
+def test_poll_triggers_reload(settings_path, models_dir):
+    reactor_name = Settings(settings_path).get_reactor_name()
+    built_dao = Dao()
+    models_repo = _build_repository(settings_path, built_dao)
+    predictors = _get_predictors(models_repo, reactor_name)
+    reloader = HotReloader(built_dao, models_repo, poll_interval=1e-3)
+
+    assert reloader.reload_if_needed() == (False, False)
+    models_dir.write(CHANGED_SENSOR, 2)
+    assert reloader.reload_if_needed() == (False, True)
+    reloaded_predictors = _get_predictors(models_repo, reactor_name)
+    assert reloaded_predictors[CHANGED_SENSOR] is not predictors[CHANGED_SENSOR]
+    assert reloaded_predictors[UNCHANGED_SENSOR] is predictors[UNCHANGED_SENSOR]
@@ -0,0 +1,144 @@
+import datetime
+
+import pytest
+import sqlalchemy
+from conftest import HISTORIAN_SINCE, Historian, LightModelRepository, SmoothModelRepository, build_settings
+
+import constants
+import late_data
+import predict_coking
+from datasource import output_schema
+from datasource.data_handling import InputDataHandler, OutputDataHandler
+from datasource.source import SQLSource
+from settings import Settings
+
+ANALYSIS_TABLE = 'catalyst_analysis'
+PREDICTIONS_KEYS = output_schema.TABLES_KEYS['predictions']
+
+
+@pytest.fixture
+def predicted_historian(historian, monkeypatch):
+    monkeypatch.setattr('model.models_repository.ModelRepository',
+                        lambda reactors, settings: LightModelRepository())
+    historian.feed(HISTORIAN_SINCE + datetime.timedelta(days=2))
+    assert predict_coking.main([historian.settings_path]) == 0
+    historian.feed()
+    assert predict_coking.main([historian.settings_path]) == 0
+    return historian
+
+
+@pytest.fixture
+def value_scans(monkeypatch):
+    scans = []
+    get_fingerprints = InputDataHandler.get_fingerprints
+
+    def count_scans(input_data_handler, table_type, since_datetime, until_datetime):
+        scans.append((table_type, since_datetime, until_datetime))
+        return get_fingerprints(input_data_handler, table_type, since_datetime, until_datetime)
+
+    monkeypatch.setattr(InputDataHandler, 'get_fingerprints', count_scans)
+    return scans
+
+
+def _read_predictions(settings):
+    output_source = SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN)
+    predictions = output_source.get_data_since(settings.get_output_tables()['predictions'])
+    return predictions.reset_index().set_index(PREDICTIONS_KEYS).sort_index().iloc[:, 0]
+
+
+def _execute(historian, query):
+    with historian.source.get_engine().begin() as connection:
+        connection.execute(sqlalchemy.text(query))
+
+
+def _format_datetime(datetime_value):
+    return SQLSource.DATETIME_CONVERTERS['sqlite'](str(datetime_value))
+
+
+def _assert_recomputed_after(historian, before, since_datetime, added_datetimes=()):
+    after = _read_predictions(historian.settings)
+    assert not after.index.duplicated().any()
+    added = after.index.difference(before.index)
+    assert set(added.get_level_values(0)) == set(added_datetimes)
+    recomputed = after.drop(index=added)
+    assert recomputed.index.equals(before.index)
+    changed = recomputed.loc[(recomputed - before).abs() > 1e-9].index.get_level_values(0)
+    assert len(changed) > 0
+    assert changed.min() > since_datetime
+    assert predict_coking.main([historian.settings_path]) == 1
+
+
+def test_corrected_row_is_recomputed_by_full_scan(predicted_historian, value_scans):
+    historian = predicted_historian
+    analysis_datetimes = historian.get_analysis_datetimes()
+    corrected_datetime = analysis_datetimes[-5].to_pydatetime()
+    table_name = historian.settings.get_input_tables()[ANALYSIS_TABLE]
+    before = _read_predictions(historian.settings)
+    _execute(historian, 'UPDATE {} SET {} WHERE {} = {}'.format(
+        table_name, ', '.join('"{0}" = "{0}" * 1.5'.format(col) for col in historian.tables[ANALYSIS_TABLE].columns),
+        constants.INPUT_DATETIME_COLUMN, _format_datetime(corrected_datetime)))
+
+    # a correction in place keeps the rows number, it waits for the next full scan
+    assert predict_coking.main([historian.settings_path]) == 1
+    assert value_scans == []
+
+    OutputDataHandler(historian.settings).set_input_scan_datetime(table_name, constants.MIN_DATETIME)
+    assert predict_coking.main([historian.settings_path]) == 0
+    # interpolated values up to the previous measurement change with the corrected one
+    _assert_recomputed_after(historian, before, analysis_datetimes[-6].to_pydatetime())
+
+
+def test_late_row_is_recomputed_without_full_scan(predicted_historian, value_scans):
+    historian = predicted_historian
+    analysis_datetimes = historian.get_analysis_datetimes()
+    late_datetime = analysis_datetimes[-5].to_pydatetime() + datetime.timedelta(hours=1)
+    late_row = historian.tables[ANALYSIS_TABLE].loc[[analysis_datetimes[-5]]] * 1.5
+    before = _read_predictions(historian.settings)
+    historian.source.write_new_data(historian.settings.get_input_tables()[ANALYSIS_TABLE],
+                                    late_row.set_axis([late_datetime]).rename_axis(constants.INPUT_DATETIME_COLUMN))
+
+    assert predict_coking.main([historian.settings_path]) == 0
+    # only the bucket with a new row is scanned for values
+    assert value_scans == [(ANALYSIS_TABLE, analysis_datetimes[-5].to_pydatetime(),
+                            analysis_datetimes[-5].to_pydatetime() + late_data.FINGERPRINT_BUCKET)]
+    # the late row is a new analysis timestamp predicted for every sensor
+    _assert_recomputed_after(historian, before, analysis_datetimes[-5].to_pydatetime(), [late_datetime])
+
+
+def test_no_new_data_run_scans_no_values(predicted_historian, value_scans):
+    historian = predicted_historian
+    assert predict_coking.main([historian.settings_path]) == 1
+    assert value_scans == []
+
+    output_data_handler = OutputDataHandler(historian.settings)
+    for table_name in historian.settings.get_input_tables().values():
+        output_data_handler.set_input_scan_datetime(table_name, constants.MIN_DATETIME)
+    assert predict_coking.main([historian.settings_path]) == 1
+    assert sorted(table_type for table_type, _, _ in value_scans) == sorted(historian.tables)
+
+    # the scan found no changes, it is not repeated before the next interval
+    value_scans.clear()
+    assert predict_coking.main([historian.settings_path]) == 1
+    assert value_scans == []
+
+
+def test_recomputed_predictions_match_full_rerun(tmp_path, monkeypatch):
+    # the smooth predictor weighs duration, so any other origin of recomputed rows shows in their predictions
+    monkeypatch.setattr('model.models_repository.ModelRepository',
+                        lambda reactors, settings: SmoothModelRepository())
+    historian = Historian(build_settings(tmp_path / 'recomputed')).feed()
+    assert predict_coking.main([historian.settings_path]) == 0
+    analysis_datetimes = historian.get_analysis_datetimes()
+    late_datetime = analysis_datetimes[-5].to_pydatetime() + datetime.timedelta(hours=1)
+    late_row = historian.tables[ANALYSIS_TABLE].loc[[analysis_datetimes[-5]]] * 1.5
+    historian.source.write_new_data(historian.settings.get_input_tables()[ANALYSIS_TABLE],
+                                    late_row.set_axis([late_datetime]).rename_axis(constants.INPUT_DATETIME_COLUMN))
+    assert predict_coking.main([historian.settings_path]) == 0
+    recomputed = _read_predictions(historian.settings)
+
+    rerun_settings_path = build_settings(tmp_path / 'rerun',
+                                         input_params={'database': historian.settings.get_input()['database']})
+    assert predict_coking.main([rerun_settings_path]) == 0
+    rerun = _read_predictions(Settings(rerun_settings_path))
+    assert recomputed.index.equals(rerun.index)
+    assert (recomputed - rerun).abs().max() < 1e-9
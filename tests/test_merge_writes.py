@@ -0,0 +1,145 @@
+import datetime
+import threading
+
+import pandas as pd
+import pytest
+import sqlalchemy
+
+import constants
+import exceptions
+from datasource import output_schema
+from datasource.sinks import SQLSink
+from datasource.source import SQLSource
+from settings import Settings
+
+WRITERS_NUMBER = 4
+KEYS_NUMBER = 5
+PROBABILITY_COLUMN = 'Вероятность коксования'
+
+
+def _build_predictions(probability, keys_number=KEYS_NUMBER):
+    datetimes = [datetime.datetime(2020, 1, 1, 4) + datetime.timedelta(hours=4 * i) for i in range(keys_number)]
+    return pd.DataFrame({output_schema.HORIZON_COLUMN: ['24'] * keys_number,
+                         output_schema.PLATE_COLUMN: [1] * keys_number,
+                         output_schema.SENSOR_COLUMN: [1] * keys_number,
+                         PROBABILITY_COLUMN: [probability] * keys_number},
+                        index=pd.DatetimeIndex(datetimes, name=constants.OUTPUT_DATETIME_COLUMN))
+
+
+def _build_sink(settings):
+    return SQLSink(settings.get_output(), settings.get_output_tables())
+
+
+def _read_table(settings, table_name):
+    return SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN).get_data_since(table_name)
+
+
+def _write_legacy_table(settings, data):
+    # predictions table as written by pandas before merges
+    source = SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN)
+    table_name = settings.get_output_tables()['predictions']
+    source.write_new_data(table_name, data)
+    return table_name
+
+
+def _get_key_indexes(settings, table_name):
+    indexes = sqlalchemy.inspect(SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN)
+                                 .get_engine()).get_indexes(table_name)
+    return {index['name']: index['unique'] for index in indexes if index['name'].endswith('_key')}
+
+
+def test_concurrent_writers_leave_one_row_per_key(settings_path):
+    settings = Settings(settings_path)
+    errors = []
+    start = threading.Barrier(WRITERS_NUMBER)
+
+    def write(i):
+        try:
+            sink = _build_sink(settings)
+            start.wait()
+            sink.ensure_schema()
+            sink.write('predictions', _build_predictions(i / 10.),
+                       watermark=('predictions', datetime.datetime(2020, 1, 2) + datetime.timedelta(days=i)))
+        except Exception as e:
+            errors.append(e)
+
+    writers = [threading.Thread(target=write, args=(i,)) for i in range(WRITERS_NUMBER)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    assert errors == []
+    predictions = _read_table(settings, settings.get_output_tables()['predictions'])
+    assert predictions.shape[0] == KEYS_NUMBER
+    assert predictions[PROBABILITY_COLUMN].nunique() == 1
+    watermarks_table = settings.get_output_tables().get('watermarks', constants.DEFAULT_WATERMARKS_TABLE)
+    with SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN).get_engine().connect() as connection:
+        assert connection.execute(sqlalchemy.text('SELECT COUNT(*) FROM {}'.format(watermarks_table))).scalar() == 1
+    assert _build_sink(settings).find_watermark('predictions') == \
+        datetime.datetime(2020, 1, 2) + datetime.timedelta(days=WRITERS_NUMBER - 1)
+
+
+def test_duplicate_rows_keep_last_row_before_index_build(settings_path, recwarn):
+    settings = Settings(settings_path)
+    table_name = _write_legacy_table(settings, pd.concat([_build_predictions(0.1), _build_predictions(0.3)]))
+    sink = _build_sink(settings)
+    with pytest.warns(exceptions.MissingComponentsWarning, match='only the last row of each is kept'):
+        sink.ensure_schema()
+
+    assert _get_key_indexes(settings, table_name) == {output_schema.build_index_name(table_name): 1}
+    assert _read_table(settings, table_name)[PROBABILITY_COLUMN].tolist() == [0.3] * KEYS_NUMBER
+    recwarn.clear()
+    sink.write('predictions', _build_predictions(0.2, KEYS_NUMBER - 1))
+    assert _read_table(settings, table_name).sort_index()[PROBABILITY_COLUMN].tolist() == \
+        [0.2] * (KEYS_NUMBER - 1) + [0.3]
+    assert not [warning for warning in recwarn if issubclass(warning.category, exceptions.MissingComponentsWarning)]
+
+
+def test_duplicate_keys_are_looked_up_until_index_exists(settings_path, monkeypatch):
+    settings = Settings(settings_path)
+    _write_legacy_table(settings, pd.concat([_build_predictions(0.1)] * 2))
+    with pytest.warns(exceptions.MissingComponentsWarning):
+        _build_sink(settings).ensure_schema()
+    lookups = []
+    monkeypatch.setattr(SQLSource, '_remove_duplicate_keys', lambda source, table, key_columns: lookups.append(table))
+
+    _build_sink(settings).ensure_schema()
+    assert lookups == []
+
+
+def test_index_built_by_another_writer_is_not_a_failure(settings_path, monkeypatch, recwarn):
+    settings = Settings(settings_path)
+    table_name = _write_legacy_table(settings, _build_predictions(0.1))
+    fit_index_columns = SQLSource._fit_index_columns
+
+    def build_concurrently(source, inspector, table, index):
+        # the other writer builds the index after this one found it missing
+        fit_index_columns(source, inspector, table, index)
+        index.create(source.get_engine())
+
+    monkeypatch.setattr(SQLSource, '_fit_index_columns', build_concurrently)
+    _build_sink(settings).ensure_schema()
+
+    assert _get_key_indexes(settings, table_name) == {output_schema.build_index_name(table_name): 1}
+    assert not [warning for warning in recwarn if issubclass(warning.category, exceptions.MissingComponentsWarning)]
+
+
+def test_failed_merge_commits_neither_rows_nor_watermark(settings_path, monkeypatch):
+    settings = Settings(settings_path)
+    sink = _build_sink(settings)
+    sink.ensure_schema()
+    sink.write('predictions', _build_predictions(0.1), watermark=('predictions', datetime.datetime(2020, 1, 2)))
+
+    def fail(connection, watermarks_table, key, datetime):
+        raise sqlalchemy.exc.OperationalError('UPDATE', {}, Exception('lock wait timeout exceeded'))
+
+    # the staging table is dropped between the merge and the watermark update
+    monkeypatch.setattr(SQLSource, '_advance_watermark', staticmethod(fail))
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        sink.write('predictions', _build_predictions(0.2, KEYS_NUMBER + 1),
+                   watermark=('predictions', datetime.datetime(2020, 1, 3)))
+
+    predictions = _read_table(settings, settings.get_output_tables()['predictions'])
+    assert predictions[PROBABILITY_COLUMN].tolist() == [0.1] * KEYS_NUMBER
+    assert _build_sink(settings).find_watermark('predictions') == datetime.datetime(2020, 1, 2)
@@ -0,0 +1,53 @@
+import datetime
+
+import pandas as pd
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import mssql, mysql, sqlite
+
+import constants
+from datasource import output_schema
+from datasource.data_handling import OutputDataHandler
+from datasource.source import SQLSource
+from settings import Settings
+
+
+def _build_legacy_predictions():
+    # rows as written by pandas before the output schema was managed, labels become unbounded text columns
+    return pd.DataFrame({output_schema.HORIZON_COLUMN: ['24', '72'], output_schema.PLATE_COLUMN: [1, 1],
+                         output_schema.SENSOR_COLUMN: [1, 1], 'Вероятность коксования': [0.1, 0.2]},
+                        index=pd.DatetimeIndex([datetime.datetime(2020, 1, 1, 4)] * 2,
+                                               name=constants.OUTPUT_DATETIME_COLUMN))
+
+
+@pytest.mark.parametrize('dialect, expected', [
+    (mysql.dialect(), 'ALTER TABLE predictions MODIFY `Горизонт прогнозирования` VARCHAR(32);'),
+    (mssql.dialect(), 'ALTER TABLE predictions ALTER COLUMN [Горизонт прогнозирования] VARCHAR(32);')
+])
+def test_legacy_text_key_columns_get_declared_length(dialect, expected):
+    table = output_schema.build_table(sqlalchemy.MetaData(), 'predictions', 'predictions')
+    assert SQLSource.build_alter_column_query(dialect, table.name, table.c[output_schema.HORIZON_COLUMN]) == expected
+
+
+@pytest.mark.parametrize('dialect, expected', [
+    (mysql.dialect(), 'DROP TEMPORARY TABLE stage_predictions;'),
+    (mssql.dialect(), 'DROP TABLE [#stage_predictions];'),
+    (sqlite.dialect(), 'DROP TABLE stage_predictions;')
+])
+def test_staging_table_drop_keeps_transaction_open(dialect, expected):
+    # a plain DROP TABLE would commit merged rows on mysql before the watermark is written
+    staging_name = ('#' if dialect.name == 'mssql' else '') + SQLSource.STAGING_TABLE_PREFIX + 'predictions'
+    assert SQLSource.build_drop_staging_table_query(dialect, staging_name) == expected
+
+
+def test_watermark_lookup_does_not_depend_on_ddl(settings_path, monkeypatch):
+    settings = Settings(settings_path)
+    SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN).write_new_data(
+        settings.get_output_tables()['predictions'], _build_legacy_predictions())
+    assert OutputDataHandler(settings).find_last_prediction_datetime() == datetime.datetime(2020, 1, 1, 4)
+
+    def fail_ddl(source, tables):
+        raise sqlalchemy.exc.OperationalError('CREATE INDEX', {}, Exception('index key is too long'))
+
+    monkeypatch.setattr(SQLSource, 'ensure_tables', fail_ddl)
+    assert OutputDataHandler(settings).find_last_prediction_datetime() == datetime.datetime(2020, 1, 1, 4)
@@ -0,0 +1,224 @@
+import datetime
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+import constants
+from datasource import output_schema
+from datasource.sinks import ParquetSink
+from settings import Settings
+
+pytest.importorskip('pyarrow')
+
+LOCK_TIMEOUT = 5.
+WRITERS_NUMBER = 8
+DATETIMES = [datetime.datetime(2020, 1, 1, 4), datetime.datetime(2020, 1, 2, 4)]
+PROBABILITY_COLUMN = 'Вероятность коксования'
+
+
+def _build_predictions(probability):
+    return pd.DataFrame({output_schema.HORIZON_COLUMN: ['24'] * len(DATETIMES),
+                         output_schema.PLATE_COLUMN: [1] * len(DATETIMES),
+                         output_schema.SENSOR_COLUMN: [1] * len(DATETIMES),
+                         PROBABILITY_COLUMN: [probability] * len(DATETIMES)},
+                        index=pd.DatetimeIndex(DATETIMES, name=constants.OUTPUT_DATETIME_COLUMN))
+
+
+def _build_sensors_predictions():
+    # every plate, sensor and horizon combination on both days
+    labels = [(horizon, plate, sensor) for horizon in ['24', '72'] for plate in [1, 2] for sensor in [1, 3]]
+    datetimes = [dt for dt in DATETIMES for _ in labels]
+    return pd.DataFrame({output_schema.HORIZON_COLUMN: [horizon for _ in DATETIMES for horizon, _, _ in labels],
+                         output_schema.PLATE_COLUMN: [plate for _ in DATETIMES for _, plate, _ in labels],
+                         output_schema.SENSOR_COLUMN: [sensor for _ in DATETIMES for _, _, sensor in labels],
+                         PROBABILITY_COLUMN: [i / 100. for i in range(len(datetimes))]},
+                        index=pd.DatetimeIndex(datetimes, name=constants.OUTPUT_DATETIME_COLUMN))
+
+
+def _sorted_rows(data):
+    keys = output_schema.TABLES_KEYS['predictions']
+    return data.reset_index()[keys + [PROBABILITY_COLUMN]].sort_values(keys).reset_index(drop=True)
+
+
+def _build_sink(settings_path, tmp_path, layout=None):
+    settings = Settings(settings_path)
+    return ParquetSink({'parquet_path': str(tmp_path / 'parquet'), 'parquet_layout': layout},
+                       settings.get_output_tables(), settings.get_reactor_name())
+
+
+@pytest.fixture
+def sink(settings_path, tmp_path):
+    sink = _build_sink(settings_path, tmp_path)
+    sink.write('predictions', _build_predictions(0.1), watermark=('predictions', DATETIMES[-1]))
+    return sink
+
+
+def test_held_lock_does_not_break_readers(sink):
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with sink._lock_partition('predictions', datetime.datetime(2020, 1, 2)):
+            locked.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    try:
+        assert locked.wait(LOCK_TIMEOUT)
+        assert sink.find_last_datetime('predictions') == DATETIMES[-1]
+        assert sink.read('predictions').shape[0] == len(DATETIMES)
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_stale_lock_in_table_directory_is_skipped(sink):
+    # lock files of earlier versions were created next to the partitions
+    table_path = sink._get_table_path('predictions')
+    open(os.path.join(table_path, 'date=2020-01-03.lock'), 'w').close()
+    assert sink.find_last_datetime('predictions') == DATETIMES[-1]
+
+    sink.replace('predictions', _build_predictions(0.2), datetime.datetime(2020, 1, 1), DATETIMES[-1])
+    replaced = sink.read('predictions')
+    assert replaced[PROBABILITY_COLUMN].tolist() == [0.2] * len(DATETIMES)
+    assert sorted(name for name in os.listdir(table_path) if not name.endswith('.lock')) == \
+        ['date=2020-01-01', 'date=2020-01-02']
+
+
+def test_wide_layout_round_trip(settings_path, tmp_path):
+    import pyarrow.parquet as pq
+
+    sink = _build_sink(settings_path, tmp_path, 'wide')
+    predictions = _build_sensors_predictions()
+    sink.write('predictions', predictions, watermark=('predictions', DATETIMES[-1]))
+
+    # one row per timestamp with a column per plate, sensor and horizon
+    paths = ParquetSink._list_parts(sink._get_partition_path('predictions', datetime.datetime(2020, 1, 1)))
+    assert len(paths) == 1
+    wide = pq.read_table(paths[0]).to_pandas()
+    assert wide.shape == (1, predictions.shape[0] // len(DATETIMES) + 1)
+    assert '2:3:72' in wide.columns
+    assert _sorted_rows(sink.read('predictions')).equals(_sorted_rows(predictions))
+    assert sink.find_last_datetime('predictions') == DATETIMES[-1]
+
+
+@pytest.mark.parametrize('layout', ['long', 'wide'])
+def test_replace_rewrites_only_affected_day(settings_path, tmp_path, layout):
+    sink = _build_sink(settings_path, tmp_path, layout)
+    predictions = _build_sensors_predictions()
+    sink.write('predictions', predictions, watermark=('predictions', DATETIMES[-1]))
+    first_day_parts = ParquetSink._list_parts(sink._get_partition_path('predictions', datetime.datetime(2020, 1, 1)))
+
+    is_replaced = (predictions.index == DATETIMES[-1]) & (predictions[output_schema.PLATE_COLUMN] == 2) \
+        & (predictions[output_schema.SENSOR_COLUMN] == 3)
+    replaced = predictions.loc[is_replaced].copy()
+    replaced[PROBABILITY_COLUMN] = 0.99
+    sink.replace('predictions', replaced, datetime.datetime(2020, 1, 2), DATETIMES[-1])
+
+    assert ParquetSink._list_parts(sink._get_partition_path('predictions', datetime.datetime(2020, 1, 1))) == \
+        first_day_parts
+    assert len(ParquetSink._list_parts(sink._get_partition_path('predictions', datetime.datetime(2020, 1, 2)))) == 1
+    expected = pd.concat([predictions.loc[~is_replaced], replaced])
+    assert _sorted_rows(sink.read('predictions')).equals(_sorted_rows(expected))
+
+
+def test_committed_pending_run_is_recovered(settings_path, tmp_path, monkeypatch):
+    sink = _build_sink(settings_path, tmp_path)
+
+    def crash(sink, pending_path):
+        raise OSError('interrupted after the commit marker')
+
+    # the run stops after its marker was written, before files were moved into the partitions
+    with monkeypatch.context() as patch:
+        patch.setattr(ParquetSink, '_finish_pending', crash)
+        with pytest.raises(OSError):
+            sink.write('predictions', _build_predictions(0.1), watermark=('predictions', DATETIMES[-1]))
+    pending_root = os.path.join(sink._path, ParquetSink.PENDING_DIR)
+    assert len(os.listdir(pending_root)) == 1
+    assert sink.read('predictions').shape[0] == 0
+
+    recovered_sink = _build_sink(settings_path, tmp_path)
+    assert recovered_sink.find_watermark('predictions') == DATETIMES[-1]
+    assert os.listdir(pending_root) == []
+    assert recovered_sink.read('predictions')[PROBABILITY_COLUMN].tolist() == [0.1] * len(DATETIMES)
+
+
+def test_concurrent_watermarks_are_kept(settings_path, tmp_path):
+    sinks = [_build_sink(settings_path, tmp_path) for _ in range(WRITERS_NUMBER)]
+    start = threading.Barrier(WRITERS_NUMBER)
+    errors = []
+
+    def set_watermark(i):
+        try:
+            start.wait()
+            # separate sinks share no in-process lock, like separate runs
+            for j in range(5):
+                sinks[i].set_watermark('key_{}'.format(i), DATETIMES[0] + datetime.timedelta(hours=j))
+        except Exception as e:
+            errors.append(e)
+
+    writers = [threading.Thread(target=set_watermark, args=(i,)) for i in range(WRITERS_NUMBER)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    assert errors == []
+    assert [_build_sink(settings_path, tmp_path).find_watermark('key_{}'.format(i)) for i in range(WRITERS_NUMBER)] \
+        == [DATETIMES[0] + datetime.timedelta(hours=4)] * WRITERS_NUMBER
+
+
+def test_committed_watermark_only_advances(sink, settings_path, tmp_path):
+    # a run finishing after a later one must not move the watermark back
+    late_sink = _build_sink(settings_path, tmp_path)
+    late_sink.write('predictions', _build_predictions(0.2), watermark=('predictions', DATETIMES[0]))
+    assert late_sink.find_watermark('predictions') == DATETIMES[-1]
+
+    late_sink.write('predictions', pd.DataFrame(), watermark=('predictions', DATETIMES[0]))
+    assert late_sink.find_watermark('predictions') == DATETIMES[-1]
+    # explicit seeds and scan datetimes are still set as given
+    late_sink.set_watermark('predictions', DATETIMES[0])
+    assert late_sink.find_watermark('predictions') == DATETIMES[0]
+
+
+def test_recovery_waits_for_running_commit(settings_path, tmp_path):
+    committing_sink = _build_sink(settings_path, tmp_path)
+    committing_sink.write('predictions', _build_predictions(0.1))
+    recovered = threading.Event()
+
+    def recover():
+        _build_sink(settings_path, tmp_path).ensure_schema()
+        recovered.set()
+
+    # the running commit has written its marker and not moved its files yet
+    with committing_sink._lock_pending():
+        ParquetSink._write_json(os.path.join(committing_sink._pending_path, ParquetSink.COMMITTED_NAME),
+                                ['predictions', str(DATETIMES[-1])])
+        recovery = threading.Thread(target=recover)
+        recovery.start()
+        assert not recovered.wait(0.2)
+        committing_sink._finish_pending(committing_sink._pending_path)
+    recovery.join(LOCK_TIMEOUT)
+
+    assert recovered.is_set()
+    assert _build_sink(settings_path, tmp_path).read('predictions')[PROBABILITY_COLUMN].tolist() == \
+        [0.1] * len(DATETIMES)
+
+
+def test_pending_run_writing_partitions_is_kept(settings_path, tmp_path):
+    running_sink = _build_sink(settings_path, tmp_path)
+    running_sink.write('predictions', _build_predictions(0.1))
+    two_days_ago = datetime.datetime.now().timestamp() - 2 * 86400
+    # the run directory is old, files are still being staged in its partitions
+    os.utime(running_sink._pending_path, (two_days_ago, two_days_ago))
+
+    _build_sink(settings_path, tmp_path).ensure_schema()
+    assert os.path.isdir(running_sink._pending_path)
+
+    for directory, _, names in os.walk(running_sink._pending_path):
+        for path in [directory] + [os.path.join(directory, name) for name in names]:
+            os.utime(path, (two_days_ago, two_days_ago))
+    _build_sink(settings_path, tmp_path).ensure_schema()
+    assert not os.path.exists(running_sink._pending_path)
@@ -0,0 +1,53 @@
+import datetime
+import re
+
+from conftest import HISTORIAN_SINCE, LightModelRepository, build_settings
+
+import predict_coking
+from dao import Dao
+from replay import ReplayHarness, SyntheticHistorian
+from settings import Settings
+
+REPLAY_DAYS = 2
+# the synthetic days are fed within a few wall clock seconds
+REPLAY_SPEED = REPLAY_DAYS * 86400. / 4.
+CYCLE_INTERVAL = 0.05
+GAP = (HISTORIAN_SINCE + datetime.timedelta(hours=24), HISTORIAN_SINCE + datetime.timedelta(hours=32))
+
+
+def test_replay_settings_keep_pipeline_options(tmp_path):
+    settings_path = build_settings(tmp_path, input_params={'temperatures_aggregation_minutes': '5'},
+                                   output_params={'parquet_layout': 'wide'})
+    replay_settings = Settings(ReplayHarness._build_replay_settings(settings_path, str(tmp_path / 'replay')))
+
+    assert replay_settings.get_input()['temperatures_aggregation_minutes'] == '5'
+    assert replay_settings.get_input()['database'] == str(tmp_path / 'replay' / 'input.db')
+    assert replay_settings.get_output()['sink'] == 'sql'
+    assert replay_settings.get_output()['parquet_layout'] == 'wide'
+    assert replay_settings.get_output()['database'] == str(tmp_path / 'replay' / 'output.db')
+
+
+def test_replay_with_gap_reports_cycles_and_lags(tmp_path, monkeypatch):
+    monkeypatch.setattr('model.models_repository.ModelRepository',
+                        lambda reactors, settings: LightModelRepository())
+    cycles = []
+    main = predict_coking.main
+
+    def count_cycles(argv):
+        cycles.append(argv)
+        return main(argv)
+
+    monkeypatch.setattr(predict_coking, 'main', count_cycles)
+    settings_path = build_settings(tmp_path)
+    tables = SyntheticHistorian(Settings(settings_path), Dao(), HISTORIAN_SINCE, REPLAY_DAYS).get_tables()
+    harness = ReplayHarness(settings_path, str(tmp_path / 'replay'), tables, REPLAY_SPEED, CYCLE_INTERVAL, [GAP])
+
+    report = harness.run().get_report()
+
+    assert re.search(r'^cycles: (\d+)$', report, re.M).group(1) == str(len(cycles))
+    assert len(cycles) >= 2
+    lags = re.search(r'^arrival to prediction lag: p50 ([\d.]+) s, p99 ([\d.]+) s, max ([\d.]+) s$', report, re.M)
+    p50, p99, max_lag = (float(value) for value in lags.groups())
+    assert 0. < p50 <= p99 <= max_lag
+    # the analysis rows held back by the gap are all predicted by the end of the replay
+    assert re.search(r'^catch-up after gap ending at {}: [\d.]+ s$'.format(re.escape(str(GAP[1]))), report, re.M)
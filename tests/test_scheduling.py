@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from scheduling import StageScheduler
+
+# waits of stages that only finish when the test lets them, long enough to fail a test instead of hanging it
+STAGE_TIMEOUT = 10.
+FAILURE_BUDGET = 1.
+
+
+def test_independent_stages_overlap():
+    # both stages pass the barrier only when they run at the same time
+    barrier = threading.Barrier(2, timeout=STAGE_TIMEOUT)
+
+    def meet(value):
+        barrier.wait()
+        return value
+
+    scheduler = StageScheduler(max_workers=2)
+    scheduler.add('left', lambda: meet(1)) \
+        .add('right', lambda: meet(2)) \
+        .add('sum', lambda left, right: left + right, ['left', 'right'])
+
+    results = scheduler.run()
+
+    assert results == {'left': 1, 'right': 2, 'sum': 3}
+
+
+def test_failing_stage_fails_run_without_waiting():
+    released = threading.Event()
+    dependant_calls = []
+
+    def fail():
+        raise RuntimeError('reading failed')
+
+    scheduler = StageScheduler(max_workers=2)
+    scheduler.add('slow', lambda: released.wait(STAGE_TIMEOUT)) \
+        .add('failing', fail) \
+        .add('dependant', lambda value: dependant_calls.append(value), ['failing'])
+
+    started_at = time.monotonic()
+    try:
+        with pytest.raises(RuntimeError, match='reading failed'):
+            scheduler.run()
+        # the run fails while the independent stage is still running
+        assert time.monotonic() - started_at < FAILURE_BUDGET
+    finally:
+        released.set()
+    assert dependant_calls == []
+    report = scheduler.get_report()
+    assert 'dependant: not finished' in report
+    assert 'critical path: failing' in report
+
+
+def test_queued_stages_are_cancelled_on_failure():
+    released = threading.Event()
+    queued_calls = []
+
+    def fail():
+        raise RuntimeError('prediction failed')
+
+    # one worker runs the failing stage first, the independent one behind it never starts
+    scheduler = StageScheduler(max_workers=1)
+    scheduler.add('failing', fail) \
+        .add('queued', lambda: queued_calls.append(released.wait(STAGE_TIMEOUT)))
+
+    with pytest.raises(RuntimeError, match='prediction failed'):
+        scheduler.run()
+    released.set()
+    assert queued_calls == []
+
+
+def test_critical_path_follows_latest_dependencies():
+    scheduler = StageScheduler(max_workers=2)
+    scheduler.add('read_analysis', lambda: time.sleep(0.01)) \
+        .add('read_temperatures', lambda: time.sleep(0.2)) \
+        .add('process_temperatures', lambda temperatures: time.sleep(0.01), ['read_temperatures']) \
+        .add('predict', lambda analysis, temperatures: None, ['read_analysis', 'process_temperatures'])
+
+    scheduler.run()
+
+    assert scheduler.get_critical_path() == ['read_temperatures', 'process_temperatures', 'predict']
+    report = scheduler.get_report()
+    assert report.startswith('stages finished in')
+    assert report.endswith('critical path: read_temperatures -> process_temperatures -> predict')
@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import json
+import os
+
+from conftest import LightModelRepository
+
+import scoring_service
+from dao import Dao
+from scoring_service import ScoringService
+
+# clients stay below the listen backlog, each one sends its requests one after another
+CLIENTS_NUMBER = 50
+CLIENT_REQUESTS_NUMBER = 4
+P99_BUDGET_MS = 2000.
+MISSING_MODEL_SENSOR = 'BTIR-1310-2'
+SENSORS = ['BTIR-1317-1', 'BTIR-1310-1', 'BTIR-1311-1', 'BTIR-1312-1', MISSING_MODEL_SENSOR]
+
+
+async def _send(socket_path, message):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(message)
+    # a body shorter than its content length ends here instead of waiting for more
+    writer.write_eof()
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, response_body = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]), json.loads(response_body.decode('utf-8'))
+
+
+async def _post(socket_path, body):
+    payload = json.dumps(body).encode('utf-8')
+    return await _send(socket_path, 'POST /score HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(len(payload))
+                       .encode('latin-1') + payload)
+
+
+def _build_request(i, reactor_name):
+    since_datetime = datetime.datetime(2020, 1, 2) + datetime.timedelta(hours=4 * (i % 3))
+    return {'reactor': reactor_name, 'sensor': SENSORS[i % len(SENSORS)], 'since': since_datetime.isoformat(),
+            'until': (since_datetime + datetime.timedelta(hours=24)).isoformat()}
+
+
+async def _run_client(socket_path, requests):
+    return [await _post(socket_path, request) for request in requests]
+
+
+async def _start_server(service, socket_path):
+    server_task = asyncio.ensure_future(service.serve(unix_socket=socket_path))
+    while not os.path.exists(socket_path):
+        await asyncio.sleep(0.01)
+    return server_task
+
+
+async def _run_clients(service, socket_path, requests):
+    server_task = await _start_server(service, socket_path)
+    try:
+        clients_responses = await asyncio.gather(*[_run_client(socket_path, requests[i::CLIENTS_NUMBER])
+                                                   for i in range(CLIENTS_NUMBER)])
+    finally:
+        server_task.cancel()
+    responses = [None] * len(requests)
+    for i, client_responses in enumerate(clients_responses):
+        responses[i::CLIENTS_NUMBER] = client_responses
+    return responses
+
+
+def test_concurrent_clients_against_sqlite(historian, monkeypatch, tmp_path):
+    historian.feed()
+    monkeypatch.setattr(scoring_service, 'ModelRepository',
+                        lambda reactors, settings: LightModelRepository(missing_sensors=[MISSING_MODEL_SENSOR]))
+    service = ScoringService(historian.settings, Dao(), reload_interval=0)
+    requests = [_build_request(i, historian.settings.get_reactor_name())
+                for i in range(CLIENTS_NUMBER * CLIENT_REQUESTS_NUMBER)]
+
+    responses = asyncio.run(_run_clients(service, str(tmp_path / 'scoring.sock'), requests))
+
+    for request, (status, body) in zip(requests, responses):
+        if request['sensor'] == MISSING_MODEL_SENSOR:
+            # only requests of the sensor without a model fail, though they share batches with the others
+            assert status == 400
+            continue
+        assert status == 200
+        assert body['sensor'] == request['sensor']
+        assert len(body['timestamps']) > 0
+        assert all(str(datetime.datetime.fromisoformat(request['since'])) <= timestamp
+                   <= str(datetime.datetime.fromisoformat(request['until'])) for timestamp in body['timestamps'])
+        assert sorted(body['probabilities']) == sorted(LightModelRepository.HORIZONS)
+    stats = service.get_stats()
+    assert stats['requests'] == len(requests)
+    assert stats['batches'] < len(requests)
+    assert stats['p99_ms'] < P99_BUDGET_MS
+
+
+class _BrokenPredictorModelRepository(LightModelRepository):
+    def get_sensor_compiled_prediction_model(self, reactor_name, sensor):
+        raise KeyError('internal predictor lookup bug')
+
+
+def test_internal_errors_are_server_errors(historian, monkeypatch, tmp_path):
+    historian.feed()
+    monkeypatch.setattr(scoring_service, 'ModelRepository',
+                        lambda reactors, settings: _BrokenPredictorModelRepository())
+    service = ScoringService(historian.settings, Dao(), reload_interval=0)
+    reactor_name = historian.settings.get_reactor_name()
+    requests = [_build_request(0, reactor_name), _build_request(1, 'unknown reactor'),
+                dict(_build_request(2, reactor_name), sensor='unknown sensor'), {'reactor': reactor_name}]
+
+    responses = asyncio.run(_run_clients(service, str(tmp_path / 'scoring.sock'), requests))
+
+    assert [status for status, _ in responses] == [500, 400, 400, 400]
+    # the malformed request never reaches scoring, the failed ones are still in the latency percentiles
+    stats = service.get_stats()
+    assert stats['requests'] == 3
+    assert stats['p99_ms'] is not None
+
+
+async def _send_messages(service, socket_path, messages):
+    server_task = await _start_server(service, socket_path)
+    try:
+        return [await _send(socket_path, message) for message in messages]
+    finally:
+        server_task.cancel()
+
+
+def test_malformed_http_requests_are_client_errors(historian, monkeypatch, tmp_path):
+    monkeypatch.setattr(scoring_service, 'ModelRepository', lambda reactors, settings: LightModelRepository())
+    service = ScoringService(historian.settings, Dao(), reload_interval=0)
+    request = json.dumps(_build_request(0, historian.settings.get_reactor_name()))
+    messages = [b'GARBAGE\r\n\r\n',
+                b'POST /score HTTP/1.1\r\nContent-Length: many\r\n\r\n',
+                b'POST /score HTTP/1.1\r\nContent-Length: 100\r\n\r\n' + request[:10].encode('utf-8'),
+                b'POST /score HTTP/1.1\r\nContent-Length: 2\r\n\r\n\xff\xfe',
+                'POST /score HTTP/1.1\r\nContent-Length: {}\r\n\r\n{}'.format(len(request) - 1, request[:-1])
+                .encode('utf-8'),
+                'POST /score HTTP/1.1\r\nContent-Length: {0}\r\n\r\n{1}'.format(
+                    len(request), request.replace('2020-01-02', '2020-13-02')).encode('utf-8')]
+
+    responses = asyncio.run(_send_messages(service, str(tmp_path / 'scoring.sock'), messages))
+
+    assert [status for status, _ in responses] == [400] * len(messages)
+    assert all(body['error'].startswith('malformed request') for _, body in responses)
+
+
+def test_data_cache_keeps_only_requested_span(historian):
+    historian.feed()
+    cache = scoring_service._DataCache(historian.settings, Dao(), ttl=0)
+    input_data_handler = cache._input_data_handler
+    get_analysis = input_data_handler.get_analysis
+    read_since = []
+
+    def record_analysis_read(since_datetime=None, until_datetime=None):
+        read_since.append(since_datetime)
+        return get_analysis(since_datetime=since_datetime, until_datetime=until_datetime)
+
+    input_data_handler.get_analysis = record_analysis_read
+    early_since, late_since = datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 3)
+    cache.get(early_since)
+    cache.get(late_since)
+
+    # an expired cache is reloaded from the requested datetime, not from the earliest one ever asked for
+    assert read_since == [early_since - scoring_service.DATA_HISTORY, late_since - scoring_service.DATA_HISTORY]
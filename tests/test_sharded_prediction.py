@@ -0,0 +1,72 @@
+import datetime
+import multiprocessing
+
+import pytest
+from conftest import HISTORIAN_SINCE, Historian, SmoothModelRepository, build_settings
+
+import constants
+import predict_coking
+import sharded_prediction
+from dao import Dao
+from datasource import output_schema
+from datasource.source import SQLSource
+from settings import Settings
+from sharding.work_queue import DONE, FileWorkQueue, STATUSES
+
+WORKERS_NUMBER = 3
+# the history outlasts the analysis history read before every unit
+HISTORIAN_DAYS = 5
+# units are shorter than the smoothing period, so every unit depends on predictions of the previous ones
+UNIT_CHUNK = datetime.timedelta(hours=12)
+SENSORS_PER_UNIT = 8
+PREDICTIONS_KEYS = output_schema.TABLES_KEYS['predictions']
+
+
+def _read_predictions(settings):
+    output_source = SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN)
+    predictions = output_source.get_data_since(settings.get_output_tables()['predictions'])
+    return predictions.reset_index().set_index(PREDICTIONS_KEYS).sort_index().iloc[:, 0]
+
+
+@pytest.fixture
+def smooth_models(monkeypatch):
+    # worker processes are forked, so they inherit the patched repository
+    repository = lambda reactors, settings: SmoothModelRepository()  # noqa: E731
+    monkeypatch.setattr(sharded_prediction, 'ModelRepository', repository)
+    monkeypatch.setattr('model.models_repository.ModelRepository', repository)
+
+
+def test_local_workers_match_sequential_run(tmp_path, smooth_models):
+    historian = Historian(build_settings(tmp_path / 'sharded'), HISTORIAN_DAYS).feed()
+    settings = historian.settings
+    reactor_name = settings.get_reactor_name()
+    reactor = Dao().get_reactors_dao().find(reactor_name).exclude_sensors(settings.get_excluded_sensors())
+    queue_dir = str(tmp_path / 'queue')
+    # the first analysis timestamp is predicted by a sequential run, units start right before it
+    units = sharded_prediction.build_work_units(reactor_name, reactor.get_sensor_list(),
+                                                HISTORIAN_SINCE - constants.ONE_SECOND_DELTA,
+                                                historian.get_analysis_datetimes().max().to_pydatetime(),
+                                                UNIT_CHUNK, SENSORS_PER_UNIT)
+    FileWorkQueue(queue_dir).put(units)
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=sharded_prediction._run_worker,
+                               args=(historian.settings_path, queue_dir, constants.WORK_UNIT_LEASE_TIMEOUT, True))
+               for _ in range(WORKERS_NUMBER)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert [worker.exitcode for worker in workers] == [0] * WORKERS_NUMBER
+    progress = FileWorkQueue(queue_dir).get_progress()
+    assert progress == {status: len(units) if status == DONE else 0 for status in STATUSES}
+    sharded_predictions = _read_predictions(settings)
+    assert not sharded_predictions.index.duplicated().any()
+
+    sequential_settings_path = build_settings(tmp_path / 'sequential',
+                                              input_params={'database': settings.get_input()['database']})
+    assert predict_coking.main([sequential_settings_path]) == 0
+    sequential_predictions = _read_predictions(Settings(sequential_settings_path))
+    assert sharded_predictions.index.equals(sequential_predictions.index)
+    assert (sharded_predictions - sequential_predictions).abs().max() < 1e-9
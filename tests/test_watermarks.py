@@ -0,0 +1,88 @@
+import datetime
+
+import pandas as pd
+import pytest
+from conftest import LightModelRepository
+
+import constants
+import predict_coking
+from datasource.data_handling import OutputDataHandler
+from datasource.source import SQLSource
+from settings import Settings
+
+STATISTICS_TABLES = ['temperatures', 'temperatures_diff', 'plates_temperatures_std', 'temperatures_std']
+
+
+def _build_predictions(plate_num, sensor_num, datetimes):
+    return pd.DataFrame({'{}:{}:1'.format(plate_num, sensor_num): [0.5] * len(datetimes)},
+                        index=pd.DatetimeIndex(datetimes, name=constants.OUTPUT_DATETIME_COLUMN))
+
+
+def _count_rows(settings, table_type):
+    output_source = SQLSource(settings.get_output(), constants.OUTPUT_DATETIME_COLUMN)
+    data = output_source.get_data_since(settings.get_output_tables()[table_type])
+    return data.shape[0], data.reset_index().duplicated().sum()
+
+
+def test_failed_run_keeps_watermark(settings_path):
+    settings = Settings(settings_path)
+    output_data_handler = OutputDataHandler(settings)
+    datetimes = [datetime.datetime(2020, 1, 1, hour) for hour in [4, 8]]
+
+    last_datetime = output_data_handler.find_last_prediction_datetime()
+    assert last_datetime == constants.MIN_DATETIME
+    predictions_writer = output_data_handler.open_predictions_writer(last_datetime)
+    predictions_writer.write(_build_predictions(1, 1, datetimes))
+    predictions_writer.close()
+    # the run fails before the next sensors and the commit, the next run has to predict every sensor again
+    assert OutputDataHandler(settings).find_last_prediction_datetime() == constants.MIN_DATETIME
+
+    output_data_handler.commit_run({'temperatures_std': pd.DataFrame()},
+                                   predictions_writer.get_last_written_datetime())
+    assert OutputDataHandler(settings).find_last_prediction_datetime() == datetimes[-1]
+
+
+def test_failed_write_does_not_mask_run_failure(settings_path, monkeypatch):
+    output_data_handler = OutputDataHandler(Settings(settings_path))
+    datetimes = [datetime.datetime(2020, 1, 1, hour) for hour in [4, 8]]
+
+    def fail_write(table_type, data, watermark=None):
+        raise OSError('output database is gone')
+
+    monkeypatch.setattr(output_data_handler._sink, 'write', fail_write)
+    last_datetime = output_data_handler.find_last_prediction_datetime()
+    with pytest.raises(RuntimeError, match='prediction failed'):
+        with output_data_handler.open_predictions_writer(last_datetime) as predictions_writer:
+            predictions_writer.write(_build_predictions(1, 1, datetimes))
+            raise RuntimeError('prediction failed')
+
+    with pytest.raises(OSError):
+        with output_data_handler.open_predictions_writer(last_datetime) as predictions_writer:
+            predictions_writer.write(_build_predictions(1, 1, datetimes))
+
+
+def test_failed_run_writes_no_statistics(historian, monkeypatch):
+    historian.feed()
+    monkeypatch.setattr('model.models_repository.ModelRepository',
+                        lambda reactors, settings: LightModelRepository())
+    predict_sensor = predict_coking.predict_sensor
+    predicted_sensors = []
+
+    def fail_second_sensor(models_repo, reactor, sensor_id, temps, chemical):
+        predicted_sensors.append(sensor_id)
+        if len(predicted_sensors) == 2:
+            raise RuntimeError('prediction failed')
+        return predict_sensor(models_repo, reactor, sensor_id, temps, chemical)
+
+    monkeypatch.setattr(predict_coking, 'predict_sensor', fail_second_sensor)
+    with pytest.raises(RuntimeError):
+        predict_coking.main([historian.settings_path])
+    for table_type in STATISTICS_TABLES:
+        assert _count_rows(historian.settings, table_type) == (0, 0)
+
+    monkeypatch.setattr(predict_coking, 'predict_sensor', predict_sensor)
+    assert predict_coking.main([historian.settings_path]) == 0
+    for table_type in STATISTICS_TABLES:
+        rows_number, duplicates_number = _count_rows(historian.settings, table_type)
+        assert rows_number > 0
+        assert duplicates_number == 0